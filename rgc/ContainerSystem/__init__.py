@@ -33,14 +33,15 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ###############################################################################
 
-from rgc.ContainerSystem.modulefile import modulefile
+from rgc.ContainerSystem.pipeline import pipeline
 import os
 
-class ContainerSystem(modulefile):
+class ContainerSystem(pipeline):
 	def __init__(self, module_dir='./containers', \
 			container_dir='./containers', \
 			cache_dir=os.path.join(os.path.expanduser('~'),'rgc_cache'), \
-			module_system='lmod', force=False, force_cache=False, n_threads=4):
+			module_system='lmod', force=False, force_cache=False, n_threads=4, \
+			queue_size=0):
 		super(ContainerSystem, self).__init__()
 		# modulefile params
 		self.moduleDir = module_dir
@@ -60,3 +61,5 @@ class ContainerSystem(modulefile):
 		# cache params
 		self.cache_dir = cache_dir
 		# metadata params
+		# pipeline params
+		self.queue_size = queue_size
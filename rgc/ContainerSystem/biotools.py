@@ -0,0 +1,152 @@
+###############################################################################
+# Author: Greg Zynda
+# Last Modified: 01/15/2021
+###############################################################################
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Texas Advanced Computing Center - UT Austin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+import sys, os, logging, json
+from time import time
+logger = logging.getLogger(__name__)
+
+try:
+	import urllib2
+	pyv = 2
+except:
+	import urllib.request as urllib2
+	pyv = 3
+
+from rgc.ContainerSystem.url import url_parser
+from rgc.ContainerSystem.cache import cache
+from rgc.helpers import translate, iterdict
+from rgc.ThreadQueue import ThreadQueue
+
+class biotools(url_parser, cache):
+	'''
+	Class for looking up tools on https://dev.bio.tools either with one
+	request per tool or from a local index of the whole catalogue
+
+	# Attributes
+	biotools_api (str): URL of the bio.tools tool API
+	biotools_ttl (int): Seconds before the cached catalogue index is downloaded again
+	'''
+	biotools_api = 'https://dev.bio.tools/api/tool/'
+	biotools_ttl = 7*86400
+	def __init__(self):
+		'''
+		# Attributes
+		self.biotools_index (dict): Compact catalogue {name:(tool types, topics, operations, description, homepage),}. Tools are queried individually while this is empty.
+		'''
+		super(biotools, self).__init__()
+		self.biotools_index = {}
+	def loadBiotools(self, dump_file=''):
+		'''
+		Loads the whole bio.tools catalogue into `self.biotools_index` so the
+		library filter and module metadata need no request per image.
+		The index is read from a JSON dump when one is given. Otherwise it
+		comes from biotools.pkl in the cache dir, and is downloaded from
+		the paged list API when that is missing or older than `biotools_ttl`.
+
+		# Parameters
+		dump_file (str): JSON file with a list of bio.tools records, or a list API page with a "list" key
+		'''
+		if dump_file:
+			with open(dump_file) as DF:
+				tools = json.load(DF)
+			if isinstance(tools, dict): tools = tools['list']
+			logger.info("Read %i bio.tools records from %s"%(len(tools), dump_file))
+		else:
+			index, updated = self._cache_load('biotools.pkl', (dict(), 0))
+			if index and time() < updated+self.biotools_ttl:
+				logger.info("Using the cached index of %i bio.tools records"%(len(index)))
+				self.biotools_index = index
+				return
+			tools = self._downloadBiotools()
+		index = {}
+		for tool in tools:
+			record = self._compactTool(tool)
+			for key in (tool.get('biotoolsID', ''), tool.get('name', '')):
+				if key: index[key.lower()] = record
+		self.biotools_index = index
+		self._cache_save('biotools.pkl', (index, time()))
+	def _downloadBiotools(self):
+		'''
+		Downloads every page of the bio.tools list API. The page count is
+		computed from the first page, and the remaining pages are
+		requested concurrently.
+
+		# Returns
+		list: bio.tools records
+		'''
+		page_query = self.biotools_api+'?format=json&page=%i'
+		resp = self._getJSON(page_query%(1), 'bio.tools')
+		tools = list(resp['list'])
+		n_pages = -(-int(resp['count'])//max(len(tools), 1))
+		logger.info("Downloading %i bio.tools records from %i pages"%(int(resp['count']), n_pages))
+		if n_pages > 1:
+			tq = ThreadQueue(target=lambda page: self._getJSON(page_query%(page), 'bio.tools')['list'], \
+				n_threads=getattr(self, 'n_threads', 4))
+			pages = tq.process_list(range(2, n_pages+1))
+			tq.join()
+			for page in pages:
+				if not page.ok: raise page.exception
+				tools += page.result
+		return tools
+	def _compactTool(self, tool):
+		'''
+		Returns the fields of a bio.tools record used by rgc
+
+		# Parameters
+		tool (dict): bio.tools record
+
+		# Returns
+		tuple: (tool types, topics, operations, description, homepage)
+		'''
+		return (tuple(tool.get('toolType', [])), \
+			tuple(t['term'] for t in tool.get('topic', []) if t['term'] != 'N/A'), \
+			tuple(o['term'] for f in tool.get('function', []) for o in f['operation']), \
+			tool.get('description', ''), tool.get('homepage', False))
+	def _biotoolsTool(self, name):
+		'''
+		Looks up a tool on bio.tools, using the catalogue index when loaded
+
+		# Parameters
+		name (str): Tool name
+
+		# Returns
+		tuple: (tool types, topics, operations, description, homepage), or None if bio.tools has no record of the tool
+		'''
+		if self.biotools_index:
+			return self.biotools_index.get(name.lower(), None)
+		try:
+			return self._compactTool(self._getJSON(self.biotools_api+'%s?format=json'%(name), 'bio.tools'))
+		except urllib2.HTTPError:
+			return None
@@ -0,0 +1,381 @@
+###############################################################################
+# Author: Greg Zynda
+# Last Modified: 01/15/2021
+###############################################################################
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Texas Advanced Computing Center - UT Austin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+
+import sys, os, logging, json, hashlib
+from collections import Counter
+from threading import current_thread, Lock
+logger = logging.getLogger(__name__)
+
+try:
+	import httplib
+	import urllib2
+except ImportError:
+	import http.client as httplib
+	import urllib.request as urllib2
+
+from rgc.ContainerSystem.validate import validate
+from rgc.helpers import translate, delete, file_lock, makedirs
+from rgc.ThreadQueue import ThreadQueue, Singleflight
+
+class layers(validate):
+	'''
+	Class for reading image manifests and downloading layer blobs through
+	the registry API
+
+	# Attributes
+	image_layers (dict): Layers of each manifest digest {digest:((layer digest, bytes),),}
+	digest_images (dict): {digest: path,} of image files pulled in this or earlier runs
+	platform (tuple): (os, architecture) picked from multi-platform manifests
+	list_types (tuple): Media types of multi-platform manifests
+	blob_retries (int): Attempts at downloading a blob, each resuming the previous one
+	layer_threads (int): Number of layers of an image downloaded at once
+	blob_flight (Singleflight): Downloads each blob once when several images need it
+	pull_limited (tuple): Registries that count manifest GET requests against an anonymous pull limit
+	manifest_lookups (int): Maximum number of new manifests read by `_lookupLayers` in a run
+	manifest_reads (int): Number of new manifests `_lookupLayers` was allowed to read
+	'''
+	platform = ('linux', 'amd64')
+	list_types = ('application/vnd.docker.distribution.manifest.list.v2+json', \
+		'application/vnd.oci.image.index.v1+json')
+	blob_retries = 3
+	layer_threads = 4
+	pull_limited = ('dockerhub',)
+	manifest_lookups = 100
+	def __init__(self):
+		super(layers, self).__init__()
+		self.image_layers = {}
+		self.digest_images = {}
+		self.manifest_reads = 0
+		self.manifest_lock = Lock()
+		self.blob_flight = Singleflight()
+	def _loadLayers(self):
+		cached = self._cache_load('layers.pkl', ({}, {}))
+		# Caches written before image files were tracked only hold the layers
+		self.image_layers, self.digest_images = cached if isinstance(cached, tuple) else (cached, {})
+	def _saveLayers(self):
+		self._cache_save('layers.pkl', (self.image_layers, self.digest_images))
+	def _imageDigest(self, url, resolve=True):
+		'''
+		Returns the manifest digest of url from validation or the tag
+		index. When neither knows it, the registry is asked with a single
+		HEAD request.
+
+		# Parameters
+		url (str): Image url used to pull
+		resolve (bool): Ask the registry when the digest is unknown
+
+		# Returns
+		str: Manifest digest ('' if unknown)
+		'''
+		if self.digest.get(url, ''): return self.digest[url]
+		indexed = self.tag_index.get(self._getUrlTuple(url), {}).get(self.tag[url], False)
+		if indexed and indexed[1]: return indexed[1]
+		if not resolve or self.offline or self.registry[url] not in self.registry_api: return ''
+		try:
+			return self._manifestDigest(url) or ''
+		except Exception as e:
+			logger.debug("Unable to resolve the digest of %s: %s"%(url, str(e)))
+			return ''
+	def _getManifest(self, url, reference):
+		'''
+		Returns the digest, the decoded manifest, and the raw manifest of
+		reference, a tag or digest in the repository of url
+		'''
+		resp = self._registryRequest(url, 'manifests/%s'%(reference), headers={'Accept':self.manifest_types})
+		digest = resp.headers.get('docker-content-digest', '') or 'sha256:'+hashlib.sha256(resp.body).hexdigest()
+		return digest, json.loads(translate(resp.body)), resp.body
+	def _platformManifest(self, index):
+		'''
+		Returns the digest of the `self.platform` manifest in a multi-platform
+		manifest ('' if there is none)
+		'''
+		for m in index.get('manifests', []):
+			p = m.get('platform', {})
+			if (p.get('os', ''), p.get('architecture', '')) == self.platform:
+				return m['digest']
+		return ''
+	def _imageLayers(self, url, fetch=True):
+		'''
+		Returns the layers of the image of url. The manifest digest comes from
+		validation, the tag index, or a HEAD request. Layers are stored by
+		digest in layers.pkl. A new digest costs a manifest GET, or two for
+		a multi-platform index, and Docker Hub counts those GETs against
+		its pull limit.
+
+		# Parameters
+		url (str): Image url used to pull
+		fetch (bool): Download the manifest when the layers of the digest are not stored
+
+		# Attributes
+		self.image_layers (dict): The layers of the manifest digest are added
+
+		# Returns
+		tuple: ((layer digest, bytes),) in the order they are applied
+		'''
+		if url not in self.registry: self.parseURL(url)
+		digest = self._imageDigest(url)
+		if not digest: return ()
+		if digest in self.image_layers: return self.image_layers[digest]
+		if not fetch: return ()
+		manifest = self._getManifest(url, digest)[1]
+		if manifest.get('mediaType', '') in self.list_types or 'manifests' in manifest:
+			platform_digest = self._platformManifest(manifest)
+			manifest = self._getManifest(url, platform_digest)[1] if platform_digest else {}
+		# Schema 1 manifests do not list layer sizes, so they are skipped
+		layer_list = tuple((l['digest'], int(l.get('size', 0))) for l in manifest.get('layers', []))
+		self.image_layers[digest] = layer_list
+		return layer_list
+	def _lookupLayers(self, url):
+		'''
+		Reads the layers of url into `self.image_layers` so scheduling can
+		use them without a request. Manifest GETs would use up the pull
+		limit of registries in `self.pull_limited`, so their images only use
+		stored layers unless `self.registry_mirror` is set. At most
+		`self.manifest_lookups` new manifests are read.
+
+		# Parameters
+		url (str): Image url used to pull
+
+		# Returns
+		tuple: ((layer digest, bytes),), or () if unknown
+		'''
+		registry = self._getUrlTuple(url)[0]
+		if registry not in self.registry_api: return ()
+		fetch = registry not in self.pull_limited or bool(self.registry_mirror)
+		if fetch and self._imageDigest(url, resolve=False) not in self.image_layers:
+			with self.manifest_lock:
+				fetch = self.manifest_reads < self.manifest_lookups
+				self.manifest_reads += 1
+				if self.manifest_reads == self.manifest_lookups+1:
+					logger.warning("Read %i manifests for layer sizes. Other images are scheduled without them."%(self.manifest_lookups))
+		try:
+			return self._imageLayers(url, fetch)
+		except Exception as e:
+			logger.debug("Unable to read the layers of %s: %s"%(url, str(e)))
+			return ()
+	def _resolveLayers(self, url_list):
+		'''
+		Runs `_lookupLayers` on the images in url_list on `self.n_threads`
+		threads, so later `_imageLayers` calls are answered from
+		`self.image_layers`
+
+		# Parameters
+		url_list (list): Image urls
+
+		# Returns
+		list: TaskResult records of `_lookupLayers`
+		'''
+		url_list = [url for url in url_list if self._getUrlTuple(url)[0] in self.registry_api]
+		if not url_list: return []
+		reads = self.manifest_reads
+		tq = ThreadQueue(target=self._lookupLayers, n_threads=self.n_threads, progress=False)
+		results = tq.process_list(url_list)
+		tq.join()
+		new = min(self.manifest_reads, self.manifest_lookups)-min(reads, self.manifest_lookups)
+		if new: logger.info("Read up to %i new manifests for the layers of %i images"%(new, len(url_list)))
+		return results
+	def _layerSize(self, url):
+		'''
+		Returns the compressed size of the image of url as the sum of the
+		manifest layers stored by `_lookupLayers`. Validation only sends a
+		HEAD request for the manifest, so this is the size of images the
+		registry never reported. No request is made, so it is safe in a
+		ThreadQueue priority function.
+
+		# Parameters
+		url (str): Image url used to pull
+
+		# Returns
+		int: Size in bytes (0 if unknown)
+		'''
+		layer_list = self.image_layers.get(self._imageDigest(url, resolve=False), ())
+		return sum(size for digest, size in layer_list)
+	def _sharedLayers(self, url_list, n):
+		'''
+		Counts the layers of the images in url_list and returns the n layers
+		that save the most bytes when they are downloaded once, which is
+		their size times the number of other images that use them.
+
+		# Parameters
+		url_list (list): Image urls
+		n (int): Maximum number of layers
+
+		# Returns
+		list: [(layer digest, url of an image with the layer),] most saved bytes first
+		'''
+		if self.offline and not self.registry_mirror: return []
+		results = self._resolveLayers(url_list)
+		counts, sizes, source = Counter(), {}, {}
+		for record in results:
+			if not record.ok:
+				logger.debug("Unable to read the layers of %s: %s"%(record.args, str(record.exception)))
+				continue
+			for digest, size in set(record.result):
+				counts[digest] += 1
+				sizes[digest] = size
+				source.setdefault(digest, record.args)
+		saved = sorted(((sizes[d]*(c-1), d) for d, c in counts.items() if c > 1), reverse=True)[:n]
+		if saved: logger.info("The %i most shared layers save %.1f GB of downloads"%(len(saved), sum(s for s, d in saved)/1e9))
+		return [(d, source[d]) for s, d in saved]
+	def _fetchBlob(self, url, digest, blob_dir):
+		'''
+		Downloads a blob from the repository of url to blob_dir/<algorithm>/<hex>.
+		The digest is checked while the blob is written, and the file only
+		appears once it is complete. Interrupted downloads are kept in a
+		partial file next to blob_dir, and are resumed with a Range request
+		by later attempts, threads, or runs. Existing blobs are not
+		downloaded again.
+
+		# Parameters
+		url (str): Image url of a repository containing the blob
+		digest (str): Blob digest
+		blob_dir (str): Blob directory of an OCI layout
+
+		# Raises
+		ValueError: If the downloaded blob does not match its digest
+
+		# Returns
+		str: Path of the blob
+		'''
+		algorithm, hex_digest = digest.split(':', 1)
+		blob_path = os.path.join(blob_dir, algorithm, hex_digest)
+		if os.path.exists(blob_path): return blob_path
+		partial_dir = os.path.join(os.path.dirname(blob_dir), 'partial')
+		for d in (os.path.dirname(blob_path), partial_dir): makedirs(d)
+		partial = os.path.join(partial_dir, hex_digest)
+		return self.blob_flight.do(digest, self._downloadBlob, url, digest, blob_path, partial)
+	def _downloadBlob(self, url, digest, blob_path, partial):
+		'''
+		Retries `_resumeBlob` while holding a lock on the partial file, so
+		other processes wait instead of downloading the same blob
+		'''
+		with file_lock(partial+'.lock'):
+			for attempt in range(self.blob_retries):
+				if os.path.exists(blob_path): break
+				try:
+					self._resumeBlob(url, digest, partial)
+				except (httplib.HTTPException, IOError, OSError, ValueError) as e:
+					# Client errors will not change on a retry
+					if attempt+1 == self.blob_retries or 400 <= getattr(e, 'code', 500) < 500: raise
+					logger.debug("Resuming %s after: %s"%(digest, str(e)))
+					continue
+				os.rename(partial, blob_path)
+				logger.debug("Downloaded %s"%(digest))
+				break
+		return blob_path
+	def _resumeBlob(self, url, digest, partial):
+		'''
+		Downloads the rest of a blob to its partial file, starting after the
+		bytes already in it. A registry that ignores the Range header sends
+		the whole blob, which replaces the partial file.
+
+		# Raises
+		ValueError: If the partial file does not match the digest. It is deleted.
+		'''
+		algorithm, hex_digest = digest.split(':', 1)
+		hasher = [hashlib.new(algorithm)]
+		offset = 0
+		if os.path.exists(partial):
+			with open(partial, 'rb') as IF:
+				for chunk in iter(lambda: IF.read(1<<20), b''):
+					hasher[0].update(chunk)
+					offset += len(chunk)
+		out = []
+		def start(resp):
+			if resp.status != 206:
+				hasher[0] = hashlib.new(algorithm)
+			out.append(open(partial, 'ab' if resp.status == 206 else 'wb'))
+		def write(chunk):
+			hasher[0].update(chunk)
+			out[0].write(chunk)
+		headers = {'Range':'bytes=%i-'%(offset)} if offset else {}
+		if offset: logger.debug("Resuming %s after %i bytes"%(digest, offset))
+		try:
+			self._registryRequest(url, 'blobs/%s'%(digest), headers=headers, write=write, start=start)
+		except urllib2.HTTPError as e:
+			# 416 means the partial file already holds the whole blob
+			if e.code != 416 or not offset: raise
+		finally:
+			for OF in out: OF.close()
+		if hasher[0].hexdigest() != hex_digest:
+			delete(partial)
+			raise ValueError("Downloaded blob does not match %s"%(digest))
+	def _downloadImage(self, url, blob_dir):
+		'''
+		Downloads the manifest, config, and layers of the image of url into
+		the blob directory of an OCI layout. Layers are downloaded
+		`self.layer_threads` at a time.
+
+		# Parameters
+		url (str): Image url used to pull
+		blob_dir (str): Blob directory of an OCI layout
+
+		# Attributes
+		self.image_layers (dict): The layers of the manifest digest are added
+
+		# Raises
+		ValueError: If the registry has no `self.platform` image, or a blob does not match its digest
+
+		# Returns
+		tuple: (manifest digest, manifest media type, manifest bytes) of the platform image
+		'''
+		if url not in self.registry: self.parseURL(url)
+		digest, manifest, body = self._getManifest(url, self.tag[url])
+		top_digest = digest
+		if manifest.get('mediaType', '') in self.list_types or 'manifests' in manifest:
+			platform_digest = self._platformManifest(manifest)
+			if not platform_digest: raise ValueError("%s has no %s/%s image"%(url, self.platform[0], self.platform[1]))
+			digest, manifest, body = self._getManifest(url, platform_digest)
+		if 'config' not in manifest: raise ValueError("%s has an unsupported manifest"%(url))
+		# The manifest is stored under the digest of its bytes
+		digest = 'sha256:'+hashlib.sha256(body).hexdigest()
+		layer_list = tuple((l['digest'], int(l.get('size', 0))) for l in manifest.get('layers', []))
+		self.image_layers[top_digest] = layer_list
+		if not self.digest.get(url, ''): self.digest[url] = top_digest
+		blobs = [manifest['config']['digest']]+[l[0] for l in layer_list]
+		tq = ThreadQueue(target=self._fetchBlob, n_threads=self.layer_threads, progress=False)
+		results = tq.process_list([(url, blob, blob_dir) for blob in blobs])
+		tq.join()
+		for record in results:
+			if not record.ok: raise record.exception
+		manifest_path = os.path.join(blob_dir, 'sha256', digest.split(':', 1)[1])
+		if not os.path.exists(manifest_path):
+			tmp_path = '%s.%i.%i.tmp'%(manifest_path, os.getpid(), current_thread().ident)
+			with open(tmp_path, 'wb') as OF:
+				OF.write(body)
+			os.rename(tmp_path, manifest_path)
+		media_type = manifest.get('mediaType', 'application/vnd.oci.image.manifest.v1+json')
+		return digest, media_type, body
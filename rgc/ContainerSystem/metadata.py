@@ -34,6 +34,7 @@
 ###############################################################################
 
 import sys, os, logging, json
+from threading import Thread
 logger = logging.getLogger(__name__)
 
 try:
@@ -43,10 +44,11 @@ except:
 	import urllib.request as urllib2
 	pyv = 3
 
-from rgc.ContainerSystem.url import url_parser
+from rgc.ContainerSystem.biotools import biotools
 from rgc.helpers import translate, iterdict, retry_call, delete
+from rgc.ThreadQueue import Singleflight
 
-class metadata(url_parser):
+class metadata(biotools):
 	'''
 	Class for interacting with variable cache
 
@@ -55,13 +57,19 @@ class metadata(url_parser):
 	self.keywords (dict)= {url: keyword list}
 	self.description (dict)= {url: description}
 	self.homepage (dict)= {url: homepage url}
+	self.metadata_flight (Singleflight): Coalesces concurrent lookups of the same tool name
+	self.tool_metadata (dict): Metadata found for each tool name {name:(functions, topics, description, homepage),}
+	launchpad_api (str): URL of the launchpad project API
 	'''
+	launchpad_api = 'https://api.launchpad.net/devel/'
 	def __init__(self):
 		super(metadata, self).__init__()
 		self.categories = {}
 		self.keywords = {}
 		self.description = {}
 		self.homepage = {}
+		self.metadata_flight = Singleflight()
+		self.tool_metadata = {}
 	def _getMetadata(self, url):
 		'''
 		Assuming the image is a biocontainer,
@@ -80,32 +88,70 @@ class metadata(url_parser):
 			logger.debug("Metadata already set for %s"%(url))
 			return
 		if url not in self.name: self.parseURL(url)
-		name = self.name[url]
-		self.homepage[url] = False
-		try:
-			# Check dev.bio.tools
-			md_url = "https://dev.bio.tools/api/tool/%s?format=json"%(name)
-			resp_json = json.loads(translate(urllib2.urlopen(md_url).read()))
-			topics = [topic['term'] for topic in resp_json['topic']]
-			topics = [t for t in topics if t != 'N/A']
-			functions = [o['term'] for f in resp_json['function'] for o in f['operation']]
-			desc = resp_json['description']
-			if 'homepage' in resp_json: self.homepage[url] = resp_json['homepage']
-		except urllib2.HTTPError:
-			try:
-				# Check Launchpad
-				md_url = "https://api.launchpad.net/devel/%s"%(name)
-				resp_json = json.loads(translate(urllib2.urlopen(md_url).read()))
-				desc = resp_json['description']
-				self.homepage[url] = resp_json['homepage_url']
-				topics = ["Container"]
-				functions = ["Unknown"]
-			except:
-				# Default values
-				logger.debug("No record of %s on dev.bio.tools or launchpad"%(name))
-				functions = ["Unknown"]
-				topics = ["Container"]
-				desc = "The %s package"%(name)
-		self.categories[url] = functions
-		self.keywords[url] = topics
+		functions, topics, desc, homepage = self.metadata_flight.do(self.name[url], self._lookupMetadata, self.name[url])
+		# The description is set last because it marks the metadata as complete
+		self.homepage[url] = homepage
+		self.categories[url] = list(functions)
+		self.keywords[url] = list(topics)
 		self.description[url] = desc
+	def _lookupMetadata(self, name):
+		'''
+		Returns the metadata of a tool, querying it only once
+
+		# Parameters
+		name (str): Tool name
+
+		# Returns
+		tuple: (functions, topics, description, homepage)
+		'''
+		if name not in self.tool_metadata:
+			self.tool_metadata[name] = self._queryMetadata(name)
+		return self.tool_metadata[name]
+	def _queryMetadata(self, name):
+		'''
+		Looks up a tool on https://dev.bio.tools (or the local catalogue
+		index) and on launchpad, falling back to default values. Unless
+		the catalogue index is loaded, launchpad is queried at the same
+		time as bio.tools so a miss on bio.tools does not add a second
+		round trip.
+
+		# Parameters
+		name (str): Tool name
+
+		# Returns
+		tuple: (functions, topics, description, homepage)
+		'''
+		launchpad = {}
+		if self.biotools_index:
+			hedge = False
+		else:
+			# Query launchpad while waiting on bio.tools
+			hedge = Thread(target=self._launchpadTool, args=(name, launchpad))
+			hedge.daemon = True
+			hedge.start()
+		tool = self._biotoolsTool(name)
+		if tool:
+			return (list(tool[2]), list(tool[1]), tool[3], tool[4])
+		if hedge:
+			hedge.join()
+		else:
+			self._launchpadTool(name, launchpad)
+		if launchpad:
+			return (["Unknown"], ["Container"], launchpad['description'], launchpad['homepage_url'])
+		# Default values
+		logger.debug("No record of %s on dev.bio.tools or launchpad"%(name))
+		return (["Unknown"], ["Container"], "The %s package"%(name), False)
+	def _launchpadTool(self, name, out):
+		'''
+		Updates out with the description and homepage_url of a launchpad
+		project. out is left empty if there is no usable record.
+
+		# Parameters
+		name (str): Tool name
+		out (dict): Receives the launchpad record
+		'''
+		try:
+			resp_json = self._getJSON(self.launchpad_api+name, 'launchpad')
+			out.update(description=resp_json['description'], homepage_url=resp_json['homepage_url'])
+		except:
+			logger.debug("No launchpad record of %s"%(name))
@@ -38,7 +38,7 @@ import subprocess as sp
 logger = logging.getLogger(__name__)
 
 from rgc.ContainerSystem.scan import scan
-from rgc.helpers import translate, iterdict, retry_call, delete, unescapeURL
+from rgc.helpers import translate, iterdict, retry_call, delete, unescapeURL, makedirs
 
 class modulefile(scan):
 	module_systems = {'lmod'}
@@ -67,22 +67,38 @@ class modulefile(scan):
 				self.genLMOD(url, pathPrefix, contact_url, mod_prefix, tracker_url, force, lmod_prereqs)
 			else:
 				logger.error("The %s module system is not currently supported"%(self.module_system))
-		if delete_old:
-			# Generate all module names
-			recent_modules = set([])
-			for url in self.images:
-				name, tag = self.name[url], self.tag[url]
-				module_tag = '%s-%s'%(mod_prefix, tag) if mod_prefix else tag
-				module_file = os.path.join(self.moduleDir, name, '%s.lua'%(module_tag))
-				recent_modules.add(module_file)
-			# Delete extras
-			self.logger.info("Deleting unused module files")
-			all_files = set((os.path.join(p, f) for p, ds, fs in os.walk(self.moduleDir) for f in fs))
-			to_delete = all_files - recent_modules
-			for fpath in to_delete:
-				if fpath.split('.')[-1] == 'lua':
-					logger.info("Deleting old modulefile %s"%(fpath))
-					os.remove(fpath)
+		if delete_old: self._deleteOldModules(mod_prefix)
+	def _moduleFile(self, url, mod_prefix=''):
+		'''
+		Returns the path of the Lmod modulefile for an image
+
+		# Parameters
+		url (str): Image url used to pull
+		mod_prefix (str): Container module files can be tagged with mod_prefix-tag
+
+		# Returns
+		str: Path to the modulefile
+		'''
+		record = self.records[url]
+		module_tag = '%s-%s'%(mod_prefix, record.tag) if mod_prefix else record.tag
+		return os.path.join(self.moduleDir, record.name, '%s.lua'%(module_tag))
+	def _deleteOldModules(self, mod_prefix=''):
+		'''
+		Deletes modulefiles in `self.moduleDir` that do not belong to an image in `self.images`
+
+		# Parameters
+		mod_prefix (str): Container module files can be tagged with mod_prefix-tag
+		'''
+		# Generate all module names
+		recent_modules = set([self._moduleFile(url, mod_prefix) for url in self.images])
+		# Delete extras
+		logger.info("Deleting unused module files")
+		all_files = set((os.path.join(p, f) for p, ds, fs in os.walk(self.moduleDir) for f in fs))
+		to_delete = all_files - recent_modules
+		for fpath in to_delete:
+			if fpath.split('.')[-1] == 'lua':
+				logger.info("Deleting old modulefile %s"%(fpath))
+				os.remove(fpath)
 	def genLMOD(self, url, pathPrefix, contact_url, mod_prefix='', tracker_url='', force=False, lmod_prereqs=[]):
 		'''
 		Generates an Lmod modulefile based on the cached container.
@@ -102,7 +118,8 @@ class modulefile(scan):
 		if url in self.invalid: return False
 		if url not in self.programs: self.scanPrograms(url)
 		#####
-		name, tag = self.name[url], self.tag[url]
+		record = self.records[url]
+		name, tag = record.name, record.tag
 		module_tag = '%s-%s'%(mod_prefix, tag) if mod_prefix else tag
 		keywords = ', '.join(self.keywords[url])
 		categories = ', '.join(self.categories[url])
@@ -112,8 +129,8 @@ class modulefile(scan):
 		img_path = self.images[url].lstrip('./')
 		contacts = '\t'+'\n\t'.join(contact_url.split(','))
 		#####
-		mPath = os.path.join(self.moduleDir, name)
-		outFile = os.path.join(mPath, "%s.lua"%(module_tag))
+		outFile = self._moduleFile(url, mod_prefix)
+		mPath = os.path.dirname(outFile)
 		if os.path.exists(outFile) and not force:
 			logger.debug("%s already exists. Skipping"%(outFile))
 			return True
@@ -129,22 +146,23 @@ class modulefile(scan):
 			decription=self.description[url], home_url=self.homepage[url], \
 			keywords=keywords, name=name, run_function=cmd_str, \
 			programs_list=progList, programs_string=progStr, \
-			url=self.sanitized_url[url], version=module_tag, \
-			web_url=self.full_url[url]) #, shell_functions=func_str)
+			url=record.sanitized_url, version=module_tag, \
+			web_url=record.full_url) #, shell_functions=func_str)
 		# add prereqs
 		if lmod_prereqs and lmod_prereqs[0]:
 			prereq_string = '","'.join(lmod_prereqs)
 			full_text += '\ndepends_on("%s")\n'%(prereq_string)
 			full_text += 'prereq("%s")\n'%(prereq_string)
 		#####
-		if not os.path.exists(mPath): os.makedirs(mPath)
+		makedirs(mPath)
 		with open(outFile,'w') as OF: OF.write(full_text)
 		return True
 	def _gen_function_prefix(self, url, pathPrefix, module_tag, tracker_url=""):
 		'''
 		Looks for {package_name}, {package_version}, and {application} in the tracker_url
 		'''
-		name, tag = self.name[url], self.tag[url]
+		record = self.records[url]
+		name, tag = record.name, record.tag
 		img_path = self.images[url].lstrip('./')
 		if 'singularity' in self.system:
 			prefix_path = os.getcwd()
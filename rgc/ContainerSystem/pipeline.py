@@ -0,0 +1,187 @@
+###############################################################################
+# Author: Greg Zynda
+# Last Modified: 01/15/2021
+###############################################################################
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Texas Advanced Computing Center - UT Austin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+import os, logging
+from collections import Counter
+logger = logging.getLogger(__name__)
+
+from rgc.ContainerSystem.modulefile import modulefile
+from rgc.helpers import remove_empty_sub_directories
+from rgc.ThreadQueue import ThreadQueue, log_slowest
+
+class pipeline(modulefile):
+	'''
+	Class for streaming images through the validate, pull, scan, and
+	modulefile stages without waiting for every image to finish a stage
+
+	# Attributes
+	self.queue_size (int): Maximum number of images waiting between two stages (0 is unbounded)
+	self.exposed (dict): {url: sorted program list,} written to modulefiles during the current run
+	'''
+	def __init__(self):
+		super(pipeline, self).__init__()
+		self.queue_size = 0
+		self.exposed = {}
+	def pipelineAll(self, url_list, include_libs=False, baseline=[], p=25, \
+			pathPrefix='', contact_url='', mod_prefix='', tracker_url='', \
+			lmod_prereqs=[], delete_old=False, use_cache=True):
+		'''
+		Validates, pulls, scans, and generates modulefiles for a list of urls.
+		Each url moves to the next stage as soon as it finishes the current
+		one, so slow pulls no longer hold back scanning and modulefile
+		generation of images that are already done. Every stage has its
+		own pool of `self.n_threads` workers.
+
+		Programs shared across images are only known once every image has
+		been scanned, so `findCommon` runs after the stream has drained and
+		any modulefile whose program list changed is regenerated.
+
+		# Parameters
+		url_list (iterable): Urls to process. They are consumed as they are read, so a generator lets work start before the whole list exists.
+		include_libs (bool): Include containers of libraries
+		baseline (list): Urls that are scanned to block their programs, but do not get modulefiles
+		p (int): Exclude programs in >= p% of images
+		pathPrefix (str): Prefix to prepend to containerDir (think environment variables)
+		contact_url (list): List of contact urls for reporting issues
+		mod_prefix (str): Container module files can be tagged with mod_prefix-tag
+		tracker_url (str): Google form tracker URL
+		lmod_prereqs (list): Module prerequisites
+		delete_old (bool): Delete outdated images and modulefiles
+		use_cache (bool): Use the singularity layer cache
+		'''
+		module_args = (pathPrefix, contact_url, mod_prefix, tracker_url, lmod_prereqs)
+		baseline = set(baseline)
+		# Load caches
+		self._loadValid()
+		self.categories, self.keywords, self.description, self.homepage = self._cache_load('metadata.pkl', [dict() for i in range(4)])
+		if not self.force_cache:
+			self.programs, self.program_count = self._cache_load('programs.pkl', (dict(), Counter()))
+		self._loadDurations()
+		self._loadTagIndex()
+		self._loadLayers()
+		for url in self.invalid | self.valid:
+			if url not in self.registry: self.parseURL(url)
+		if 'singularity' in self.system and use_cache:
+			# Shared layers are only counted when the URLs are known up front, since streamed URLs are read lazily
+			self._makeSingularityCache(url_list if isinstance(url_list, (list, tuple, set)) else ())
+		pull_threads = self._pullThreads()
+		# Stages are created from last to first so each can feed the next
+		self.exposed = {}
+		module_tq = ThreadQueue(target=lambda url: self._pipeModule(url, module_args), n_threads=self.n_threads, maxsize=self.queue_size)
+		scan_tq = ThreadQueue(target=lambda url: self._pipeScan(url, baseline, module_tq), n_threads=self.n_threads, maxsize=self.queue_size, priority=self._expectedScanTime)
+		pull_tq = ThreadQueue(target=lambda url: self._pipePull(url, scan_tq), n_threads=pull_threads, maxsize=self.queue_size, priority=self._expectedPullTime)
+		metadata_tq = ThreadQueue(target=self._resolveMetadata, n_threads=self.metadata_threads, progress=False)
+		validate_tq = ThreadQueue(target=lambda url: self._pipeValidate(url, include_libs, pull_tq, metadata_tq), n_threads=self.n_threads, maxsize=self.queue_size)
+		logger.info("Streaming URLs through validation, pulling, scanning, and module generation")
+		n_urls = 0
+		for url in url_list:
+			validate_tq.put(url)
+			n_urls += 1
+		logger.info("Read all %i URLs"%(n_urls))
+		# Drain the stages in order
+		for stage, tq in (('validate', validate_tq), ('pull', pull_tq), ('metadata', metadata_tq), ('scan', scan_tq), ('module', module_tq)):
+			results = tq.wait()
+			tq.join()
+			for record in results:
+				if not record.ok and stage == 'metadata':
+					logger.warning("Unable to resolve metadata of %s: %s"%(record.args, str(record.exception)))
+				elif not record.ok:
+					logger.error("Failed to %s %s. Marking as invalid."%(stage, record.args))
+					self._markInvalid(record.args, '%s failed'%(stage))
+			log_slowest(results)
+		if 'singularity' in self.system: self._pruneSingularityCache()
+		# Write caches
+		self._saveValid()
+		self._cache_save('metadata.pkl', (self.categories, self.keywords, self.description, self.homepage))
+		self._cache_save('programs.pkl', (self.programs, self.program_count))
+		self._saveDurations()
+		self._saveTagIndex()
+		self._saveLayers()
+		# Reconcile modulefiles with the final set of common programs
+		self.findCommon(p=p, baseline=list(baseline))
+		self._reconcileModules(module_args)
+		for url in baseline: self.deleteImage(url)
+		if delete_old:
+			self._deleteOldImages()
+			self._deleteOldModules(mod_prefix)
+		remove_empty_sub_directories(self.containerDir)
+	def _pipeValidate(self, url, include_libs, next_tq, metadata_tq):
+		'''
+		Validation stage of `pipelineAll`. Valid urls are queued for pulling
+		and for metadata resolution, which runs alongside the pulls.
+		'''
+		if url not in self.valid and url not in self.invalid:
+			self.validateURL(url, include_libs)
+		if url in self.valid:
+			metadata_tq.put(url)
+			# Pull priorities only read stored sizes, so layers are looked up here
+			if not self.image_size.get(url, 0) and not self._registrySize(url): self._lookupLayers(url)
+			next_tq.put(url)
+	def _pipePull(self, url, next_tq):
+		'''
+		Pull stage of `pipelineAll`. Pulled images are queued for scanning.
+		'''
+		if 'singularity' in self.system: self._makeImageDirs([url])
+		self.pull(url, metadata=False)
+		if self.images.get(url, False) and url not in self.invalid:
+			next_tq.put(url)
+	def _pipeScan(self, url, baseline, next_tq):
+		'''
+		Scan stage of `pipelineAll`. Scanned images, except baseline images, are queued for module generation.
+		'''
+		if self.scanPrograms(url) and url not in baseline:
+			next_tq.put(url)
+	def _pipeModule(self, url, module_args):
+		'''
+		Module generation stage of `pipelineAll`. Records the programs written
+		to each new modulefile so they can be reconciled after `findCommon`.
+		'''
+		pathPrefix, contact_url, mod_prefix, tracker_url, lmod_prereqs = module_args
+		if os.path.exists(self._moduleFile(url, mod_prefix)): return
+		# Waits for the metadata stage if it is still resolving this url
+		self._resolveMetadata(url)
+		if self.genLMOD(url, pathPrefix, contact_url, mod_prefix, tracker_url, False, lmod_prereqs):
+			self.exposed[url] = sorted(self.getPrograms(url))
+	def _reconcileModules(self, module_args):
+		'''
+		Regenerates modulefiles written by `pipelineAll` whose program list
+		changed after the final `findCommon` pass.
+		'''
+		pathPrefix, contact_url, mod_prefix, tracker_url, lmod_prereqs = module_args
+		changed = [url for url, progs in self.exposed.items() if sorted(self.getPrograms(url)) != progs]
+		logger.info("Regenerating %i of %i new modulefiles after excluding common programs"%(len(changed), len(self.exposed)))
+		for url in changed:
+			self.genLMOD(url, pathPrefix, contact_url, mod_prefix, tracker_url, True, lmod_prereqs)
+			self.exposed[url] = sorted(self.getPrograms(url))
@@ -33,29 +33,57 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ###############################################################################
 
-import sys, os, logging, tarfile
+import sys, os, logging, tarfile, json
+from time import time
 from tempfile import mkdtemp, mkstemp
-from shutil import rmtree
+from shutil import rmtree, move, copyfile, copymode
 import subprocess as sp
 from glob import glob
 logger = logging.getLogger(__name__)
-from rgc.ContainerSystem.validate import validate
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+from rgc.ContainerSystem.layers import layers
+from rgc.ContainerSystem.snapshot import snapshot
 from rgc.ContainerSystem.system import system
-from rgc.ContainerSystem.metadata import metadata
-from rgc.helpers import translate, iterdict, retry_call, delete, remove_empty_sub_directories
-from rgc.ThreadQueue import ThreadQueue
+from rgc.helpers import translate, iterdict, retry_call, delete, remove_empty_sub_directories, call, file_lock, makedirs
+from rgc.ThreadQueue import ThreadQueue, Singleflight, log_slowest
 
-class pull(validate, system, metadata):
+class pull(layers, snapshot, system):
 	'''
 	Class for interacting with variable cache
 
 	# Attributes
 	cache_dir (str): Location for metadata cache
 	force_cache (bool): Ignore current cache
+	pull_time (dict): {url: seconds,} spent pulling each image
+	scan_time (dict): {url: seconds,} spent scanning each image
+	image_size (dict): {url: bytes,} size of each pulled image
+	transfer_rate (dict): {stage: bytes per second,} cached by _transferRate until a duration or size is recorded
+	default_rate (float): Bytes per second assumed when converting an image size to a duration
+	pull_timeout (float): Seconds a pull may take across all of its attempts before it is killed (0 disables)
+	metadata_threads (int): Number of threads resolving metadata while images are pulled
+	digest_flight (Singleflight): Pulls and scans each manifest digest once
+	shared_layers (int): Number of the most shared layers downloaded to the layer cache before pulling
+	layer_cache_size (float): Bytes of layers kept in the layer cache. The least recently used layers are evicted beyond this
+	partial_age (float): Seconds after which an unfinished layer download is evicted from the layer cache
+	layer_used (dict): {layer digest: timestamp,} of layers used by pulls in this run
+	docker_config (str): Docker daemon configuration with max-concurrent-downloads
+	docker_downloads (int): Default max-concurrent-downloads of the Docker daemon
+	native_pull (bool): Download singularity3 images from the registry with rgc and only build them with singularity
 	'''
+	default_rate = 20e6
+	pull_timeout = 7200
+	metadata_threads = 4
 	ext_dict = {'docker':'sif', 'singularity2':'simg', 'singularity3':'sif'}
 	singularity_docker_image = "quay.io/singularity/singularity:v3.6.4-slim"
-	cache_docker_images = ['biocontainers/biocontainers:v1.2.0_cv1', 'biocontainers/biocontainers:vdebian-buster-backports_cv1', 'biocontainers/biocontainers:v1.1.0_cv2','biocontainers/biocontainers:v1.0.0_cv4']
+	shared_layers = 16
+	layer_cache_size = 50e9
+	partial_age = 7*24*3600
+	docker_config = '/etc/docker/daemon.json'
+	docker_downloads = 3
+	native_pull = True
 	def __init__(self, cDir='./containers', cache_dir=False, target=''):
 		super(pull, self).__init__()
 		self.containerDir = cDir
@@ -68,6 +96,12 @@ class pull(validate, system, metadata):
 		self.reached_pull_limit = False
 		self.n_threads = 4
 		self.images = {}
+		self.digest_flight = Singleflight()
+		self.layer_used = {}
+		self.pull_time = {}
+		self.scan_time = {}
+		self.image_size = {}
+		self.transfer_rate = {}
 		# Support a custom cache directory
 		if cache_dir:
 			self.cache_dir = cache_dir
@@ -89,40 +123,157 @@ class pull(validate, system, metadata):
 		# Load cache
 		cache_file = 'metadata.pkl'
 		self.categories, self.keywords, self.description, self.homepage = self._cache_load(cache_file, [dict() for i in range(4)])
-		if 'singularity' in self.system:
-			# Create tool name directory
-			for url in url_list:
-				if url not in self.full_url: self.parseURL(url)
-				simg_dir = os.path.join(self.containerDir, self.name[url])
-				if not os.path.exists(simg_dir): os.makedirs(simg_dir)
-			# Make singularity layer cache
-			if use_cache: self._makeSingularityCache()
+		self._loadDurations()
+		self._loadLayers()
+		# Resolve metadata alongside the pulls so pull threads only pull
+		metadata_tq = ThreadQueue(target=self._resolveMetadata, n_threads=self.metadata_threads, progress=False)
+		for url in url_list: metadata_tq.put(url)
+		try:
+			if 'singularity' in self.system:
+				# Create tool name directory
+				self._makeImageDirs(url_list)
+				# Make singularity layer cache
+				if use_cache: self._makeSingularityCache(url_list)
+			# Priorities only read stored sizes, so never-seen images are looked up in parallel first
+			self._resolveLayers([url for url in url_list if url not in self.pull_time \
+				and not self.image_size.get(url, 0) and not self._registrySize(url)])
 			# Process using ThreadQueue
-			logger.info("Pulling %i containers on %i threads"%(len(url_list), self.n_threads))
-			tq = ThreadQueue(target=self.pull, n_threads=self.n_threads)
-			tq.process_list(url_list)
+			n_threads = self._pullThreads()
+			logger.info("Pulling %i containers on %i threads"%(len(url_list), n_threads))
+			tq = ThreadQueue(target=lambda url: self.pull(url, metadata=False), n_threads=n_threads, priority=self._expectedPullTime)
+			results = tq.process_list(url_list)
 			tq.join()
-		else:
-			# Use single thread to pull with docker
-			for url in url_list:
-				self.pull(url)
+			# Images that raised during the pull are marked invalid
+			for record in results:
+				if not record.ok and record.args not in self.invalid:
+					self._pullError(record.args)
+			log_slowest(results)
+			if 'singularity' in self.system: self._pruneSingularityCache()
+		finally:
+			for record in metadata_tq.wait():
+				if not record.ok: logger.warning("Unable to resolve metadata of %s: %s"%(record.args, str(record.exception)))
+			metadata_tq.join()
 		# Write to cache
 		self._cache_save(cache_file, (self.categories, self.keywords, self.description, self.homepage))
+		self._saveDurations()
+		self._saveLayers()
+		# Keep images that failed to pull invalid on the next run
+		self._saveValid()
 		# Delete unused images
-		if delete_old:
-			logger.info("Deleting unused containers")
-			if 'singularity' in self.system:
-				all_files = set((os.path.join(p, f) for p, ds, fs in os.walk(self.containerDir) for f in fs))
-				to_delete = all_files - set(self.images.values())
-				for fpath in to_delete:
-					if fpath.split('.')[-1] in self.container_exts:
-						logger.info("Deleting old container %s"%(fpath))
-						os.remove(fpath)
-			else:
-				logger.info("RGC is unable to determine which docker containers it created. Not deleting any")
+		if delete_old: self._deleteOldImages()
 		# Remove empty image directories
 		remove_empty_sub_directories(self.containerDir)
-	def pull(self, url):
+	def _pullThreads(self):
+		'''
+		Returns the number of concurrent pulls. The Docker daemon shares its
+		max-concurrent-downloads between all pulls, so docker pulls are
+		limited to that many threads.
+
+		# Returns
+		int: Number of pull threads
+		'''
+		if self.system != 'docker': return self.n_threads
+		downloads = self.docker_downloads
+		try:
+			with open(self.docker_config) as CF:
+				downloads = int(json.load(CF).get('max-concurrent-downloads', downloads))
+		except (IOError, OSError, ValueError) as e:
+			logger.debug("Using %i concurrent docker downloads: %s"%(downloads, str(e)))
+		return max(1, min(self.n_threads, downloads))
+	def _loadDurations(self):
+		'''
+		Restores the recorded pull times, scan times, and image sizes from durations.pkl
+		'''
+		self.pull_time, self.scan_time, self.image_size = self._cache_load('durations.pkl', (dict(), dict(), dict()))
+		self.transfer_rate = {}
+	def _saveDurations(self):
+		'''
+		Saves the recorded pull times, scan times, and image sizes to durations.pkl
+		'''
+		self._cache_save('durations.pkl', (self.pull_time, self.scan_time, self.image_size))
+	def _recordTime(self, stage, url, seconds, size=0):
+		'''
+		Records how long a stage took for an image, and its size when known,
+		and drops the cached transfer rates
+
+		# Parameters
+		stage (str): "pull" or "scan"
+		url (str): Image url used to pull
+		seconds (float): Duration of the stage
+		size (int): Image size in bytes (0 if unknown)
+		'''
+		getattr(self, '%s_time'%(stage))[url] = seconds
+		if size: self.image_size[url] = size
+		self.transfer_rate = {}
+	def _expectedTime(self, url, stage):
+		'''
+		Estimates how long an image will take to process. Recorded durations
+		are used when available. Otherwise the image size is converted to
+		seconds using the transfer rate observed on previous runs. Images
+		that were never pulled use the compressed size reported by the
+		registry, or the sum of their manifest layers.
+
+		# Parameters
+		url (str): Image url used to pull
+		stage (str): "pull" or "scan"
+
+		# Returns
+		float: Expected seconds (0 when nothing is known about the image)
+		'''
+		times = getattr(self, '%s_time'%(stage))
+		if url in times: return times[url]
+		size = self.image_size.get(url, 0) or self._registrySize(url) or self._layerSize(url)
+		if not size: return 0
+		return size/self._transferRate(stage)
+	def _transferRate(self, stage):
+		'''
+		Returns the transfer rate of a stage observed on previous runs. The
+		rate is cached until `_recordTime` or `_loadDurations` changes the
+		recorded durations, so prioritizing a batch only sums them once.
+
+		# Parameters
+		stage (str): "pull" or "scan"
+
+		# Returns
+		float: Bytes per second
+		'''
+		rate = self.transfer_rate.get(stage, 0)
+		if rate: return rate
+		known = [(self.image_size[u], t) for u, t in list(iterdict(getattr(self, '%s_time'%(stage)))) if self.image_size.get(u, 0)]
+		total_time = sum(t for s, t in known)
+		rate = sum(s for s, t in known)/total_time if total_time else self.default_rate
+		self.transfer_rate[stage] = rate
+		return rate
+	def _expectedPullTime(self, url):
+		return self._expectedTime(url, 'pull')
+	def _expectedScanTime(self, url):
+		return self._expectedTime(url, 'scan')
+	def _makeImageDirs(self, url_list):
+		'''
+		Creates the tool name directory for every url when images are stored as files
+
+		# Parameters
+		url_list (list): List of urls that will be pulled
+		'''
+		for url in url_list:
+			if url not in self.full_url: self.parseURL(url)
+			simg_dir = os.path.join(self.containerDir, self.name[url])
+			makedirs(simg_dir)
+	def _deleteOldImages(self):
+		'''
+		Deletes container files in `self.containerDir` that are not in `self.images`
+		'''
+		logger.info("Deleting unused containers")
+		if 'singularity' in self.system:
+			all_files = set((os.path.join(p, f) for p, ds, fs in os.walk(self.containerDir) for f in fs))
+			to_delete = all_files - set(self.images.values())
+			for fpath in to_delete:
+				if fpath.split('.')[-1] in self.ext_dict.values():
+					logger.info("Deleting old container %s"%(fpath))
+					os.remove(fpath)
+		else:
+			logger.info("RGC is unable to determine which docker containers it created. Not deleting any")
+	def pull(self, url, metadata=True):
 		'''
 		Pulls the following
 
@@ -132,6 +283,7 @@ class pull(validate, system, metadata):
 
 		# Parameters
 		url (str): Image url used to pull
+		metadata (bool): Resolve metadata before pulling. `pullAll` resolves it in a separate stage instead.
 
 		# Returns:
 		bool: Whether or not image was pulled
@@ -141,12 +293,22 @@ class pull(validate, system, metadata):
 		if url in self.invalid:
 			logger.debug("Not pulling. %s is an invalid URL"%(url))
 			return False
+		if metadata: self._resolveMetadata(url)
+		return self._pullImage(url)
+	def _resolveMetadata(self, url):
+		'''
+		Sets the metadata of a valid url, using the container url as the
+		homepage when no homepage was found
+
+		# Parameters
+		url (str): Image url used to pull
+		'''
+		if url not in self.full_url: self.parseURL(url)
+		if url in self.invalid: return
 		self._getMetadata(url)
-		ret = self._pullImage(url)
 		# Set homepage if to container url if it was not included in metadata
 		if not self.homepage[url]:
 			self.homepage[url] = self.full_url[url]
-		return ret
 	def _pullImage(self, url):
 		'''
 		Pulls an image using either docker or singularity and
@@ -174,29 +336,94 @@ class pull(validate, system, metadata):
 			raise ValueError
 		# Resolve paths and file names
 		if url not in self.name: self.parseURL(url)
-		img_dir = os.path.join(self.containerDir, self.name[url])
+		record = self.records[url]
+		img_dir = os.path.join(self.containerDir, record.name)
 		abs_img_dir = os.path.abspath(img_dir)
-		simg = '%s-%s.%s'%(self.name[url], self.tag[url], self.ext_dict[self.system])
+		simg = '%s-%s.%s'%(record.name, record.tag, self.ext_dict[self.system])
 		img_out = os.path.join(img_dir, simg)
-		img_set = (os.path.join(img_dir, '%s-%s.%s'%(self.name[url], self.tag[url], ext)) for ext in self.ext_dict.values())
+		img_set = (os.path.join(img_dir, '%s-%s.%s'%(record.name, record.tag, ext)) for ext in self.ext_dict.values())
 		# If working with file based containers
 		if 'singularity' in self.system:
 			# Check for image
 			self.images[url] = self._checkForImage(url, img_set)
-			if self.images[url]: return
+			if self.images[url]:
+				# Tags pulled before digests were recorded can still be linked by later tags
+				digest = self._imageDigest(url, resolve=False)
+				if digest: self.digest_images.setdefault(digest, self.images[url])
+				return
 			# Make image destination path
-			if not os.path.exists(img_dir): os.makedirs(img_dir)
+			makedirs(img_dir)
 		# Pull the container
+		start = time()
 		if self.system == 'docker':
 			self.images[url] = self._pullDocker(url, img_dir, simg)
 		elif 'singularity' in self.system:
-			self.images[url] = self._pullSingularity(url, img_dir, simg)
+			digest = self._imageDigest(url)
+			if digest:
+				# Tags that share a manifest are pulled once and linked
+				source = self.digest_flight.do(('pull', digest), self._pullDigest, url, img_dir, simg, digest)
+				# The tag that pulled was already marked invalid by _pullSingularity
+				if not source and url not in self.invalid: self._pullError(url)
+				self.images[url] = self._linkImage(source, img_out) if source and source != img_out else source
+				if self.images[url] and source != img_out:
+					logger.info("Linked %s to %s, which has the same digest"%(url, source))
+					return True
+			else:
+				self.images[url] = self._pullSingularity(url, img_dir, simg)
 		else:
 			logger.error("Unhandled system")
 			raise ValueError
 		if self.images[url]:
 			logger.debug("Pulled %s"%(url))
+			size = os.path.getsize(self.images[url]) if 'singularity' in self.system else 0
+			self._recordTime('pull', url, time()-start, size)
 		return bool(self.images[url])
+	def _pullDigest(self, url, img_dir, simg, digest):
+		'''
+		Pulls url unless an image with the same digest was already pulled
+
+		# Returns
+		str: Path to the image of the digest, or False if the pull failed
+		'''
+		if digest in self.digest_images and os.path.exists(self.digest_images[digest]):
+			return self.digest_images[digest]
+		path = self._pullSingularity(url, img_dir, simg)
+		if path:
+			# The file may have held another digest of a moving tag
+			for old, old_path in list(iterdict(self.digest_images)):
+				if old_path == path: self.digest_images.pop(old, None)
+			self.digest_images[digest] = path
+			self._touchLayers(digest)
+		return path
+	def _linkImage(self, source, img_out):
+		'''
+		Hardlinks an image file to a new path, falling back to a copy when
+		the paths are on different filesystems. Both keep the image when
+		the source tag is deleted, unlike a symbolic link.
+
+		# Parameters
+		source (str): Existing image file
+		img_out (str): Path of the new image
+
+		# Returns
+		str: img_out
+		'''
+		img_dir = os.path.dirname(img_out)
+		makedirs(img_dir)
+		try:
+			os.link(source, img_out)
+		except OSError:
+			# Copy next to img_out first so a partial copy is never used
+			fd, tmp_out = mkstemp(dir=img_dir, suffix='.tmp')
+			os.close(fd)
+			try:
+				copyfile(source, tmp_out)
+				copymode(source, tmp_out)
+				os.rename(tmp_out, img_out)
+			except:
+				delete(tmp_out)
+				raise
+		return img_out
 	def _pullDocker(self, url, img_dir, simg):
 		'''
 		Uses docker to pull an image
@@ -212,30 +439,28 @@ class pull(validate, system, metadata):
 		# Returns
 		val: False if image could not be pulled or image destination if successful
 		'''
-		if self.reached_pull_limit and self.registry[url] == 'dockerhub':
-			logger.debug("Pull limit already exceeded - skipping %s"%(url))
-			self._pullError(url)
-			return False
 		tmp_log = mkstemp()[1]
 		img_out = os.path.join(img_dir, simg)
 		try:
-			sp.check_call('docker pull %s &> %s'%(self.docker_url[url], tmp_log), shell=True)
+			with self._limiter('%s/pull'%(self.registry[url]), slow=0).slot() as slot:
+				ret = call('docker pull %s &> %s'%(self.docker_url[url], tmp_log), timeout=self.pull_timeout)
+				if self._rateLimited(self._readLog(tmp_log)): slot.congested()
+			if ret: raise sp.CalledProcessError(ret, 'docker pull')
 			delete(tmp_log)
 			return url
 		except:
 			self._pullError(url, tmp_log)
 			delete(tmp_log)
 			return False
-	def _pullSingularity(self, url, img_dir, simg, cache_dir=False, clean=True, keep_img=True):
+	def _pullSingularity(self, url, img_dir, simg, keep_img=True):
 		'''
-		Uses singularity to pull an image
+		Uses singularity to pull an image. Every pull shares the layer cache
+		in `self.cache_dir`, so base layers are only downloaded once.
 
 		# Parameters
 		url (str): Image url used to pull
 		img_dir (str): Final directory for image file
 		simg (str): Name of imae file
-		cache_dir (bool): Directory of singularity cache (temp dir if not specified)
-		clean (bool): Delete cache directory after pulling
 		keep_img (bool): Delete image file after pulling
 
 		# Attributes
@@ -244,94 +469,238 @@ class pull(validate, system, metadata):
 		# Returns
 		val: False if image could not be pulled or image destination if successful
 		'''
-		if self.reached_pull_limit and self.registry[url] == 'dockerhub':
-			logger.debug("Pull limit already exceeded - skipping %s"%(url))
-			self._pullError(url)
-			return False
-		tmp_dir = mkdtemp() if not cache_dir else cache_dir
-		tmp_log = mkstemp()[1]
 		img_out = os.path.join(img_dir, simg)
-		logger.debug("Created temporary directory: %s"%(tmp_dir))
-		if self.layer_cache:
-			self._extractSingularityCache(tmp_dir)
-			assert os.path.exists(os.path.join(tmp_dir,'cache'))
+		if self.native_pull and self.system == 'singularity3' and self.registry[url] in self.registry_api \
+				and (self.registry_mirror or not self.offline):
+			try:
+				self._pullNative(url, img_out)
+				if not keep_img: delete(img_out)
+				return img_out
+			except Exception as e:
+				logger.warning("Unable to pull %s from the registry (%s). Pulling with singularity instead"%(url, str(e)))
+		tmp_log = mkstemp()[1]
+		# Singularity2 names the image itself, so it is pulled into a private folder
+		pull_dir = mkdtemp() if self.system == 'singularity2' else ''
+		env = 'SINGULARITY_CACHEDIR=%s'%(self._layerCacheDir())
+		if pull_dir: env += ' SINGULARITY_PULLFOLDER=%s'%(pull_dir)
 		try:
 			# assert statments break the try section
 			tmp_img_out = img_out+' ' if self.system == 'singularity3' else ''
-			cmd = 'SINGULARITY_CACHEDIR=%s singularity pull -F %s%s &> %s'%(tmp_dir, tmp_img_out, self.singularity_url[url], tmp_log)
-			if retry_call(cmd, url): logger.debug("Finished pulling %s"%(url))
-			if self.system == 'singularity2':
-				tmp_path = os.path.join(tmp_dir, simg)
+			cmd = '%s singularity pull -F %s%s &> %s'%(env, tmp_img_out, self.singularity_url[url], tmp_log)
+			with file_lock(self._layerCacheLock(), shared=True):
+				with self._limiter('%s/pull'%(self.registry[url]), slow=0).slot() as slot:
+					if retry_call(cmd, url, timeout=self.pull_timeout): logger.debug("Finished pulling %s"%(url))
+					if self._rateLimited(self._readLog(tmp_log)): slot.congested()
+			if pull_dir:
+				tmp_path = os.path.join(pull_dir, simg)
 				assert(os.path.exists(tmp_path))
 				move(tmp_path, img_out)
 			assert(os.path.exists(img_out))
 		except:
-			self._pullError(url)
-			self._pullWarn(tmp_log)
-			delete(tmp_dir, tmp_log)
+			self._pullError(url, tmp_log)
+			delete(tmp_log, *([pull_dir] if pull_dir else []))
 			return False
-		if clean: delete(tmp_dir)
+		if pull_dir: delete(pull_dir)
 		if not keep_img: delete(img_out)
 		delete(tmp_log)
 		return img_out
-	def _extractSingularityCache(self, extract_to):
+	def _pullNative(self, url, img_out):
 		'''
-		Extracts the singularity cache to a directory.
+		Downloads the image of url from the registry into the blob store of
+		the shared layer cache (see `_downloadImage`), and builds img_out
+		from an OCI layout of those blobs with `singularity build`
 
 		# Parameters
-		extract_to (str): Directory cache is extracted to
+		url (str): Image url used to pull
+		img_out (str): Path of the image file
+
+		# Raises
+		CalledProcessError: If singularity cannot build the image
 		'''
-		if self.layer_cache and os.path.exists(self.layer_cache):
-			assert os.path.exists(extract_to)
-			logger.debug("Extracting %s to %s"%(self.layer_cache, extract_to))
-			with tarfile.open(self.layer_cache,'r') as TF:
-				TF.extractall(extract_to)
-		else:
-			logger.warning("No layer cache detected")
-	def _makeSingularityCache(self):
+		cache_folder = self._layerCacheDir()
+		oci_dir = os.path.join(cache_folder, 'cache', 'blob')
+		blob_dir = os.path.join(oci_dir, 'blobs')
+		layout_root = os.path.join(cache_folder, 'layouts')
+		for d in (blob_dir, layout_root): makedirs(d)
+		tmp_log = mkstemp()[1]
+		with file_lock(self._layerCacheLock(), shared=True):
+			digest, media_type, body = self._downloadImage(url, blob_dir)
+			# Each image gets its own layout, so no index.json is shared between pulls
+			layout = mkdtemp(dir=layout_root)
+			try:
+				with open(os.path.join(layout, 'oci-layout'), 'w') as OF:
+					OF.write('{"imageLayoutVersion": "1.0.0"}')
+				index = {'schemaVersion':2, 'manifests':[{'mediaType':media_type, 'digest':digest, 'size':len(body), \
+					'annotations':{'org.opencontainers.image.ref.name':self.tag[url]}}]}
+				with open(os.path.join(layout, 'index.json'), 'w') as OF:
+					json.dump(index, OF)
+				os.symlink(os.path.abspath(blob_dir), os.path.join(layout, 'blobs'))
+				cmd = 'SINGULARITY_CACHEDIR=%s singularity build -F %s oci:%s:%s &> %s'%(cache_folder, img_out, layout, self.tag[url], tmp_log)
+				ret = call(cmd, timeout=self.pull_timeout)
+				if ret or not os.path.exists(img_out):
+					logger.debug(self._readLog(tmp_log))
+					raise sp.CalledProcessError(ret, 'singularity build')
+			finally:
+				delete(layout, tmp_log)
+		self._touchLayers(self.digest.get(url, ''))
+		logger.debug("Built %s from %s"%(img_out, digest))
+	def _layerCacheDir(self):
+		'''
+		Returns the SINGULARITY_CACHEDIR shared by all pulls, creating it if needed
+		'''
+		cache_folder = os.path.join(self.cache_dir, 'scache')
+		makedirs(cache_folder)
+		return cache_folder
+	def _layerCacheLock(self):
+		'''
+		Returns the lock file of the shared layer cache. Pulls hold it shared,
+		while building or pruning the cache holds it exclusively.
+		'''
+		return os.path.join(self.cache_dir, 'scache.lock')
+	def _importSingularityCache(self, cache_file, cache_folder):
+		'''
+		Extracts a layer cache tarball from older versions of rgc into the
+		shared cache directory once, and then removes it.
+
+		# Parameters
+		cache_file (str): Path to the layer cache tarball
+		cache_folder (str): Shared cache directory
+
+		# Returns
+		bool: Whether the tarball was imported
+		'''
+		logger.info("Importing layer cache %s into %s"%(cache_file, cache_folder))
+		try:
+			with tarfile.open(cache_file,'r') as TF:
+				TF.extractall(cache_folder)
+		except (tarfile.TarError, IOError, OSError) as e:
+			logger.warning("Unable to import %s: %s"%(cache_file, str(e)))
+			return False
+		delete(cache_file)
+		return True
+	def _touchLayers(self, digest):
+		'''
+		Records that the layers of a manifest digest were just used
+
+		# Parameters
+		digest (str): Manifest digest
 		'''
-		Pulls and builds the layer cache for singularity images
+		now = time()
+		for layer, size in self.image_layers.get(digest, ()):
+			self.layer_used[layer] = now
+	def _pruneSingularityCache(self):
+		'''
+		Deletes the image copies singularity keeps in the shared cache, and
+		evicts the least recently used layers once the layers take more than
+		`self.layer_cache_size` bytes. Layers are tracked individually by
+		digest in scache/layers.pkl, which is merged with the layers used by
+		this run. Layers that were never tracked use their modification time.
+		Unfinished layer downloads that were not resumed for
+		`self.partial_age` seconds are deleted with their lock files.
+		Waits until no pull is using the cache.
 
 		# Attributes
-		self.cache_dir (str): Path to the cache directory
-		self.layer_cache (str): Path to the layer cache tarball
+		self.layer_used (dict): {layer digest: timestamp,} of layers used by this run
+		'''
+		cache_folder = self._layerCacheDir()
+		index_file = os.path.join(cache_folder, 'layers.pkl')
+		blob_dir = os.path.join(cache_folder, 'cache', 'blob', 'blobs')
+		with file_lock(self._layerCacheLock()):
+			oci_tmp = glob(os.path.join(cache_folder,'cache/oci-tmp/*'))
+			if oci_tmp: delete(*oci_tmp)
+			try:
+				with open(index_file, 'rb') as IF:
+					last_used = pickle.load(IF)
+			except (IOError, OSError, EOFError, pickle.UnpicklingError):
+				last_used = {}
+			for layer, used in iterdict(self.layer_used):
+				last_used[layer] = max(used, last_used.get(layer, 0))
+			# (last used, layer digest, path, bytes) of every cached blob
+			blobs = []
+			for blob_path in glob(os.path.join(blob_dir, '*', '*')):
+				if blob_path.endswith('.tmp'): continue
+				algorithm, hex_digest = blob_path.split(os.sep)[-2:]
+				layer = '%s:%s'%(algorithm, hex_digest)
+				blobs.append((last_used.get(layer, os.path.getmtime(blob_path)), layer, blob_path, os.path.getsize(blob_path)))
+			blobs.sort()
+			# Partial files of downloads that are still resumed are written to, so only abandoned ones are old
+			partial_dir = os.path.join(os.path.dirname(blob_dir), 'partial')
+			cutoff = time()-self.partial_age
+			stale = [p for p in glob(os.path.join(partial_dir, '*')) if os.path.getmtime(p) < cutoff \
+				and not (p.endswith('.lock') and os.path.exists(p[:-5]) and os.path.getmtime(p[:-5]) >= cutoff)]
+			if stale:
+				delete(*stale)
+				logger.info("Evicted %i abandoned partial layers from the layer cache"%(len([p for p in stale if not p.endswith('.lock')])))
+			total = sum(b[3] for b in blobs)
+			evicted = 0
+			for used, layer, blob_path, size in blobs:
+				if total <= self.layer_cache_size: break
+				delete(blob_path)
+				total -= size
+				evicted += 1
+			if evicted: logger.info("Evicted %i least recently used layers from the layer cache"%(evicted))
+			cached = set(b[1] for b in blobs[evicted:])
+			last_used = dict((layer, used) for layer, used in iterdict(last_used) if layer in cached)
+			with open(index_file, 'wb') as OF:
+				pickle.dump(last_used, OF)
+	def _makeSingularityCache(self, url_list=()):
+		'''
+		Prepares the shared layer cache for singularity images, and downloads
+		the layers shared most by the images in url_list into it. Layers that
+		are already cached are not downloaded again.
 
-		# Raises
-		Exception: If the layer cache cannot be built
+		# Parameters
+		url_list (list): Image urls that are about to be pulled
+
+		# Attributes
+		self.cache_dir (str): Path to the cache directory
+		self.layer_cache (str): Path to the shared layer cache directory
 		'''
-		# Cache names
-		cache_folder = os.path.join(self.cache_dir, 'scache')
+		cache_folder = self._layerCacheDir()
 		cache_file = os.path.join(self.cache_dir, 'scache.tar')
-		# Skip re-creating file if not being forced
-		if not self.force_cache:
-			if self.layer_cache and os.path.exists(self.layer_cache):
+		blob_folder = os.path.join(cache_folder, 'cache')
+		# Forcing the cache only refreshes metadata. Layers are evicted by `_pruneSingularityCache`
+		with file_lock(self._layerCacheLock()):
+			if self.layer_cache == cache_folder and os.path.exists(blob_folder):
 				logger.info("Using existing layer cache %s"%(self.layer_cache))
-				return
-			if not self.layer_cache and os.path.exists(cache_file):
-				logger.info("Using found layer cache %s"%(cache_file))
-				self.layer_cache = cache_file
-				return
-		# Create the cache directory
-		if not os.path.exists(cache_folder):
-			logger.debug("Making temporary cache folder: %s"%(cache_folder))
-			os.makedirs(cache_folder)
-		logger.warning("Creating the base layer cache. This may take a while")
-		# Pull the images in parallel
-		tq = ThreadQueue(target=self._pullSingularity, n_threads=self.n_threads)
-		arg_list = []
-		for url in self.cache_docker_images:
-			self.parseURL(url)
-			dir, fname = os.path.split(mkstemp()[1])
-			arg_list.append((url, dir, fname, cache_folder, False, False))
-		tq.process_list(arg_list)
-		tq.join()
-		# Delete OCI files
-		delete(*glob(os.path.join(cache_folder,'cache/oci-tmp/*')))
-		logger.debug("Creating TAR file %s"%(cache_file))
-		with tarfile.open(cache_file,'w') as TF:
-			TF.add(os.path.join(cache_folder,'cache'), arcname='cache')
-		delete(cache_folder)
-		self.layer_cache = cache_file
+			else:
+				if os.path.exists(cache_file) and not os.path.exists(blob_folder):
+					self._importSingularityCache(cache_file, cache_folder)
+				if os.path.exists(blob_folder):
+					logger.info("Using found layer cache %s"%(cache_folder))
+				else:
+					logger.info("Creating the base layer cache in %s"%(cache_folder))
+		self.layer_cache = cache_folder
+		if url_list: self._warmLayerCache(url_list)
+	def _warmLayerCache(self, url_list):
+		'''
+		Downloads the `self.shared_layers` layers that are shared most by
+		the images in url_list into the blob store of the layer cache, where
+		singularity finds them instead of downloading them for every image
+
+		# Parameters
+		url_list (list): Image urls that are about to be pulled
+		'''
+		shared = self._sharedLayers(url_list, self.shared_layers)
+		if not shared: return
+		oci_dir = os.path.join(self.layer_cache, 'cache', 'blob')
+		blob_dir = os.path.join(oci_dir, 'blobs')
+		makedirs(blob_dir)
+		layout_file = os.path.join(oci_dir, 'oci-layout')
+		if not os.path.exists(layout_file):
+			with open(layout_file, 'w') as OF:
+				OF.write('{"imageLayoutVersion": "1.0.0"}')
+		logger.info("Caching %i shared layers"%(len(shared)))
+		with file_lock(self._layerCacheLock(), shared=True):
+			tq = ThreadQueue(target=self._fetchBlob, n_threads=self.n_threads, progress=False)
+			results = tq.process_list([(url, digest, blob_dir) for digest, url in shared])
+			tq.join()
+		now = time()
+		for record in results:
+			if record.ok:
+				self.layer_used[record.args[1]] = now
+			else:
+				logger.warning("Unable to cache layer %s: %s"%(record.args[1], str(record.exception)))
 	def _pullError(self, url, log_txt=""):
 		'''
 		If an image URL can't be pulled, the image is marked as invalid.
@@ -346,22 +715,43 @@ class pull(validate, system, metadata):
 		self.invalid (set): Set of invalid URLs
 		'''
 		logger.error("Could not pull %s"%(url))
-		if log_txt: self._pullWarn(log_txt)
-		self.invalid.add(url)
-		self.valid.remove(url)
+		log_text = self._readLog(log_txt) if log_txt else ''
+		if log_text: self._pullWarn(log_text)
+		# Rate-limited pulls are retried on the next run
+		self._markInvalid(url, 'rate limited' if self._rateLimited(log_text) else 'pull failed')
+	def _readLog(self, log_file):
+		'''
+		Returns the text of a temporary pull log ("" if it cannot be read)
+
+		# Parameters
+		log_file (str): Path to temporary log file
+		'''
+		try:
+			with open(log_file) as LF: return LF.read()
+		except (IOError, OSError):
+			return ""
+	def _rateLimited(self, log_txt):
+		'''
+		Returns True if the text of a pull log reports a registry rate limit
+
+		# Parameters
+		log_txt (str): Text of the pull log
+		'''
+		return "reached your pull rate limit" in log_txt or "429 Too Many Requests" in log_txt
 	def _pullWarn(self, log_txt):
 		'''
 		Issues a warning if the Docker Hub pull limit has been exceeded.
+		Pulls are not skipped afterwards - the registry limiter backs off instead.
 
 		# Parameters
-		log_txt (str): Path to temprorary log file (optional)
+		log_txt (str): Text of the pull log
 
 		# Attributes
 		self.reached_pull_limit (bool): Variable to ensure the warning is only issued once
 		'''
 		# Only warn once
 		if self.reached_pull_limit: return
-		if "reached your pull rate limit" in log_txt:
+		if self._rateLimited(log_txt):
 			logger.warning('''You have reached your pull limit on Docker Hub. You can try the following to increase it:
 
 			1. Autenticate
@@ -36,11 +36,12 @@
 import sys, os, logging, json, re
 import subprocess as sp
 from collections import Counter
+from time import time
 logger = logging.getLogger(__name__)
 
 from rgc.ContainerSystem.pull import pull
-from rgc.helpers import translate, iterdict, retry_call, delete
-from rgc.ThreadQueue import ThreadQueue
+from rgc.helpers import translate, iterdict, retry_call, delete, call, check_output
+from rgc.ThreadQueue import ThreadQueue, log_slowest
 
 class scan(pull):
 	'''
@@ -51,7 +52,10 @@ class scan(pull):
 	self.keywords (dict)= {url: keyword list}
 	self.description (dict)= {url: description}
 	self.homepage (dict)= {url: homepage url}
+	scan_timeout (float): Seconds before a command run in a container is killed (0 disables)
+	self.digest_programs (dict)= {digest: program list} of images scanned in this run
 	'''
+	scan_timeout = 600
 	# Create cmd templates, which are used with template%(self.images[url], cmd)
 	docker_cmd_template = "docker run --rm -t %s %s"
 	singularity_cmd_template = "singularity exec %s %s"
@@ -71,6 +75,7 @@ class scan(pull):
 	def __init__(self):
 		super(scan, self).__init__()
 		self.programs = {}
+		self.digest_programs = {}
 		self.program_count = Counter()
 		self.force_cache = False
 		self.n_threads = 4
@@ -83,19 +88,29 @@ class scan(pull):
 		cache_file = 'programs.pkl'
 		if not self.force_cache:
 			self.programs, self.program_count = self._cache_load(cache_file, (dict(), Counter()))
+		self._loadDurations()
 		to_check = self.valid | set(url_list)
 		if self.force_cache:
 			logger.debug("Ignoring cache and re-scanning all containers")
 		else:
 			to_check -= set(self.programs.keys())
 		# Process using ThreadQueue
-		tq = ThreadQueue(target=self.scanPrograms, n_threads=self.n_threads)
+		tq = ThreadQueue(target=self.scanPrograms, n_threads=self.n_threads, priority=self._expectedScanTime)
 		if to_check:
 			logger.info("Scanning for programs in all %i containers using %i threads"%(len(self.valid), self.n_threads))
-			tq.process_list(to_check)
+			results = tq.process_list(to_check)
+			# Images that could not be scanned are marked invalid
+			for record in results:
+				if not record.ok:
+					logger.error("Failed to scan %s. Marking as invalid."%(record.args))
+					self._markInvalid(record.args, 'scan failed')
+			log_slowest(results)
 		tq.join()
 		# Write to cache
 		self._cache_save(cache_file, (self.programs, self.program_count))
+		self._saveDurations()
+		# Keep images that failed to scan invalid on the next run
+		self._saveValid()
 	def scanPrograms(self, url, force=False):
 		'''
 		Crawls all directories on a container's PATH and caches a list of all executable files in
@@ -122,38 +137,66 @@ class scan(pull):
 		if not force and not self.force_cache and url in self.programs:
 			logger.debug("Programs are already cached for %s"%(url))
 			return True
+		start = time()
+		digest = self._imageDigest(url, resolve=False) if 'singularity' in self.system else ''
+		if digest:
+			# Tags that share a manifest are only scanned once
+			progList = self.digest_flight.do(('scan', digest), self._scanDigest, url, digest)
+		else:
+			progList = self._listPrograms(url)
+		if progList is None: return False
+		if not progList:
+			logger.error("No programs detected in %s. Marking as invalid."%(url))
+			self._markInvalid(url, 'no programs')
+			return False
+		self.program_count += Counter(progList)
+		self.programs[url] = set(progList)
+		self._recordTime('scan', url, time()-start)
+		logger.debug("%s - %i unique programs found"%(url, len(set(progList))))
+		return True
+	def _listPrograms(self, url):
+		'''
+		Lists the programs on the PATH of an image
+
+		# Parameters
+		url (str): Image url used to pull
+
+		# Returns
+		list: Program names, or None if no shell was detected
+		'''
 		# Detect container shell
 		shell = self._detect_shell(url)
-		if not shell: return False
+		if not shell: return None
 		# Scan
 		logger.debug("Caching all programs in %s"%(url))
 		# Create find string
 		cmd = self.find_cmd[shell]%(self.find_string[shell])
 		progList = self._ccheck_output(url, cmd)
-		progList = list(filter(lambda x: len(x) > 0 and x[0] != '_' and self.prx.fullmatch(x), progList))
-		if not progList:
-			self.logger.error("No programs detected in %s. Marking as invalid."%(url))
-			self.invalid.add(url)
-			self.valid.remove(url)
-			return False
-		self.program_count += Counter(progList)
-		self.programs[url] = set(progList)
-		logger.debug("%s - %i unique programs found"%(url, len(set(progList))))
-		return True
+		return list(filter(lambda x: len(x) > 0 and x[0] != '_' and self.prx.fullmatch(x), progList))
+	def _scanDigest(self, url, digest):
+		'''
+		Lists the programs of url unless an image with the same digest was already scanned
+
+		# Returns
+		list: Program names, or None if no shell was detected
+		'''
+		if digest not in self.digest_programs:
+			self.digest_programs[digest] = self._listPrograms(url)
+		return self.digest_programs[digest]
 	def _ccall(self, url, cmd):
 		if self.system not in self.cmd_templates:
 			logger.error("%s system is unhandled"%(self.system))
 			sys.exit(500)
 		to_run = self.cmd_templates[self.system]%(self.images[url], cmd)
 		logger.debug("Running: %s"%(to_run))
-		return sp.call(to_run, shell=True)
+		return call(to_run, timeout=self.scan_timeout)
 	def _ccheck_output(self, url, cmd):
 		if self.system not in self.cmd_templates:
 			logger.error("%s system is unhandled"%(self.system))
 			sys.exit(500)
 		to_run = self.cmd_templates[self.system]%(self.images[url], cmd)
 		logger.debug("Running: %s"%(to_run))
-		output = sp.check_output(to_run, shell=True)
+		output = check_output(to_run, timeout=self.scan_timeout)
 		return list(filter(lambda x: x, re.split(r'\r?\n', translate(output))))
 	def _detect_shell(self, url):
 		for shell in self.supported_shells:
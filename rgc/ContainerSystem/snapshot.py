@@ -0,0 +1,94 @@
+###############################################################################
+# Author: Greg Zynda
+# Last Modified: 01/15/2021
+###############################################################################
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Texas Advanced Computing Center - UT Austin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+import sys, os, logging
+logger = logging.getLogger(__name__)
+
+try:
+	import cPickle as pickle
+	pyv = 2
+except:
+	import pickle
+	pyv = 3
+
+from rgc.ContainerSystem.validate import validate
+from rgc.ContainerSystem.metadata import metadata
+
+class snapshot(validate, metadata):
+	'''
+	Class for exporting and loading registry snapshots, which let rgc
+	validate URLs and write metadata without network access
+	'''
+	def exportSnapshot(self, snapshot_file):
+		'''
+		Writes the tag index, bio.tools index, and tool metadata gathered
+		by this run to a snapshot file
+
+		# Parameters
+		snapshot_file (str): Path of the snapshot file
+		'''
+		snap = {'tag_index':self.tag_index, 'biotools_index':self.biotools_index, \
+			'tool_metadata':self.tool_metadata}
+		with open(snapshot_file, 'wb') as OF:
+			pickle.dump(snap, OF)
+		logger.info("Exported %i repositories and %i tools to %s"%(len(self.tag_index), len(self.tool_metadata), snapshot_file))
+	def loadSnapshot(self, snapshot_file, mirror=''):
+		'''
+		Switches to offline mode. Tags, library checks, and metadata are
+		answered from a snapshot file written by `exportSnapshot`. Tags
+		that are not in the snapshot are checked against a local OCI
+		distribution mirror when one is given.
+
+		# Parameters
+		snapshot_file (str): Path of the snapshot file
+		mirror (str): Base URL of a local registry mirror (optional)
+
+		# Attributes
+		self.offline (bool): Set to True
+		self.registry_mirror (str): Set to mirror
+		'''
+		with open(snapshot_file, 'rb') as IF:
+			snap = pickle.load(IF)
+		self.offline = True
+		self.registry_mirror = mirror
+		self.tag_index = snap['tag_index']
+		self.biotools_index = snap['biotools_index']
+		self.tool_metadata = snap['tool_metadata']
+		logger.info("Working offline from %s with %i repositories and %i tools"%(snapshot_file, len(self.tag_index), len(self.tool_metadata)))
+	def _loadTagIndex(self):
+		'''
+		Keeps the snapshot tag index in offline mode instead of reading tags.pkl
+		'''
+		if not self.offline: super(snapshot, self)._loadTagIndex()
@@ -45,7 +45,75 @@ except:
 	import urllib.request as urllib2
 	pyv = 3
 
+try:
+	from sys import intern
+except ImportError:
+	pass
+from threading import Lock
 from rgc.helpers import translate, iterdict
+from rgc.ThreadQueue import AIMDLimiter, Singleflight
+from rgc.HTTPPool import HTTPPool
+
+class ImageRecord:
+	'''
+	Parsed fields of a single image URL. Unset fields are missing
+	attributes, so a URL only costs the fields that were parsed.
+	'''
+	__slots__ = ('sanitized_url', 'docker_url', 'singularity_url', 'org', 'name', 'tag', 'registry', 'full_url')
+
+# Sentinel for fields that were never set, since False and None are valid values
+_missing = object()
+
+class FieldView:
+	'''
+	Dictionary-like view of one ImageRecord field across all URLs, so
+	`self.name[url]` reads and writes `self.records[url].name`. String
+	values are interned, since orgs, names, and registries repeat across
+	thousands of tags. Every access costs an extra call and attribute
+	lookup, so code that reads several fields of a URL should fetch
+	`self.records[url]` once instead.
+	'''
+	__slots__ = ('records', 'field')
+	def __init__(self, records, field):
+		self.records = records
+		self.field = field
+	def __getitem__(self, url):
+		try:
+			return getattr(self.records[url], self.field)
+		except AttributeError:
+			raise KeyError(url)
+	def __setitem__(self, url, value):
+		record = self.records.get(url, None)
+		if record is None: record = self.records.setdefault(url, ImageRecord())
+		if type(value) is str: value = intern(value)
+		setattr(record, self.field, value)
+	def __delitem__(self, url):
+		try:
+			delattr(self.records[url], self.field)
+		except AttributeError:
+			raise KeyError(url)
+	def __contains__(self, url):
+		return hasattr(self.records.get(url, None), self.field)
+	def _items(self):
+		# Snapshot the records, since worker threads may add URLs while iterating
+		field, missing = self.field, _missing
+		for url, record in list(iterdict(self.records)):
+			value = getattr(record, field, missing)
+			if value is not missing: yield url, value
+	def __iter__(self):
+		return (url for url, value in self._items())
+	def __len__(self):
+		return sum(1 for item in self._items())
+	def get(self, url, default=None):
+		return getattr(self.records.get(url, None), self.field, default)
+	def keys(self):
+		return [url for url, value in self._items()]
+	def values(self):
+		return [value for url, value in self._items()]
+	def items(self):
+		return list(self._items())
+	def __repr__(self):
+		return repr(dict(self._items()))
 
 class url_parser:
 	'''
@@ -54,7 +122,17 @@ class url_parser:
 	# Attributes
 	known_registries (dict): Static dictionary of known registries {name:identifier,}
 	full_url_templates (dict): Static dictionary of full_url templates {name:template,}
+	limiter_slow (float): Requests slower than this many seconds reduce the concurrency of their host
+	limiter_lock (Lock): Guards the creation of limiters
+	http (HTTPPool): Keep-alive connection pool shared by all registry and metadata queries
+	json_flight (Singleflight): Coalesces concurrent requests for the same JSON document
+	offline (bool): Answer queries only from local data. Every request fails as not found.
 	'''
+	offline = False
+	limiter_slow = 15
+	limiter_lock = Lock()
+	http = HTTPPool()
+	json_flight = Singleflight()
 	known_registries = {'dockerhub':'dockerhub','quay':'quay',\
 		'github':'github','ghcr':'ghcr','shub':'shub'}
 	full_url_templates = {'dockerhub':'https://hub.docker.com/r/%s/%s',\
@@ -67,22 +145,22 @@ class url_parser:
 		Sets the following attributes at initialization.
 
 		# Attributes
-		self.sanitized_url (dict): Dictionary of {url:"sanitized url",} pairs
-		self.org (dict): Dictionary of url:"image org" pairs
-		self.name (dict): Dictionary of url:"image name" pairs
-		self.tag (dict): Dictionary of url:"image tag" pairs
-		self.registry (dict): The url:registry keypair is added
-		self.full_url (dict): Dictionary of full-length URLs for requested image URL
+		self.records (dict): Dictionary of {url:ImageRecord,} holding the parsed fields of each URL
+		self.sanitized_url (FieldView): Dictionary of {url:"sanitized url",} pairs
+		self.org (FieldView): Dictionary of url:"image org" pairs
+		self.name (FieldView): Dictionary of url:"image name" pairs
+		self.tag (FieldView): Dictionary of url:"image tag" pairs
+		self.registry (FieldView): The url:registry keypair is added
+		self.full_url (FieldView): Dictionary of full-length URLs for requested image URL
+		self.limiters (dict): Dictionary of {host:AIMDLimiter,} used to throttle requests
+		self.missing_urls (set): URLs that responded with 404 this run
 		'''
 		super(url_parser, self).__init__()
-		self.sanitized_url = {}
-		self.docker_url = {}
-		self.singularity_url = {}
-		self.org = {}
-		self.name = {}
-		self.tag = {}
-		self.registry = {}
-		self.full_url = {}
+		self.limiters = {}
+		self.missing_urls = set()
+		self.records = {}
+		for field in ImageRecord.__slots__:
+			setattr(self, field, FieldView(self.records, field))
 	def parseURL(self, url):
 		'''
 		Sanitizes and identifies the image name, tag, and registry of a given URL
@@ -193,6 +271,68 @@ class url_parser:
 				self.registry[url] = v
 				break
 		logger.debug("URL %s associated with %s registry"%(url, self.registry[url]))
+	def _limiter(self, host, slow=None):
+		'''
+		Returns the adaptive concurrency limiter for a registry or host,
+		creating it on first use with `self.n_threads` as its maximum.
+		`slow` only applies when the limiter is created, so work with a
+		different notion of slow, like pulls, uses its own key (e.g.
+		"dockerhub/pull").
+
+		# Parameters
+		host (str): Registry name, host, or key of a limiter
+		slow (float): Seconds before a request counts as congested [self.limiter_slow]
+
+		# Returns
+		AIMDLimiter: limiter shared by all threads
+		'''
+		with self.limiter_lock:
+			if host not in self.limiters:
+				slow = self.limiter_slow if slow is None else slow
+				self.limiters[host] = AIMDLimiter(host, max_limit=getattr(self, 'n_threads', 4), slow=slow)
+			return self.limiters[host]
+	def _getJSON(self, url, host):
+		'''
+		Fetches and decodes a JSON document over the shared connection pool
+		while holding a slot from the limiter of `host`. Concurrent requests
+		for a URL wait for the one in flight. Responses are stored in
+		`self.cache_dir` and revalidated on later runs, and only 404s are
+		remembered so transient errors are retried.
+
+		# Parameters
+		url (str): URL of the JSON document
+		host (str): Registry name or host used to select the limiter
+
+		# Raises
+		HTTPError: If the server responds with a status >= 400
+
+		# Returns
+		dict: Decoded JSON response
+		'''
+		if self.offline:
+			raise urllib2.HTTPError(url, 404, 'Offline', {}, None)
+		if url in self.missing_urls:
+			raise urllib2.HTTPError(url, 404, 'Not Found', {}, None)
+		return self.json_flight.do(url, self._fetchJSON, url, host)
+	def _fetchJSON(self, url, host):
+		'''
+		Fetches and decodes a JSON document for `_getJSON`
+
+		# Parameters
+		url (str): URL of the JSON document
+		host (str): Registry name or host used to select the limiter
+
+		# Returns
+		dict: Decoded JSON response
+		'''
+		try:
+			with self._limiter(host).slot():
+				body = self.http.cached_get(url, {'Accept':'application/json'}, \
+					cache_dir=getattr(self, 'cache_dir', False), refresh=getattr(self, 'force_cache', False))
+		except urllib2.HTTPError as e:
+			if e.code == 404: self.missing_urls.add(url)
+			raise
+		return json.loads(translate(body))
 	def getRegistry(self, url):
 		'''
 		Sets self.registry[url] with the registry that tracks the URL.
@@ -34,6 +34,7 @@
 ###############################################################################
 
 import sys, os, logging, re, json
+from time import time
 logger = logging.getLogger(__name__)
 
 try:
@@ -45,30 +46,64 @@ except:
 	import urllib.request as urllib2
 	pyv = 3
 
-from rgc.ContainerSystem.url import url_parser
-from rgc.ContainerSystem.cache import cache
-from rgc.helpers import translate
-from rgc.ThreadQueue import ThreadQueue
+from rgc.ContainerSystem.biotools import biotools
+from rgc.helpers import translate, iterdict
+from rgc.ThreadQueue import ThreadQueue, Singleflight
 
-class validate(url_parser, cache):
+class validate(biotools):
 	'''
 	Class for validating image URLs
 
 	# Attributes
 	valid (set): Set of valid URLs
 	invalid (set): Set of invalid URLs
+	validation (dict): Validation record of each URL {url:(timestamp, reason, ttl),}
+	validation_ttl (dict): Seconds before a validation result is checked again {reason:seconds,} (None never expires). Unknown reasons use the "error" TTL
 	tag_dict (dict): Temporary cache of tags, to prevent repeated requests
+	tag_flight (Singleflight): Coalesces concurrent tag listings of the same repository
+	tag_size (dict): Compressed image size reported by the registry {(registry,org,name):{tag:bytes,},}
+	digest (dict): Manifest digest of each URL validated through the registry API {url:digest,}
+	registry_api (dict): Base URL of the OCI distribution API of each registry {registry:url,}
+	registry_mirror (str): Base URL of a local OCI distribution mirror used instead of `registry_api`
+	manifest_types (str): Accepted manifest media types
+	tag_query (dict): Tag listing API of each registry {registry:url,}
+	tag_pagers (dict): Method that walks the tag pages of each registry {registry:method name,}
+	tag_sync (dict): Newest-first page query, result key, and timestamp field of each registry {registry:(query,key,field),}
+	tag_index (dict): Persistent index of tags {(registry,org,name):{tag:(last_updated,digest,size),},}
+	page_size (int): Number of tags requested per page
+	registry_tokens (dict): Anonymous pull tokens {(registry,org/name):(token, expiration),}
 	self.registry (dict): The url:registry keypair is added
 	registry_exclude_re (re): Compiled regular expression of registry urls to exclude
 	n_threads (int): Default number of threads used for URL validation
 	'''
+	validation_ttl = {'valid':30*86400, 'unsupported registry':None, 'no tag':None, \
+		'library':30*86400, 'tag not found':7*86400, 'no programs':30*86400, \
+		'scan failed':7*86400, 'pull failed':86400, 'rate limited':3600, 'error':3600}
 	registry_exclude_re = re.compile(r'(shub://|(docker://)?(ghcr\.io|docker\.pkg\.github\.com))')
+	registry_api = {'dockerhub':'https://registry-1.docker.io', 'quay':'https://quay.io'}
+	registry_mirror = ''
+	manifest_types = ', '.join(('application/vnd.docker.distribution.manifest.list.v2+json',\
+		'application/vnd.docker.distribution.manifest.v2+json',\
+		'application/vnd.oci.image.index.v1+json',\
+		'application/vnd.oci.image.manifest.v1+json'))
+	tag_query = {'dockerhub':'https://hub.docker.com/v2/repositories/%s/%s/tags/',\
+		'quay':'https://quay.io/api/v1/repository/%s/%s/tag/'}
+	tag_pagers = {'dockerhub':'_dockerhubTags', 'quay':'_quayTags'}
+	tag_sync = {'dockerhub':('?ordering=last_updated&page_size=%i&page=%i', 'results', 'last_updated'),\
+		'quay':('?onlyActiveTags=true&limit=%i&page=%i', 'tags', 'last_modified')}
+	page_size = 100
+	challenge_re = re.compile(r'(\w+)="([^"]*)"')
 	def __init__(self):
 		super(validate, self).__init__()
 		self.valid = set()
 		self.invalid = set()
+		self.validation = {}
 		self.tag_dict = {}
-		self.registry = {}
+		self.tag_size = {}
+		self.tag_index = {}
+		self.tag_flight = Singleflight()
+		self.digest = {}
+		self.registry_tokens = {}
 		self.n_threads = 4
 	def validateURL(self, url, include_libs=False):
 		'''
@@ -96,29 +131,24 @@ class validate(url_parser, cache):
 		# Exclude registries that require authentication
 		if self.registry_exclude_re.match(url):
 			logger.debug("The registry for %s requires authentication and is not supported by rgc."%(url))
-			self.invalid.add(url)
+			self._markInvalid(url, 'unsupported registry')
 			return
 		# Sanitize docker prefix if included
 		if url not in self.sanitized_url:
 			self.parseURL(url)
-		name = self.name[url]
-		tag = self.tag[url]
+		record = self.records[url]
+		name, tag = record.name, record.tag
 		if not tag:
 			logger.warning("Excluding - No tag included in %s"%(url))
-			self.invalid.add(url)
+			self._markInvalid(url, 'no tag')
 			return
 		if not include_libs:
 			# See if it is a bio lib
-			md_url = "https://dev.bio.tools/api/tool/%s?format=json"%(name)
-			try:
-				resp_json = json.loads(translate(urllib2.urlopen(md_url).read()))
-				types = [v for v in resp_json['toolType']]
-				if types == ['Library']:
-					self.invalid.add(url)
-					logger.debug("Excluding %s, which is a library"%(url))
-					return
-			except urllib2.HTTPError:
-				pass
+			tool = self._biotoolsTool(name)
+			if tool and tool[0] == ('Library',):
+				self._markInvalid(url, 'library')
+				logger.debug("Excluding %s, which is a library"%(url))
+				return
 			## Check for pypi lib
 			#if name not in set(('ubuntu','singularity','bowtie','centos')):
 			#	try:
@@ -129,16 +159,183 @@ class validate(url_parser, cache):
 			#			return
 			#	except urllib2.HTTPError:
 			#		pass
-		if tag not in self._getTags(url):
-			logger.warning("%s not found in %s"%(tag, self._getTags(url)))
-			self.invalid.add(url)
+		try:
+			exists = self._tagExists(url)
+		except (IOError, OSError) as e:
+			# Transient failures are retried after a short TTL instead of recording the tag as missing
+			reason = 'rate limited' if getattr(e, 'code', None) == 429 else 'error'
+			logger.warning("Unable to validate %s (%s)"%(url, str(e)))
+			self._markInvalid(url, reason)
+			return
+		if not exists:
+			logger.warning("%s is not a tag of %s/%s"%(tag, record.org, name))
+			self._markInvalid(url, 'tag not found')
 			logger.warning("%s is an invalid URL"%(url))
 		else:
 			logger.debug("%s is valid"%(url))
-			self.valid.add(url)
+			self._markValid(url)
+	def _markValid(self, url):
+		'''
+		Adds url to self.valid and records when it was validated
+		'''
+		self.invalid.discard(url)
+		self.valid.add(url)
+		self.validation[url] = (time(), 'valid', self.validation_ttl['valid'])
+	def _markInvalid(self, url, reason):
+		'''
+		Adds url to self.invalid with a record of why it is invalid. The
+		reason determines when the URL will be validated again.
+
+		# Parameters
+		url (str): Image url used to pull
+		reason (str): Key of `validation_ttl`
+		'''
+		self.valid.discard(url)
+		self.invalid.add(url)
+		self.validation[url] = (time(), reason, self.validation_ttl.get(reason, self.validation_ttl['error']))
+	def _loadValid(self):
+		'''
+		Loads the valid and invalid sets with their validation records from
+		valid.pkl. URLs whose record has expired are dropped from both sets,
+		so they are validated again. Caches written before validation
+		records existed expire invalid URLs right away.
+		'''
+		cached = self._cache_load('valid.pkl', (set(), set(), dict()))
+		self.invalid, self.valid = cached[:2]
+		self.validation = cached[2] if len(cached) > 2 else {}
+		now = time()
+		for url in self.valid - set(self.validation):
+			self.validation[url] = (now, 'valid', self.validation_ttl['valid'])
+		expired = [url for url in self.invalid | self.valid if url not in self.validation or \
+			(self.validation[url][2] is not None and self.validation[url][0]+self.validation[url][2] < now)]
+		for url in expired:
+			self.invalid.discard(url)
+			self.valid.discard(url)
+			self.validation.pop(url, None)
+		if expired: logger.info("Revalidating %i URLs with expired validation records"%(len(expired)))
+	def _saveValid(self):
+		'''
+		Saves the valid and invalid sets with their validation records to valid.pkl
+		'''
+		self._cache_save('valid.pkl', (self.invalid, self.valid, self.validation))
+	def _tagExists(self, url):
+		'''
+		Checks whether the tag of url exists. Tags in the tag index or that
+		were already listed are checked locally. Otherwise the tag manifest is requested from the
+		registry API, and all tags are listed only if that request fails.
+
+		# Parameters
+		url (str): Image url used to pull
+
+		# Returns
+		bool: True if the tag exists
+		'''
+		tag_tuple = self._getUrlTuple(url)
+		tag = self.records[url].tag
+		if tag in self.tag_index.get(tag_tuple, {}): return True
+		if tag_tuple in self.tag_dict or tag_tuple[0] not in self.registry_api \
+				or (self.offline and not self.registry_mirror):
+			return tag in self._getTags(url)
+		try:
+			return self._manifestDigest(url) is not None
+		except (urllib2.HTTPError, IOError, OSError, ValueError, KeyError) as e:
+			logger.debug("Unable to check the manifest of %s (%s), listing tags instead"%(url, str(e)))
+			return tag in self._getTags(url)
+	def _manifestDigest(self, url):
+		'''
+		Sends a HEAD request for the tag manifest of url to the registry API
+		with an anonymous pull token. This is usually a single request, and
+		HEAD requests do not count against the Docker Hub pull limit.
+
+		# Parameters
+		url (str): Image url used to pull
+
+		# Attributes
+		self.digest (dict): The manifest digest of url is added
+
+		# Raises
+		HTTPError: If the registry rejects the request for any reason except a missing tag
+
+		# Returns
+		str: Manifest digest, or None if the tag does not exist
+		'''
+		try:
+			resp = self._registryRequest(url, 'manifests/%s'%(self.tag[url]), 'HEAD', {'Accept':self.manifest_types})
+		except urllib2.HTTPError as e:
+			if e.code == 404: return None
+			raise
+		digest = resp.headers.get('docker-content-digest', '')
+		self.digest[url] = digest
+		logger.debug("%s has manifest %s"%(url, digest))
+		return digest
+	def _registryRequest(self, url, path, method='GET', headers={}, write=None, start=None):
+		'''
+		Sends a request for path under the repository of url to the registry
+		API, or `self.registry_mirror`, while holding a slot from the
+		registry limiter. An anonymous pull token is fetched and the request
+		is repeated when the registry answers with a Bearer challenge.
+
+		# Parameters
+		url (str): Image url used to pull
+		path (str): Path below /v2/<org>/<name>/
+		method (str): HTTP method [GET]
+		headers (dict): Extra request headers
+		write (function): Streams the body of a GET to this function in chunks (see `HTTPPool.stream`)
+		start (function): Called with the streamed response before its first chunk
+
+		# Raises
+		HTTPError: If the registry rejects the request
+
+		# Returns
+		Response: Response of the registry
+		'''
+		registry = self.registry[url]
+		repo = '%s/%s'%(self.org[url], self.name[url])
+		req_url = '%s/v2/%s/%s'%(self.registry_mirror or self.registry_api[registry], repo, path)
+		headers = dict(headers)
+		# Blob downloads are long, so they are not counted as congestion
+		limiter = self._limiter('%s/blobs'%(registry), slow=0) if write else self._limiter(registry)
+		with limiter.slot():
+			for attempt in range(2):
+				token = self._registryToken(registry, repo)
+				if token: headers['Authorization'] = 'Bearer %s'%(token)
+				try:
+					if write: return self.http.stream(req_url, write, headers, start)
+					return self.http.request(req_url, method, headers)
+				except urllib2.HTTPError as e:
+					challenge = e.hdrs.get('www-authenticate', '')
+					if e.code != 401 or attempt or not challenge.startswith('Bearer'): raise
+					self.tag_flight.do(('token', registry, repo), self._fetchToken, registry, repo, challenge)
+	def _registryToken(self, registry, repo):
+		'''
+		Returns the cached pull token for repo, or False if there is no
+		unexpired token
+		'''
+		token, expires = self.registry_tokens.get((registry, repo), (False, 0))
+		return token if time() < expires else False
+	def _fetchToken(self, registry, repo, challenge):
+		'''
+		Requests an anonymous pull token from the realm in a Bearer challenge
+
+		# Parameters
+		registry (str): Registry name
+		repo (str): Repository as org/name
+		challenge (str): Value of the WWW-Authenticate response header
+
+		# Attributes
+		self.registry_tokens (dict): {(registry,repo):(token, expiration),}
+		'''
+		params = dict(self.challenge_re.findall(challenge))
+		query = '%s?service=%s&scope=%s'%(params['realm'], params.get('service', ''), \
+			params.get('scope', 'repository:%s:pull'%(repo)))
+		resp = json.loads(translate(self.http.get(query)))
+		token = resp.get('token', resp.get('access_token', ''))
+		# Expire tokens a little early to avoid racing the registry
+		self.registry_tokens[(registry, repo)] = (token, time()+int(resp.get('expires_in', 60))-10)
 	def _getTags(self, url, remove_latest=False):
 		'''
-		Returns all tags for the image specified with URL
+		Returns all tags for the image specified with URL. Repositories
+		already in the tag index are only synced with their newest tags.
 
 		# Parameters
 		url (str): Image url used to pull
@@ -146,34 +343,135 @@ class validate(url_parser, cache):
 
 		# Attributes
 		self.tag_dict (dict): Temporary cache of tags, to prevent repeated requests: {(registry,org,name):set,}
+		self.tag_index (dict): Tags of the repository are added or updated
 
 		# Returns
 		set: all tags associated with main image URL
 		'''
-		tag_query = {'dockerhub':('https://hub.docker.com/v2/repositories/%s/%s/tags/','results'),\
-			'quay':('https://quay.io/api/v1/repository/%s/%s/tag/','tags')} #{registry:(url,key),}
 		tag_tuple = self._getUrlTuple(url)
-		if self.registry[url] not in tag_query:
+		if self.registry[url] not in self.tag_pagers:
 			logger.error('Unable to query tags for %s'%(url))
 			self.tag_dict[tag_tuple] = set()
 		if tag_tuple not in self.tag_dict:
-			query, key = tag_query[self.registry[url]]
-			query = query%(self.org[url], self.name[url])
-			try:
-				resp = json.loads(translate(urllib2.urlopen(query).read()))
-				results = resp[key]
-				while 'next' in resp and resp['next']:
-					resp = json.loads(translate(urllib2.urlopen(resp['next']).read()))
-					results += resp[key]
-				all_tags = set([t['name'] for t in results])
-				self.tag_dict[tag_tuple] = all_tags
-			except urllib2.HTTPError:
-				logger.warning("No response from %s"%(query))
-				self.tag_dict[tag_tuple] = set()
+			self.tag_flight.do(tag_tuple, self._listTags, url, tag_tuple)
 		if not remove_latest:
 			return self.tag_dict[tag_tuple]
 		logger.debug("Removing the latest tag from %s"%(url))
 		return self.tag_dict[tag_tuple]-set(['latest'])
+	def _dockerhubTags(self, url):
+		'''
+		Lists the tags of a Docker Hub repository. The page count is computed
+		from the first response, so all remaining pages are requested
+		concurrently.
+
+		# Parameters
+		url (str): Image url used to pull
+
+		# Returns
+		list: Tag records
+		'''
+		query = self.tag_query['dockerhub']%(self.org[url], self.name[url])
+		page_query = query+'?page_size=%i&page=%%i'%(self.page_size)
+		resp = self._getJSON(page_query%(1), 'dockerhub')
+		results = list(resp['results'])
+		n_pages = -(-int(resp.get('count', 0))//self.page_size)
+		if n_pages > 1:
+			tq = ThreadQueue(target=lambda page: self._getJSON(page_query%(page), 'dockerhub')['results'], \
+				n_threads=min(n_pages-1, self.n_threads), progress=False)
+			pages = tq.process_list(range(2, n_pages+1))
+			tq.join()
+			for page in pages:
+				if not page.ok: raise page.exception
+				results += page.result
+		return results
+	def _quayTags(self, url):
+		'''
+		Lists the active tags of a quay.io repository by walking pages
+		until `has_additional` is false
+
+		# Parameters
+		url (str): Image url used to pull
+
+		# Returns
+		list: Tag records
+		'''
+		query = self.tag_query['quay']%(self.org[url], self.name[url])
+		results = []
+		page = 1
+		while True:
+			resp = self._getJSON(query+'?onlyActiveTags=true&limit=%i&page=%i'%(self.page_size, page), 'quay')
+			results += resp['tags']
+			if not resp.get('has_additional', False): break
+			page += 1
+		return results
+	def _listTags(self, url, tag_tuple):
+		'''
+		Lists or syncs the tags of the repository of url into `self.tag_dict`,
+		`self.tag_size`, and `self.tag_index`. Only one thread runs this for a
+		repository at a time (see `_getTags`).
+		'''
+		if tag_tuple in self.tag_dict: return
+		if self.offline:
+			self.tag_dict[tag_tuple] = set(self.tag_index.get(tag_tuple, {}))
+			return
+		try:
+			known = self.tag_index.get(tag_tuple, {})
+			if known:
+				results = self._newTags(url, known)
+			else:
+				results = getattr(self, self.tag_pagers[self.registry[url]])(url)
+			index = dict(known)
+			for t in results: index[t['name']] = self._tagRecord(t)
+			self.tag_index[tag_tuple] = index
+			self.tag_size[tag_tuple] = {name:r[2] for name, r in iterdict(index)}
+			self.tag_dict[tag_tuple] = set(index)
+		except urllib2.HTTPError as e:
+			# Only a missing repository means there are no tags. Other errors reach the caller.
+			if e.code != 404: raise
+			logger.warning("Unable to list the tags of %s"%(url))
+			self.tag_dict[tag_tuple] = set()
+	def _newTags(self, url, known):
+		'''
+		Walks the tags of a repository from the most recently updated and
+		stops at the first page containing a tag that is already known
+		and unchanged
+
+		# Parameters
+		url (str): Image url used to pull
+		known (dict): Indexed tags of the repository {tag:(last_updated,digest,size),}
+
+		# Returns
+		list: Tag records that are new or were updated
+		'''
+		registry = self.registry[url]
+		query = self.tag_query[registry]%(self.org[url], self.name[url])
+		page_query, key, field = self.tag_sync[registry]
+		results = []
+		page = 1
+		while True:
+			resp = self._getJSON(query+page_query%(self.page_size, page), registry)
+			results += resp[key]
+			if any(t['name'] in known and known[t['name']][0] == t.get(field, '') for t in resp[key]): break
+			if not (resp.get('next', False) or resp.get('has_additional', False)): break
+			page += 1
+		logger.debug("Synced %i recent tags of %s"%(len(results), url))
+		return results
+	def _tagRecord(self, t):
+		'''
+		Returns the (last_updated, digest, size) index record of a Docker Hub or quay.io tag
+		'''
+		return (t.get('last_updated', t.get('last_modified', '')), t.get('digest', t.get('manifest_digest', '')), \
+			t.get('full_size', t.get('size', 0)) or 0)
+	def _loadTagIndex(self):
+		'''
+		Loads the persistent tag index from tags.pkl
+		'''
+		self.tag_index = self._cache_load('tags.pkl', dict())
+	def _saveTagIndex(self):
+		'''
+		Saves the persistent tag index to tags.pkl
+		'''
+		self._cache_save('tags.pkl', self.tag_index)
 	def _getUrlTuple(self, url):
 		'''
 		Returns all tags for the image specified with URL
@@ -186,7 +484,24 @@ class validate(url_parser, cache):
 		'''
 		if url not in self.registry:
 			self.parseURL(url)
-		return (self.registry[url], self.org[url], self.name[url])
+		record = self.records[url]
+		return (record.registry, record.org, record.name)
+	def _registrySize(self, url):
+		'''
+		Returns the compressed image size reported by the registry when the
+		tags of the image were queried or indexed. No request is made.
+
+		# Parameters
+		url (str): Image url used to pull
+
+		# Returns
+		int: Size in bytes (0 if unknown)
+		'''
+		tag_tuple = self._getUrlTuple(url)
+		tag = self.records[url].tag
+		if tag_tuple in self.tag_size:
+			return self.tag_size[tag_tuple].get(tag, 0)
+		return self.tag_index.get(tag_tuple, {}).get(tag, (0, 0, 0))[2]
 	def validateURLs(self, url_list, include_libs=False):
 		'''
 		Adds url to the self.invalid set and returns False when a URL is invalid
@@ -196,8 +511,8 @@ class validate(url_parser, cache):
 		include_libs (bool): Include containers of libraries
 		'''
 		# Start from cache
-		cache_file = 'valid.pkl'
-		self.invalid, self.valid = self._cache_load(cache_file, (set(), set()))
+		self._loadValid()
+		self._loadTagIndex()
 		# Parse restored URLs
 		for url in self.invalid | self.valid:
 			logger.debug("Restored %s"%(url))
@@ -214,4 +529,5 @@ class validate(url_parser, cache):
 			tq.process_list([(url, include_libs) for url in to_check])
 			tq.join()
 		# Write to cache
-		self._cache_save(cache_file, (self.invalid, self.valid))
+		self._saveValid()
+		self._saveTagIndex()
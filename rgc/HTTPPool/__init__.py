@@ -0,0 +1,368 @@
+###############################################################################
+# Author: Greg Zynda
+# Last Modified: 01/15/2021
+###############################################################################
+# BSD 3-Clause License
+#
+# Copyright (c) 2018, Texas Advanced Computing Center - UT Austin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+import sys, os, logging, gzip, io, re, hashlib
+from time import time
+from threading import Lock, BoundedSemaphore, current_thread
+logger = logging.getLogger(__name__)
+
+try:
+	import httplib
+	from urlparse import urlsplit, urljoin
+	from urllib2 import HTTPError
+	pyv = 2
+except:
+	import http.client as httplib
+	from urllib.parse import urlsplit, urljoin
+	from urllib.error import HTTPError
+	pyv = 3
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+
+class Response:
+	'''
+	Fully read HTTP response
+
+	# Attributes
+	url (str): URL of the final (post-redirect) request
+	status (int): HTTP status code
+	headers (dict): Response headers with lower-case names
+	body (bytes): Decoded response body
+	'''
+	__slots__ = ('url', 'status', 'headers', 'body')
+	def __init__(self, url, status, headers, body):
+		self.url = url
+		self.status = status
+		self.headers = headers
+		self.body = body
+	def read(self):
+		return self.body
+
+class HTTPPool:
+	user_agent = 'rgc'
+	max_redirects = 5
+	chunk_size = 1<<20
+	cache_max_age = 30*24*3600
+	cache_max_bytes = 256<<20
+	def __init__(self, max_per_host=8, timeout=30):
+		'''
+		Thread-safe pool of persistent HTTP/1.1 connections. Connections are
+		kept open and reused for later requests to the same host, so each
+		host only pays for a TCP and TLS handshake once per connection.
+		At most `max_per_host` connections are open to a host at a time.
+		Other requests to that host wait for a free connection.
+
+		# Parameters
+		max_per_host (int): Maximum concurrent connections per host [8]
+		timeout (float): Socket timeout in seconds for connecting and reading [30]
+		'''
+		self.max_per_host = max_per_host
+		self.timeout = timeout
+		self.idle = {}
+		self.slots = {}
+		self.lock = Lock()
+		self.n_connections = 0
+		self.pruned = set()
+	def _host(self, key):
+		with self.lock:
+			if key not in self.slots:
+				self.slots[key] = BoundedSemaphore(self.max_per_host)
+				self.idle[key] = []
+			return self.slots[key]
+	def _connection(self, key):
+		with self.lock:
+			if self.idle[key]: return self.idle[key].pop()
+			self.n_connections += 1
+		scheme, host = key
+		logger.debug("Opening connection to %s://%s"%(scheme, host))
+		if scheme == 'https':
+			return httplib.HTTPSConnection(host, timeout=self.timeout)
+		return httplib.HTTPConnection(host, timeout=self.timeout)
+	def _release(self, key, conn):
+		with self.lock:
+			self.idle[key].append(conn)
+	def request(self, url, method='GET', headers={}):
+		'''
+		Sends a request on a pooled connection and follows redirects. The
+		Authorization header is only sent to the original host.
+
+		# Parameters
+		url (str): Absolute http or https URL
+		method (str): HTTP method [GET]
+		headers (dict): Extra request headers
+
+		# Raises
+		HTTPError: If the final response has a status >= 400
+
+		# Returns
+		Response: The fully read response
+		'''
+		origin = urlsplit(url).netloc
+		all_headers = dict(headers)
+		for i in range(self.max_redirects+1):
+			if urlsplit(url).netloc != origin:
+				all_headers = _strip_auth(all_headers)
+			resp = self._request(url, method, all_headers)
+			if resp.status in (301, 302, 303, 307, 308) and 'location' in resp.headers:
+				url = urljoin(url, resp.headers['location'])
+				if resp.status == 303: method = 'GET'
+				continue
+			break
+		if resp.status >= 400:
+			raise HTTPError(url, resp.status, httplib.responses.get(resp.status, ''), resp.headers, io.BytesIO(resp.body))
+		return resp
+	def get(self, url, headers={}):
+		'''
+		Returns the body of a GET request
+
+		# Parameters
+		url (str): Absolute http or https URL
+		headers (dict): Extra request headers
+
+		# Returns
+		bytes: Response body
+		'''
+		return self.request(url, 'GET', headers).body
+	def stream(self, url, write, headers={}, start=None):
+		'''
+		Sends a GET request and passes the body to write in chunks as it
+		arrives, so large downloads are never held in memory. The body is
+		not decoded. Redirects are followed, but the Authorization header is
+		only sent to the original host.
+
+		# Parameters
+		url (str): Absolute http or https URL
+		write (function): Called with each chunk of the body
+		headers (dict): Extra request headers
+		start (function): Called with the final response before its first chunk, e.g. to tell a 206 from a 200
+
+		# Raises
+		HTTPError: If the final response has a status >= 400
+
+		# Returns
+		Response: The final response, with an empty body
+		'''
+		origin = urlsplit(url).netloc
+		all_headers = dict(headers)
+		all_headers['Accept-Encoding'] = 'identity'
+		for i in range(self.max_redirects+1):
+			if urlsplit(url).netloc != origin:
+				all_headers = _strip_auth(all_headers)
+			resp = self._request(url, 'GET', all_headers, write, start)
+			if resp.status in (301, 302, 303, 307, 308) and 'location' in resp.headers:
+				url = urljoin(url, resp.headers['location'])
+				continue
+			break
+		if resp.status >= 400:
+			raise HTTPError(url, resp.status, httplib.responses.get(resp.status, ''), resp.headers, io.BytesIO(resp.body))
+		return resp
+	def _request(self, url, method, headers, write=None, start=None):
+		parts = urlsplit(url)
+		key = (parts.scheme, parts.netloc)
+		path = parts.path or '/'
+		if parts.query: path += '?'+parts.query
+		all_headers = {'User-Agent':self.user_agent, 'Accept-Encoding':'gzip', 'Connection':'keep-alive'}
+		all_headers.update(headers)
+		slot = self._host(key)
+		with slot:
+			# A reused connection may have been closed by the server, so retry once on a new one
+			for attempt in range(2):
+				conn = self._connection(key)
+				try:
+					conn.request(method, path, headers=all_headers)
+					resp = conn.getresponse()
+					streaming = write is not None and resp.status < 300
+					body = b'' if streaming else resp.read()
+				except (httplib.HTTPException, IOError, OSError):
+					conn.close()
+					if attempt: raise
+					continue
+				break
+			resp_headers = dict((k.lower(), v) for k, v in resp.getheaders())
+			if streaming:
+				# A failure part way through the body cannot be retried here
+				try:
+					if start: start(Response(url, resp.status, resp_headers, b''))
+					for chunk in iter(lambda: resp.read(self.chunk_size), b''): write(chunk)
+				except:
+					conn.close()
+					raise
+			if resp.will_close:
+				conn.close()
+			else:
+				self._release(key, conn)
+		if body and resp_headers.get('content-encoding', '') == 'gzip':
+			body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+		return Response(url, resp.status, resp_headers, body)
+	def cached_get(self, url, headers={}, cache_dir=False, refresh=False):
+		'''
+		Returns the body of a GET request, using a response stored in
+		`cache_dir/http` when possible. A stored response is returned
+		without a request while it is fresh according to its Cache-Control
+		max-age. After that it is revalidated with If-None-Match and
+		If-Modified-Since, and a 304 response reuses the stored body.
+		Only responses that are still fresh or can be revalidated are saved,
+		so no-store responses and responses with max-age=0 and neither an
+		ETag nor a Last-Modified header are not. Stored responses are pruned
+		by `prune` the first time a cache directory is used.
+
+		# Parameters
+		url (str): Absolute http or https URL
+		headers (dict): Extra request headers
+		cache_dir (str): Cache directory (responses are not stored when False)
+		refresh (bool): Ignore stored responses, but still save the new one
+
+		# Raises
+		HTTPError: If the server responds with a status >= 400
+
+		# Returns
+		bytes: Response body
+		'''
+		if not cache_dir: return self.get(url, headers)
+		if cache_dir not in self.pruned:
+			self.pruned.add(cache_dir)
+			self.prune(cache_dir)
+		cache_file = os.path.join(cache_dir, 'http', hashlib.sha1(url.encode('utf-8')).hexdigest())
+		entry = False if refresh else _read_entry(cache_file, url)
+		if entry and entry['expires'] > time():
+			logger.debug("Using stored response for %s"%(url))
+			return entry['body']
+		all_headers = dict(headers)
+		if entry and entry['etag']: all_headers['If-None-Match'] = entry['etag']
+		if entry and entry['last_modified']: all_headers['If-Modified-Since'] = entry['last_modified']
+		resp = self.request(url, 'GET', all_headers)
+		if resp.status == 304 and entry:
+			logger.debug("Revalidated stored response for %s"%(url))
+			body = entry['body']
+		else:
+			body = resp.body
+		max_age = _max_age(resp.headers.get('cache-control', ''))
+		etag = resp.headers.get('etag', entry['etag'] if entry else '')
+		last_modified = resp.headers.get('last-modified', entry['last_modified'] if entry else '')
+		if max_age is not None and (max_age or etag or last_modified):
+			_write_entry(cache_file, {'url':url, 'body':body, 'expires':time()+max_age, \
+				'etag':etag, 'last_modified':last_modified})
+		elif entry:
+			_remove(cache_file)
+		return body
+	def prune(self, cache_dir):
+		'''
+		Deletes responses stored in `cache_dir/http` that were last saved
+		more than `cache_max_age` seconds ago. The oldest remaining
+		responses are then deleted until the directory holds at most
+		`cache_max_bytes`. Temporary files left by interrupted writes are
+		deleted after an hour.
+
+		# Parameters
+		cache_dir (str): Cache directory passed to `cached_get`
+		'''
+		http_dir = os.path.join(cache_dir, 'http')
+		if not os.path.isdir(http_dir): return
+		cutoff = time()-self.cache_max_age
+		entries = []
+		for f in os.listdir(http_dir):
+			cache_file = os.path.join(http_dir, f)
+			try:
+				st = os.stat(cache_file)
+			except OSError:
+				continue
+			# Temporary files of finished writes were renamed, so these were abandoned
+			if st.st_mtime < cutoff or (f.endswith('.tmp') and st.st_mtime < time()-3600):
+				_remove(cache_file)
+			elif not f.endswith('.tmp'):
+				entries.append((st.st_mtime, st.st_size, cache_file))
+		total = sum(e[1] for e in entries)
+		n_removed = 0
+		for mtime, size, cache_file in sorted(entries):
+			if total <= self.cache_max_bytes: break
+			_remove(cache_file)
+			total -= size
+			n_removed += 1
+		if n_removed: logger.debug("Removed %i stored responses to keep %s under %i bytes"%(n_removed, http_dir, self.cache_max_bytes))
+	def close(self):
+		'''
+		Closes all idle connections
+		'''
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns: conn.close()
+				del conns[:]
+
+max_age_re = re.compile(r'max-age=(\d+)')
+
+def _max_age(cache_control):
+	'''
+	Returns the seconds a response stays fresh, 0 if it must always be
+	revalidated, or None if it must not be stored
+	'''
+	if 'no-store' in cache_control or 'private' in cache_control: return None
+	if 'no-cache' in cache_control: return 0
+	match = max_age_re.search(cache_control)
+	return int(match.group(1)) if match else 0
+
+def _strip_auth(headers):
+	'''
+	Returns a copy of headers without the Authorization header
+	'''
+	return dict((k, v) for k, v in headers.items() if k.lower() != 'authorization')
+
+def _remove(cache_file):
+	try:
+		os.remove(cache_file)
+	except OSError:
+		pass
+
+def _read_entry(cache_file, url):
+	try:
+		with open(cache_file, 'rb') as OF:
+			entry = pickle.load(OF)
+	except (IOError, OSError, EOFError, pickle.UnpicklingError):
+		return False
+	return entry if entry.get('url') == url else False
+
+def _write_entry(cache_file, entry):
+	cache_dir = os.path.dirname(cache_file)
+	if not os.path.exists(cache_dir):
+		try:
+			os.makedirs(cache_dir)
+		except OSError:
+			pass
+	# Write then rename so concurrent readers never see a partial entry
+	tmp_file = '%s.%i.%i.tmp'%(cache_file, os.getpid(), current_thread().ident)
+	with open(tmp_file, 'wb') as OF:
+		pickle.dump(entry, OF)
+	os.rename(tmp_file, cache_file)
@@ -35,15 +35,17 @@
 
 import sys, os, logging, re, json
 from tqdm import tqdm
-from threading import Thread, current_thread
-from time import sleep
+from threading import Thread, Condition, Event, Lock, current_thread
+from time import time
 logger = logging.getLogger(__name__)
 
+from itertools import count
+from rgc.helpers import kill_children
 try:
-	from Queue import Queue
+	from Queue import Queue, PriorityQueue, Empty
 	pyv = 2
 except:
-	from queue import Queue
+	from queue import Queue, PriorityQueue, Empty
 	pyv = 3
 
 # https://github.com/tqdm/tqdm/issues/313
@@ -56,59 +58,307 @@ class TqdmHandler(logging.StreamHandler):
         except (KeyboardInterrupt, SystemExit): raise
         except: self.handleError(record)
 
+class TaskResult:
+	'''
+	Record of a single task run by a ThreadQueue worker
+
+	# Attributes
+	args: Arguments the target was called with
+	result: Return value of the target (None if it raised)
+	exception (Exception): Exception raised by the target (None if it succeeded)
+	elapsed (float): Wall-clock seconds spent running the target
+	'''
+	__slots__ = ('args', 'result', 'exception', 'elapsed')
+	def __init__(self, args, result=None, exception=None, elapsed=0.0):
+		self.args = args
+		self.result = result
+		self.exception = exception
+		self.elapsed = elapsed
+	@property
+	def ok(self):
+		return self.exception is None
+	def __repr__(self):
+		if self.ok:
+			return "TaskResult(%s, result=%s, %.2fs)"%(str(self.args), str(self.result), self.elapsed)
+		return "TaskResult(%s, exception=%s, %.2fs)"%(str(self.args), repr(self.exception), self.elapsed)
+
+class _Call:
+	__slots__ = ('done', 'result', 'exception')
+	def __init__(self):
+		self.done = Event()
+		self.result = None
+		self.exception = None
+
+class Singleflight:
+	'''
+	Coalesces concurrent calls that share a key. The first caller runs the
+	function while the others wait and receive its result or exception.
+	Keys are forgotten once the call finishes, so later calls run again.
+	'''
+	def __init__(self):
+		self.lock = Lock()
+		self.calls = {}
+	def do(self, key, target, *args):
+		'''
+		Runs target(*args) unless a call with the same key is already running
+
+		# Parameters
+		key: Hashable key identifying the work
+		target (function): Function to run
+
+		# Returns
+		Return value of the call that ran for this key
+		'''
+		with self.lock:
+			leader = key not in self.calls
+			if leader: self.calls[key] = _Call()
+			call = self.calls[key]
+		if leader:
+			try:
+				call.result = target(*args)
+			except Exception as e:
+				call.exception = e
+			finally:
+				with self.lock: del self.calls[key]
+				call.done.set()
+		else:
+			logger.debug("Waiting for the in-flight call of %s"%(str(key)))
+			call.done.wait()
+		if call.exception is not None: raise call.exception
+		return call.result
+
+class AIMDLimiter:
+	def __init__(self, name, max_limit=8, min_limit=1, slow=0, max_cooldown=60):
+		'''
+		Concurrency limit for a single registry or host that is adjusted with
+		additive-increase/multiplicative-decrease (AIMD). Every successful
+		request grows the limit by 1/limit (about one slot per round of
+		requests). A congested request halves the limit and pauses new
+		requests for a cooldown that doubles while congestion persists.
+		Congestion is a 429 or 5xx HTTP error, a connection error, a
+		request slower than `slow` seconds, or an explicit call to
+		`slot.congested()`.
+
+		# Parameters
+		name (str): Registry or host the limiter belongs to
+		max_limit (int): Maximum number of concurrent requests [8]
+		min_limit (int): Minimum number of concurrent requests [1]
+		slow (float): Requests taking longer than this many seconds count as congested (0 disables) [0]
+		max_cooldown (float): Maximum pause in seconds after congestion [60]
+		'''
+		self.name = name
+		self.max_limit = max(max_limit, min_limit)
+		self.min_limit = min_limit
+		self.limit = float(self.max_limit)
+		self.slow = slow
+		self.max_cooldown = max_cooldown
+		self.cooldown = 0
+		self.hold_until = 0
+		self.active = 0
+		self.cond = Condition()
+	def acquire(self):
+		with self.cond:
+			while True:
+				wait = self.hold_until-time()
+				if wait > 0:
+					self.cond.wait(wait)
+				elif self.active >= int(self.limit):
+					self.cond.wait()
+				else:
+					break
+			self.active += 1
+	def release(self, congested=False):
+		with self.cond:
+			self.active -= 1
+			if congested:
+				self.limit = max(self.min_limit, self.limit/2.0)
+				self.cooldown = min(self.max_cooldown, self.cooldown*2 if self.cooldown else 1)
+				self.hold_until = time()+self.cooldown
+				logger.debug("%s is congested - limiting to %i concurrent requests for %i seconds"%(self.name, int(self.limit), self.cooldown))
+			else:
+				self.limit = min(self.max_limit, self.limit+1.0/self.limit)
+				self.cooldown = 0
+			self.cond.notify_all()
+	def slot(self):
+		'''
+		Returns a context manager that holds one concurrency slot
+
+		>>> with limiter.slot() as s:
+		...	if rate_limited: s.congested()
+		'''
+		return _Slot(self)
+
+class _Slot:
+	def __init__(self, limiter):
+		self.limiter = limiter
+		self.is_congested = False
+	def congested(self):
+		self.is_congested = True
+	def __enter__(self):
+		self.limiter.acquire()
+		self.start = time()
+		return self
+	def __exit__(self, exc_type, exc, tb):
+		if exc is not None and _isCongestion(exc): self.is_congested = True
+		if self.limiter.slow and time()-self.start > self.limiter.slow: self.is_congested = True
+		self.limiter.release(self.is_congested)
+		return False
+
+def _isCongestion(exc):
+	'''
+	Returns True for exceptions that indicate an overloaded or rate-limiting server
+	'''
+	code = getattr(exc, 'code', None)
+	if isinstance(code, int): return code == 429 or code >= 500
+	# URLError, socket.timeout, and connection errors
+	return isinstance(exc, (IOError, OSError))
+
+def log_slowest(results, n=5):
+	'''
+	Logs the n slowest tasks from a list of TaskResult records
+
+	# Parameters
+	results (list): TaskResult records returned by `ThreadQueue.process_list`
+	n (int): Number of tasks to report [5]
+	'''
+	for record in sorted(results, key=lambda r: r.elapsed, reverse=True)[:n]:
+		logger.debug("%.1f seconds - %s"%(record.elapsed, str(record.args)))
+
 class ThreadQueue:
-	def __init__(self, target, n_threads=10):
+	'''
+	# Attributes
+	handler (TqdmHandler): Log handler shared by every ThreadQueue, so concurrent queues do not repeat log lines
+	handler_users (int): Number of live ThreadQueues using the shared handler
+	handler_lock (Lock): Guards adding and removing the shared handler
+	'''
+	handler = None
+	handler_users = 0
+	handler_lock = Lock()
+	def __init__(self, target, n_threads=10, maxsize=0, priority=None, progress=True):
 		'''
 		Class for killable thread pools
 
 		# Parameters
 		target (function): Target function for threads to run
 		n_threads (int): Number of worker threads to use [10]
-		verbose (bool): Enables verbose logging
+		maxsize (int): Maximum number of queued items before `put` blocks (0 is unbounded) [0]
+		priority (function): Returns the expected cost of a work item. When set, the most expensive queued items are run first (longest processing time scheduling)
+		progress (bool): Display a progress bar while processing [True]
 		'''
 		# Get the log level
 		self.numerical_level = logger.getEffectiveLevel()
 		self.log_level = logging.getLevelName(self.numerical_level)
-		# Init logger with handler for tqdm
+		# Init logger with one handler for tqdm shared by all queues
 		FORMAT = '[%(levelname)s - %(threadName)s - %(name)s.%(funcName)s] %(message)s'
-		# Store handler so it can be removed
-		self.handler = TqdmHandler()
-		self.handler.setFormatter(logging.Formatter(FORMAT))
-		logger.addHandler(self.handler)
+		with ThreadQueue.handler_lock:
+			if ThreadQueue.handler is None:
+				ThreadQueue.handler = TqdmHandler()
+				ThreadQueue.handler.setFormatter(logging.Formatter(FORMAT))
+			if ThreadQueue.handler not in logger.handlers: logger.addHandler(ThreadQueue.handler)
+			ThreadQueue.handler_users += 1
 		logger.propagate = False
 		logger.debug("Finished initializing the threaded log handler for tqdm")
 		self.pbar = ''
+		self.results = []
 		self.n_threads = n_threads
-		self.queue = Queue()
+		self.priority = priority
+		self.progress = progress
+		self.queue = PriorityQueue(maxsize) if priority else Queue(maxsize)
+		self.counter = count()
 		# Spawn threads
 		self.threads = [Thread(target=self.worker, args=[target]) for i in range(n_threads)]
-		for t in self.threads: t.start()
+		for t in self.threads:
+			# Daemon threads cannot keep the interpreter alive after an interrupt
+			t.daemon = True
+			t.start()
 		logger.debug("Spawned and started %i threads"%(n_threads))
 	def __del__(self):
-		logger.debug("Removing handler")
-		logger.removeHandler(self.handler)
+		with ThreadQueue.handler_lock:
+			ThreadQueue.handler_users -= 1
+			if ThreadQueue.handler_users > 0: return
+			logger.debug("Removing handler")
+			logger.removeHandler(ThreadQueue.handler)
 	def process_list(self, work_list):
 		'''
+		Queues every item of work_list and blocks until the last one
+		has finished. Completion is signaled by the workers through
+		`Queue.task_done`, so this returns as soon as the final task
+		completes instead of polling the queue. When a priority function
+		is set, every cost is computed before the first item is queued and
+		the items are queued from the most to the least expensive, so the
+		workers never start on a partially prioritized batch.
+
 		# Parameters
 		work_list (list): List of argument lists for threads to run
+
+		# Returns
+		list: TaskResult records in the order the tasks completed
 		'''
-		#if self.log_level != 'DEBUG':
-		self.pbar = tqdm(total=len(work_list))
+		work_list = list(work_list)
+		self.results = []
+		self.pbar = tqdm(total=len(work_list), disable=not self.progress)
 		try:
-			for work_item in work_list:
-				self.queue.put(work_item)
+			if self.priority:
+				costs = [self.priority(work_item) for work_item in work_list]
+				for i in sorted(range(len(work_list)), key=lambda i: -costs[i]):
+					self._enqueue(work_list[i], costs[i])
+			else:
+				for work_item in work_list:
+					self._enqueue(work_item)
 			logger.debug("Added %i items to the work queue"%(len(work_list)))
-			while not self.queue.empty():
-				sleep(0.5)
+			self.queue.join()
 			logger.debug("Finished running work list")
-			while self.pbar.n != len(work_list): sleep(0.5)
 			if self.pbar:
 				self.pbar.close()
 				self.pbar = ''
+			return self.results
 		except KeyboardInterrupt as e:
 			logger.warning("Caught KeyboardInterrupt - Killing threads")
-			for t in self.threads: t.alive = False
-			for t in self.threads: t.join()
+			self._kill()
+			sys.exit(e)
+	def put(self, work_item):
+		'''
+		Queues a single work item without waiting for it to finish. The
+		progress bar total grows with every item, so stages can be fed
+		incrementally by upstream workers. Blocks when the queue is full.
+
+		# Parameters
+		work_item: Argument list for a thread to run
+		'''
+		if not self.pbar: self.pbar = tqdm(total=0, disable=not self.progress)
+		self.pbar.total += 1
+		self.pbar.refresh()
+		self._enqueue(work_item)
+	def _enqueue(self, work_item, cost=None):
+		'''
+		Puts a work item on the queue, ordered by descending cost when
+		`self.priority` is set. Items of equal cost keep their insertion order.
+
+		# Parameters
+		work_item: Argument list for a thread to run
+		cost (float): Override the cost returned by `self.priority`
+		'''
+		if not self.priority:
+			self.queue.put(work_item)
+			return
+		if cost is None: cost = self.priority(work_item)
+		self.queue.put((-cost, next(self.counter), work_item))
+	def wait(self):
+		'''
+		Blocks until every item queued with `put` has finished
+
+		# Returns
+		list: TaskResult records in the order the tasks completed
+		'''
+		try:
+			self.queue.join()
+			if self.pbar:
+				self.pbar.close()
+				self.pbar = ''
+			return self.results
+		except KeyboardInterrupt as e:
+			logger.warning("Caught KeyboardInterrupt - Killing threads")
+			self._kill()
 			sys.exit(e)
 	def join(self):
 		'''
@@ -117,20 +367,33 @@ class ThreadQueue:
 		try:
 			for t in self.threads:
 				logger.debug("Added STOP")
-				self.queue.put('STOP')
+				self._enqueue('STOP', cost=float('-inf'))
 			for t in self.threads:
-				while t.is_alive():
-					t.join(0.5)
+				t.join()
 			if self.pbar:
 				self.pbar.close()
 				self.pbar = ''
 			logger.debug("Joined all threads")
 		except KeyboardInterrupt as e:
 			logger.warning("Caught KeyboardInterrupt. Killing threads")
-			for t in self.threads: t.alive = False
-			sp.call('pkill -9f "singularity pull"', shell=True)
-			for t in self.threads: t.join()
+			self._kill()
 			sys.exit(e)
+	def _kill(self):
+		'''
+		Kills running child processes, drops queued work, and stops every
+		worker. Idle workers block on the queue, so each one is woken by a
+		STOP that is ordered before any remaining work.
+		'''
+		kill_children()
+		for t in self.threads: t.alive = False
+		try:
+			while True:
+				self.queue.get_nowait()
+				self.queue.task_done()
+		except Empty:
+			pass
+		for t in self.threads: self._enqueue('STOP', cost=float('inf'))
+		for t in self.threads: t.join()
 	def worker(self, target):
 		'''
 		Worker for pulling images
@@ -140,17 +403,29 @@ class ThreadQueue:
 		'''
 		t = current_thread()
 		t.alive = True
-		for args in iter(self.queue.get, 'STOP'):
+		while True:
+			args = self.queue.get()
+			if self.priority: args = args[2]
+			if type(args) is str and args == 'STOP': break
 			if not t.alive:
 				logger.debug("Thread was killed. Stopping")
+				self.queue.task_done()
 				break
-			if type(args) is list or type(args) is tuple:
-				logger.debug("Running %s%s"%(target.__name__, str(map(str, args))))
-				target(*args)
-			else:
-				logger.debug("Running %s(%s)"%(target.__name__, str(args)))
-				target(args)
-			#if self.log_level != 'DEBUG':
-			logger.debug("Finished task. Updating progress")
-			self.pbar.update(1)
-			self.queue.task_done()
+			record = TaskResult(args)
+			start = time()
+			try:
+				if type(args) is list or type(args) is tuple:
+					logger.debug("Running %s%s"%(target.__name__, str(tuple(map(str, args)))))
+					record.result = target(*args)
+				else:
+					logger.debug("Running %s(%s)"%(target.__name__, str(args)))
+					record.result = target(args)
+			except Exception as e:
+				logger.error("%s(%s) raised %s: %s"%(target.__name__, str(args), type(e).__name__, str(e)))
+				record.exception = e
+			finally:
+				record.elapsed = time()-start
+				self.results.append(record)
+				logger.debug("Finished task. Updating progress")
+				if self.pbar: self.pbar.update(1)
+				self.queue.task_done()
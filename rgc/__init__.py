@@ -39,7 +39,9 @@ import sys, argparse, os, json, logging
 logger = logging.getLogger(__name__)
 
 from .version import version as __version__
+from itertools import chain
 from rgc.ContainerSystem import ContainerSystem
+from rgc.helpers import read_urls, unique
 
 # Environment
 FORMAT = '[%(levelname)s - %(name)s.%(funcName)s] %(message)s'
@@ -77,10 +79,32 @@ def main():
 		help='Delete unused containers and module files')
 	parser.add_argument('-t', '--threads', metavar='INT', \
 		help='Number of concurrent threads to use for pulling [%(default)s]', default='8', type=int)
+	parser.add_argument('--pull-timeout', metavar='INT', \
+		help='Seconds a pull may take across all of its attempts before it is killed (0 disables) [%(default)s]', default='7200', type=int)
+	parser.add_argument('--http-timeout', metavar='FLOAT', \
+		help='Seconds before a registry or metadata request times out [%(default)s]', default='30', type=float)
+	parser.add_argument('--biotools-index', action='store_true', \
+		help='Download the bio.tools catalogue once (cached for a week) instead of querying each tool')
+	parser.add_argument('--biotools-dump', metavar='JSON', \
+		help='Read the bio.tools catalogue from a JSON dump instead of querying each tool')
+	parser.add_argument('--offline', metavar='SNAPSHOT', \
+		help='Validate and write metadata without network access, using a snapshot from --export-snapshot')
+	parser.add_argument('--registry-mirror', metavar='URL', \
+		help='Check tags missing from the --offline snapshot against this local OCI registry mirror', default='')
+	parser.add_argument('--export-snapshot', metavar='FILE', \
+		help='Save the tags and metadata gathered by this run for use with --offline')
+	parser.add_argument('--pipeline', action='store_true', \
+		help='Stream each image through validation, pulling, scanning, and module generation instead of finishing each stage for all images first')
+	parser.add_argument('--queue-size', metavar='INT', \
+		help='Maximum number of images waiting between pipeline stages (0 is unbounded) [%(default)s]', default='0', type=int)
 	parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
 	parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
-	parser.add_argument('urls', metavar='URL', type=str, nargs='+', help='Image urls to pull')
+	parser.add_argument('--urls-from', metavar='FILE', \
+		help='Read image urls from FILE (- for stdin), one per line with # comments. With --pipeline, work starts while the file is still being read')
+	parser.add_argument('urls', metavar='URL', type=str, nargs='*', help='Image urls to pull')
 	args = parser.parse_args()
+	if not args.urls and not args.urls_from:
+		parser.error("at least one URL or --urls-from is required")
 	################################
 	# Configure logging
 	################################
@@ -95,7 +119,10 @@ def main():
 	cSystem = ContainerSystem(module_dir=args.moddir, \
 			container_dir=args.imgdir, cache_dir=args.cachedir, \
 			module_system='lmod', force=False, \
-			force_cache=args.force, n_threads=args.threads)
+			force_cache=args.force, n_threads=args.threads, \
+			queue_size=args.queue_size)
+	cSystem.pull_timeout = args.pull_timeout
+	cSystem.http.timeout = args.http_timeout
 	logger.info("Finished initializing system")
 	################################
 	# Define default URLs
@@ -104,15 +131,37 @@ def main():
 		'biocontainers/biocontainers:vdebian-buster-backports_cv1', \
 		'gzynda/build-essential:bionic']
 	logger.debug("Using the following images as baselines: %s"%(str(defaultURLS)))
+	if args.urls_from:
+		urls = unique(chain(defaultURLS, args.urls, read_urls(args.urls_from)))
+	else:
+		urls = unique(defaultURLS+args.urls)
+	if args.offline:
+		cSystem.loadSnapshot(args.offline, args.registry_mirror)
+	elif args.biotools_index or args.biotools_dump:
+		cSystem.loadBiotools(args.biotools_dump or '')
+	if args.pipeline:
+		################################
+		# Stream URLs through all stages
+		################################
+		cSystem.pipelineAll(urls, include_libs=args.include_libs, \
+			baseline=defaultURLS, p=args.percentile, pathPrefix=args.prefix, \
+			contact_url=args.contact, mod_prefix=args.modprefix, \
+			tracker_url=args.tracker, lmod_prereqs=args.requires.split(','), \
+			delete_old=args.delete_old, use_cache=True)
+		if args.export_snapshot: cSystem.exportSnapshot(args.export_snapshot)
+		logger.debug("DONE processing all containers")
+		return
+	url_list = list(urls)
 	################################
 	# Validate all URLs
 	################################
-	cSystem.validateURLs(defaultURLS+args.urls, args.include_libs)
+	cSystem.validateURLs(url_list, args.include_libs)
 	logger.debug("DONE validating URLs")
 	################################
 	# Pull all URLs
 	################################
-	cSystem.pullAll(defaultURLS+args.urls, delete_old=args.delete_old, use_cache=True)
+	cSystem.pullAll(url_list, delete_old=args.delete_old, use_cache=True)
+	if args.export_snapshot: cSystem.exportSnapshot(args.export_snapshot)
 	logger.debug("DONE pulling all urls")
 	################################
 	# Process all images
@@ -129,8 +178,8 @@ def main():
 	################################
 	cSystem.genModFiles(pathPrefix=args.prefix, contact_url=args.contact, \
 		mod_prefix=args.modprefix, delete_old=args.delete_old, \
-		tracker_url=args.tracker, force=False, lmod_prereqs=requires.split(','))
-	logger.debug("DONE creating Lmod files for all %i containers"%(len(args.urls)))
+		tracker_url=args.tracker, force=False, lmod_prereqs=args.requires.split(','))
+	logger.debug("DONE creating Lmod files for all %i containers"%(len(url_list)-len(defaultURLS)))
 
 if __name__ == "__main__":
 	main()
@@ -35,10 +35,16 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ###############################################################################
 
-import logging, os, sys
+import logging, os, sys, signal, errno
 from shutil import rmtree
 import subprocess as sp
-from time import sleep
+from threading import Lock, Timer, Event
+from time import sleep, time
+from contextlib import contextmanager
+try:
+	import fcntl
+except ImportError:
+	fcntl = False
 
 ###### globals ############
 pyv = sys.version_info.major
@@ -66,6 +72,19 @@ def delete(*paths):
 		else:
 			logger.warning("%s does not exist. Cannot remove"%(p))
 
+def makedirs(path):
+	'''
+	Creates a directory and its parents. Unlike `os.makedirs`, a directory
+	created by another thread or process at the same time is not an error.
+
+	# Parameters
+	path (str): Directory to create
+	'''
+	try:
+		os.makedirs(path)
+	except OSError as e:
+		if e.errno != errno.EEXIST or not os.path.isdir(path): raise
+
 def remove_empty_sub_directories(dir_path):
 	'''
 	Descends from a provided path and deletes any empty directories.
@@ -79,28 +98,128 @@ def remove_empty_sub_directories(dir_path):
 			assert dir_path in path
 			delete(path)
 
-def retry_call(cmd, url, times=3, sleep_time=2):
+# Process groups of running child processes {pid:Popen,}
+_children = {}
+_children_lock = Lock()
+# Set by `kill_children` so no new children are started and failed commands are not retried
+_cancelled = Event()
+
+def _kill_group(proc):
+	'''
+	Kills the process group of a child started by `run`
+	'''
+	try:
+		os.killpg(proc.pid, signal.SIGKILL)
+	except OSError:
+		pass
+
+def kill_children():
+	'''
+	Kills every child process group started by `run` that is still
+	running. Only processes launched by this rgc instance are affected.
+	Commands started by `run` afterwards are killed immediately, and
+	`retry_call` stops retrying.
+	'''
+	with _children_lock:
+		_cancelled.set()
+		procs = list(_children.values())
+	for proc in procs:
+		logger.debug("Killing process group %i"%(proc.pid))
+		_kill_group(proc)
+
+def run(cmd, timeout=0, capture=False, stdout=None, stderr=None):
+	'''
+	Runs a shell command in its own process group, which is tracked so it
+	can be killed by `kill_children`. If the command runs longer than
+	`timeout` seconds, the whole group is killed.
+
+	# Parameters
+	cmd (str): Command to run
+	timeout (float): Wall-clock limit in seconds (0 disables)
+	capture (bool): Capture and return stdout
+	stdout (file): File for stdout when not capturing
+	stderr (file): File for stderr
+
+	# Returns
+	tuple: (return code, stdout bytes or None). The return code is -9 when the command timed out.
+	'''
+	if capture: stdout = sp.PIPE
+	# preexec_fn is not safe in threaded programs, so it is only used where start_new_session is missing
+	session = {'start_new_session':True} if pyv == 3 else {'preexec_fn':os.setsid}
+	proc = sp.Popen(cmd, shell=True, stdout=stdout, stderr=stderr, **session)
+	with _children_lock:
+		_children[proc.pid] = proc
+		if _cancelled.is_set(): _kill_group(proc)
+	timer = None
+	if timeout:
+		timer = Timer(timeout, _kill_group, [proc])
+		timer.daemon = True
+		timer.start()
+	try:
+		output = proc.communicate()[0]
+	finally:
+		if timer: timer.cancel()
+		with _children_lock:
+			_children.pop(proc.pid, None)
+	if timer and proc.returncode == -signal.SIGKILL:
+		logger.warning("Killed after %i seconds: %s"%(timeout, cmd))
+	return proc.returncode, output
+
+def call(cmd, timeout=0, stdout=None, stderr=None):
+	'''
+	Tracked replacement for `subprocess.call(cmd, shell=True)`
+
+	# Returns
+	int: return code
+	'''
+	return run(cmd, timeout, stdout=stdout, stderr=stderr)[0]
+
+def check_output(cmd, timeout=0, stderr=None):
+	'''
+	Tracked replacement for `subprocess.check_output(cmd, shell=True)`
+
+	# Raises
+	subprocess.CalledProcessError: If the command fails or times out
+
+	# Returns
+	bytes: stdout of the command
+	'''
+	ret, output = run(cmd, timeout, capture=True, stderr=stderr)
+	if ret: raise sp.CalledProcessError(ret, cmd, output)
+	return output
+
+def retry_call(cmd, url, times=3, sleep_time=2, timeout=0):
 	'''
-	Retries the check_call command
+	Retries the check_call command. Commands killed by `kill_children`
+	are not retried.
 
 	# Parameters
 	cmd (str): Command to run
 	url (str): Image url used to pull
 	times (int): Number of retries allowed
+	timeout (float): Wall-clock limit in seconds for all attempts together (0 disables)
 
 	# Returns
 	bool: Whether the command succeeded or not
 	'''
 	logger.debug("Running: "+cmd)
 	FNULL = open(os.devnull, 'w')
+	deadline = time()+timeout if timeout else 0
 	for i in range(times):
 		try:
-			sp.check_call(cmd, shell=True, stdout=FNULL, stderr=FNULL)
+			remaining = deadline-time() if deadline else 0
+			if deadline and remaining <= 0:
+				logger.warning("Stopped retrying after %i seconds: %s"%(timeout, cmd))
+				FNULL.close()
+				return False
+			if call(cmd, remaining, stdout=FNULL, stderr=FNULL):
+				raise sp.CalledProcessError(1, cmd)
 		except KeyboardInterrupt as e:
+			kill_children()
 			FNULL.close()
 			sys.exit()
 		except sp.CalledProcessError:
-			if i < times-1:
+			if i < times-1 and not _cancelled.is_set():
 				logger.debug("Attempting to pull %s again"%(url))
 				sleep(sleep_time)
 				continue
@@ -150,3 +269,61 @@ def iterdict(D):
 		# Python 3
 		OI = D.items()
 	return OI
+
+def read_urls(handle):
+	'''
+	Yields image urls from a file, one per line. Blank lines and
+	anything after a `#` are skipped. A file opened from a path is
+	closed once it has been read, or when the generator is closed.
+
+	# Parameters
+	handle (file or str): Open file, or a path to open (- reads sys.stdin)
+
+	# Yields
+	str: Image url
+	'''
+	if handle == '-': handle = sys.stdin
+	if isinstance(handle, str):
+		with open(handle) as IF:
+			for url in read_urls(IF): yield url
+		return
+	for line in handle:
+		url = line.split('#', 1)[0].strip()
+		if url: yield url
+
+def unique(iterable):
+	'''
+	Yields each item of iterable the first time it is seen
+
+	# Parameters
+	iterable (iterable): Items to deduplicate
+
+	# Yields
+	Items in their original order
+	'''
+	seen = set()
+	for item in iterable:
+		if item not in seen:
+			seen.add(item)
+			yield item
+
+@contextmanager
+def file_lock(path, shared=False):
+	'''
+	Holds an advisory lock on path, which is created if missing. Shared locks
+	are held together, while an exclusive lock waits for every other holder.
+	Each call opens its own descriptor, so threads and processes are both
+	coordinated. Locking is skipped where `fcntl` is unavailable.
+
+	# Parameters
+	path (str): Lock file
+	shared (bool): Take a shared lock instead of an exclusive one
+	'''
+	lock_dir = os.path.dirname(path)
+	if lock_dir: makedirs(lock_dir)
+	with open(path, 'a') as LF:
+		if fcntl: fcntl.flock(LF.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			if fcntl: fcntl.flock(LF.fileno(), fcntl.LOCK_UN)
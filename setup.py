@@ -62,7 +62,7 @@ setup(name = "rgc",
 	description="pulls and converts containers to LMOD modules",
 	tests_require = ['pydoc-markdown','tqdm'],
 	install_requires = ['tqdm'],
-	packages = ["rgc","rgc.ContainerSystem","rgc.ThreadQueue"],
+	packages = ["rgc","rgc.ContainerSystem","rgc.ThreadQueue","rgc.HTTPPool"],
 	package_data={'rgc.ContainerSystem':['templates/*.tmpl']},
 	entry_points = {'console_scripts': ['rgc=rgc:main']},
 	options = {'build_scripts': {'executable': '/usr/bin/env python'}},
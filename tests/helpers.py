@@ -26,3 +26,86 @@ def tmp_file(split=False):
 	if split:
 		return tmp_file, *os.path.split(tmp_file)
 	return tmp_file
+
+class local_server:
+	'''
+	Threaded HTTP/1.1 server on localhost that answers from a routes dict of
+	{path:(status, headers, body),} or {path:callable(handler),}. Counts
+	accepted connections and requests so tests can check connection reuse.
+	'''
+	def __init__(self, routes):
+		import threading
+		try:
+			from http.server import BaseHTTPRequestHandler, HTTPServer
+			from socketserver import ThreadingMixIn
+		except ImportError:
+			from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+			from SocketServer import ThreadingMixIn
+		self.routes = routes
+		self.connections = 0
+		self.requests = []
+		self.lock = threading.Lock()
+		server = self
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			def setup(self):
+				BaseHTTPRequestHandler.setup(self)
+				with server.lock: server.connections += 1
+			def log_message(self, *args):
+				pass
+			def do_GET(self):
+				with server.lock: server.requests.append((self.command, self.path, dict(self.headers)))
+				route = server.routes.get(self.path, server.routes.get(self.path.split('?')[0], (404, {}, b'{}')))
+				if callable(route): route = route(self)
+				status, headers, body = route
+				if not isinstance(body, bytes): body = body.encode()
+				self.send_response(status)
+				for k, v in headers.items(): self.send_header(k, v)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				if self.command != 'HEAD': self.wfile.write(body)
+			do_HEAD = do_GET
+		class Server(ThreadingMixIn, HTTPServer):
+			daemon_threads = True
+		self.httpd = Server(('127.0.0.1', 0), Handler)
+		self.url = 'http://127.0.0.1:%i'%(self.httpd.server_address[1])
+		self.thread = threading.Thread(target=self.httpd.serve_forever)
+		self.thread.daemon = True
+	def __enter__(self):
+		self.thread.start()
+		return self
+	def __exit__(self, *args):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+def registry_routes(images, blobs):
+	'''
+	Returns local_server routes of a minimal OCI distribution registry that
+	serves the given images without authentication
+
+	# Parameters
+	images (dict): {'org/name:tag':[layer bytes,],}
+	blobs (dict): Filled with {digest:layer bytes,}
+	'''
+	import json, hashlib
+	routes = {}
+	for image, layer_list in images.items():
+		repo, tag = image.split(':')
+		layers = []
+		for layer in layer_list:
+			digest = 'sha256:'+hashlib.sha256(layer).hexdigest()
+			blobs[digest] = layer
+			routes['/v2/%s/blobs/%s'%(repo, digest)] = (200, {}, layer)
+			layers.append({'mediaType':'application/vnd.oci.image.layer.v1.tar+gzip', 'digest':digest, 'size':len(layer)})
+		config = json.dumps({'architecture':'amd64', 'os':'linux', 'rootfs':{'type':'layers', 'diff_ids':[]}}).encode()
+		config_digest = 'sha256:'+hashlib.sha256(config).hexdigest()
+		blobs[config_digest] = config
+		routes['/v2/%s/blobs/%s'%(repo, config_digest)] = (200, {}, config)
+		manifest = json.dumps({'schemaVersion':2, 'mediaType':'application/vnd.oci.image.manifest.v1+json', \
+			'config':{'mediaType':'application/vnd.oci.image.config.v1+json', 'digest':config_digest, 'size':len(config)}, \
+			'layers':layers}).encode()
+		digest = 'sha256:'+hashlib.sha256(manifest).hexdigest()
+		headers = {'Docker-Content-Digest':digest, 'Content-Type':'application/vnd.oci.image.manifest.v1+json'}
+		routes['/v2/%s/manifests/%s'%(repo, tag)] = (200, headers, manifest)
+		routes['/v2/%s/manifests/%s'%(repo, digest)] = (200, headers, manifest)
+	return routes
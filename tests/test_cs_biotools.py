@@ -0,0 +1,48 @@
+import pytest, logging, os, shutil, tempfile, json
+
+from rgc.ContainerSystem.validate import validate
+from rgc.ContainerSystem.metadata import metadata
+from helpers import local_server
+
+tools = [{'biotoolsID':'bwa', 'name':'BWA', 'toolType':['Command-line tool'], \
+		'topic':[{'term':'Mapping'}, {'term':'N/A'}], 'function':[{'operation':[{'term':'Read mapping'}]}], \
+		'description':'Fast aligner', 'homepage':'http://bio-bwa.sourceforge.net'}, \
+	{'biotoolsID':'htslib', 'name':'htslib', 'toolType':['Library'], 'topic':[], 'function':[], 'description':'lib'}]
+
+def test_loadBiotools_dump():
+	cache_dir = tempfile.mkdtemp()
+	dump = os.path.join(cache_dir, 'dump.json')
+	with open(dump, 'w') as OF: json.dump(tools, OF)
+	m = metadata()
+	m.cache_dir = cache_dir
+	m.loadBiotools(dump)
+	m._getMetadata('quay.io/biocontainers/bwa:0.7.3a--hed695b0_5')
+	url = 'quay.io/biocontainers/bwa:0.7.3a--hed695b0_5'
+	assert m.categories[url] == ['Read mapping']
+	assert m.keywords[url] == ['Mapping']
+	assert m.description[url] == 'Fast aligner'
+	assert m.homepage[url] == 'http://bio-bwa.sourceforge.net'
+	# The library filter is served from the cached index
+	v = validate()
+	v.cache_dir = cache_dir
+	v.loadBiotools()
+	v.validateURL('quay.io/biocontainers/htslib:1.9')
+	assert 'quay.io/biocontainers/htslib:1.9' in v.invalid
+	assert v.validation['quay.io/biocontainers/htslib:1.9'][1] == 'library'
+	shutil.rmtree(cache_dir)
+
+def test_loadBiotools_api():
+	def page(handler):
+		p = int(handler.path.split('page=')[1])
+		return (200, {}, json.dumps({'count':2, 'list':[tools[p-1]]}))
+	cache_dir = tempfile.mkdtemp()
+	with local_server({'/api/tool/':page}) as srv:
+		v = validate()
+		v.cache_dir = cache_dir
+		v.biotools_api = srv.url+'/api/tool/'
+		v.loadBiotools()
+	assert sorted(v.biotools_index) == ['bwa', 'htslib']
+	assert v._biotoolsTool('BWA')[0] == ('Command-line tool',)
+	assert v._biotoolsTool('samtools') is None
+	assert len(srv.requests) == 2
+	shutil.rmtree(cache_dir)
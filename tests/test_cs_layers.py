@@ -0,0 +1,134 @@
+import pytest, logging, os, tempfile, shutil, hashlib
+
+from helpers import local_server, registry_routes
+from rgc.ContainerSystem.layers import layers
+
+images = {'gzynda/a:1':[b'b'*3000, b'm'*1000, b'a'*500], 'gzynda/b:1':[b'b'*3000, b'm'*1000, b'x'*800], \
+	'gzynda/c:1':[b'b'*3000, b'c'*100]}
+
+def test__sharedLayers():
+	cache_dir = tempfile.mkdtemp()
+	blobs = {}
+	with local_server(registry_routes(images, blobs)) as srv:
+		l = layers()
+		l.cache_dir = cache_dir
+		l.registry_api = {'dockerhub':srv.url}
+		l.pull_limited = ()
+		shared = l._sharedLayers(sorted(images), 1)
+		assert [blobs[d] for d, url in shared] == [b'b'*3000]
+		shared = l._sharedLayers(sorted(images), 5)
+		assert [blobs[d] for d, url in shared] == [b'b'*3000, b'm'*1000]
+		assert shared[1][1] in ('gzynda/a:1', 'gzynda/b:1')
+		l._saveLayers()
+		n_first = len(srv.requests)
+		# Known digests reuse the stored layers, so later runs only send HEAD requests
+		l = layers()
+		l.cache_dir = cache_dir
+		l.registry_api = {'dockerhub':srv.url}
+		l.pull_limited = ()
+		l._loadLayers()
+		assert len(l._sharedLayers(sorted(images), 5)) == 2
+	methods = [r[0] for r in srv.requests]
+	assert n_first == 6
+	assert methods[n_first:] == ['HEAD']*3
+	shutil.rmtree(cache_dir)
+
+def test__resolveLayers_limited():
+	blobs = {}
+	with local_server(registry_routes(images, blobs)) as srv:
+		l = layers()
+		l.registry_api = {'dockerhub':srv.url}
+		# Manifest GETs would count against the Docker Hub pull limit
+		assert not any(r.result for r in l._resolveLayers(sorted(images)))
+		assert set(r[0] for r in srv.requests) == {'HEAD'}
+		# A mirror has no pull limit, but the number of new manifests is capped
+		l.registry_mirror = srv.url
+		l.manifest_lookups = 2
+		results = l._resolveLayers(sorted(images))
+	assert sum(1 for r in results if r.result) == 2
+	assert len(l.image_layers) == 2
+
+def test__fetchBlob():
+	blob_dir = tempfile.mkdtemp()
+	blobs = {}
+	routes = registry_routes(images, blobs)
+	digest = [d for d in blobs if blobs[d] == b'a'*500][0]
+	bad = 'sha256:'+'0'*64
+	routes['/v2/gzynda/a/blobs/%s'%(bad)] = (200, {}, b'corrupt')
+	with local_server(routes) as srv:
+		l = layers()
+		l.registry_api = {'dockerhub':srv.url}
+		l.parseURL('gzynda/a:1')
+		path = l._fetchBlob('gzynda/a:1', digest, blob_dir)
+		assert path == os.path.join(blob_dir, 'sha256', digest.split(':')[1])
+		with open(path, 'rb') as IF: assert IF.read() == b'a'*500
+		assert l._fetchBlob('gzynda/a:1', digest, blob_dir) == path
+		with pytest.raises(ValueError):
+			l._fetchBlob('gzynda/a:1', bad, blob_dir)
+	# A corrupt blob is downloaded again from the start before giving up
+	assert len(srv.requests) == 1+l.blob_retries
+	assert 'Range' not in srv.requests[-1][2]
+	assert os.listdir(os.path.join(blob_dir, 'sha256')) == [digest.split(':')[1]]
+	shutil.rmtree(blob_dir)
+
+def test__fetchBlob_resume():
+	blob_dir = os.path.join(tempfile.mkdtemp(), 'blobs')
+	blob = os.urandom(10000)
+	digest = 'sha256:'+hashlib.sha256(blob).hexdigest()
+	ranged = [True]
+	def serve(handler):
+		first = int(handler.headers.get('Range', 'bytes=0-')[6:-1])
+		if first and ranged[0]:
+			return (206, {'Content-Range':'bytes %i-%i/%i'%(first, len(blob)-1, len(blob))}, blob[first:])
+		return (200, {}, blob)
+	with local_server({'/v2/gzynda/a/blobs/%s'%(digest):serve}) as srv:
+		l = layers()
+		l.registry_api = {'dockerhub':srv.url}
+		l.parseURL('gzynda/a:1')
+		# An interrupted download is resumed after the bytes already written
+		partial = os.path.join(os.path.dirname(blob_dir), 'partial', digest.split(':')[1])
+		os.makedirs(os.path.dirname(partial))
+		with open(partial, 'wb') as OF: OF.write(blob[:4000])
+		path = l._fetchBlob('gzynda/a:1', digest, blob_dir)
+		with open(path, 'rb') as IF: assert IF.read() == blob
+		assert srv.requests[-1][2].get('Range') == 'bytes=4000-'
+		assert not os.path.exists(partial)
+		# Registries that ignore Range replace the partial file
+		os.remove(path)
+		ranged[0] = False
+		with open(partial, 'wb') as OF: OF.write(blob[:4000])
+		path = l._fetchBlob('gzynda/a:1', digest, blob_dir)
+		with open(path, 'rb') as IF: assert IF.read() == blob
+	assert len(srv.requests) == 2
+	shutil.rmtree(os.path.dirname(blob_dir))
+
+def test__downloadImage():
+	from threading import Lock
+	from time import sleep
+	blob_dir = os.path.join(tempfile.mkdtemp(), 'blobs')
+	blobs = {}
+	routes = registry_routes({'gzynda/big:1':[os.urandom(2000) for i in range(6)]}, blobs)
+	active, peak, lock = [0], [0], Lock()
+	def slow(route):
+		def serve(handler):
+			with lock:
+				active[0] += 1
+				peak[0] = max(peak[0], active[0])
+			sleep(0.1)
+			with lock: active[0] -= 1
+			return route
+		return serve
+	for path in routes:
+		if '/blobs/' in path: routes[path] = slow(routes[path])
+	with local_server(routes) as srv:
+		l = layers()
+		l.registry_api = {'dockerhub':srv.url}
+		digest, media_type, body = l._downloadImage('gzynda/big:1', blob_dir)
+	assert media_type == 'application/vnd.oci.image.manifest.v1+json'
+	assert digest == 'sha256:'+hashlib.sha256(body).hexdigest()
+	stored = set('sha256:'+d for d in os.listdir(os.path.join(blob_dir, 'sha256')))
+	assert stored == set(blobs) | set([digest])
+	# Layers are downloaded in parallel
+	assert 1 < peak[0] <= l.layer_threads
+	assert len(l.image_layers[l.digest['gzynda/big:1']]) == 6
+	shutil.rmtree(os.path.dirname(blob_dir))
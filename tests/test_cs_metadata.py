@@ -14,3 +14,27 @@ def test__getMetadata(url, md):
 	assert ms.keywords[url] == md['keywords']
 	assert ms.description[url] == md['description']
 	assert ms.homepage[url] == md['homepage']
+
+def test__getMetadata_hedged():
+	from helpers import local_server
+	from time import time, sleep
+	def slow(status, body):
+		def route(handler):
+			sleep(0.3)
+			return (status, {}, body)
+		return route
+	routes = {'/biotools/bears':slow(404, '{}'), \
+		'/launchpad/bears':slow(200, '{"description":"Bears", "homepage_url":"http://bears"}')}
+	with local_server(routes) as srv:
+		ms = metadata()
+		ms.cache_dir = False
+		ms.biotools_api = srv.url+'/biotools/'
+		ms.launchpad_api = srv.url+'/launchpad/'
+		start = time()
+		ms._getMetadata('quay.io/biocontainers/bears:latest')
+		elapsed = time()-start
+	url = 'quay.io/biocontainers/bears:latest'
+	assert ms.description[url] == 'Bears'
+	assert ms.homepage[url] == 'http://bears'
+	assert ms.categories[url] == ['Unknown']
+	assert elapsed < 0.55
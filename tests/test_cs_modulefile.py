@@ -99,3 +99,22 @@ def test_curl_tracker_url_same():
 	for purl in (p0,p1):
 		assert '${{SLURM_JOB_ID}}' in purl
 		assert '{application}' in purl
+
+def test_genModFiles_prereqs(caplog):
+	ms = test_genModFiles_prereqs.ms
+	ms.system = 'singularity3'
+	for url in urls:
+		ms.parseURL(url)
+		ms.images[url] = os.path.join(ms.containerDir, '%s.sif'%(ms.name[url]))
+		ms.programs[url] = {'ls', ms.name[url]}
+		ms.categories[url], ms.keywords[url] = ['Unknown'], ['Container']
+		ms.description[url], ms.homepage[url] = 'desc', ms.full_url[url]
+	ms.genModFiles(contact_url='ctr')
+	plain_text = {}
+	for url in urls:
+		with open(ms._moduleFile(url)) as MF: plain_text[url] = MF.read()
+	ms.genModFiles(contact_url='ctr', force=True, lmod_prereqs=['one'])
+	for url in urls:
+		with open(ms._moduleFile(url)) as MF: text = MF.read()
+		assert text.startswith(plain_text[url])
+		assert 'prereq("one")' in text
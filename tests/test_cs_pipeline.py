@@ -0,0 +1,125 @@
+import pytest, logging, os, shutil, tempfile
+from collections import Counter
+
+from helpers import del_cache_dir
+from rgc.ContainerSystem.pipeline import pipeline
+from rgc.ContainerSystem.system import system
+
+def make_pipeline(monkeypatch):
+	monkeypatch.setattr(system, '_detectSystem', lambda self, target='': 'docker')
+	ps = pipeline()
+	ps.cache_dir = tempfile.mkdtemp()
+	ps.moduleDir = tempfile.mkdtemp()
+	ps.containerDir = tempfile.mkdtemp()
+	# Image sizes are not looked up in the registry
+	monkeypatch.setattr(ps, '_imageLayers', lambda url, fetch=True: ())
+	return ps
+
+def cleanup(ps):
+	for d in (ps.cache_dir, ps.moduleDir, ps.containerDir):
+		del_cache_dir(d)
+
+url_list = ['quay.io/biocontainers/bwa:0.7.3a--hed695b0_5',\
+	'quay.io/biocontainers/bears:latest',\
+	'quay.io/biocontainers/samtools:1.11--h6270b1f_0']
+programs = {url_list[0]:{'bwa','ls','cat'}, url_list[2]:{'samtools','ls','cat'}}
+
+def test_pipelineAll_stream(monkeypatch, caplog):
+	caplog.set_level(logging.INFO)
+	ps = make_pipeline(monkeypatch)
+	def validateURL(url, include_libs=False):
+		if url in programs:
+			ps.valid.add(url)
+		else:
+			ps.invalid.add(url)
+	def pull(url, metadata=True):
+		ps.parseURL(url)
+		ps.images[url] = url
+		return True
+	def getMetadata(url):
+		for d in (ps.categories, ps.keywords): d[url] = ['Unknown']
+		ps.description[url] = 'desc'
+		ps.homepage[url] = False
+	def scanPrograms(url, force=False):
+		ps.programs[url] = set(programs[url])
+		ps.program_count += Counter(programs[url])
+		return True
+	monkeypatch.setattr(ps, 'validateURL', validateURL)
+	monkeypatch.setattr(ps, 'pull', pull)
+	monkeypatch.setattr(ps, '_getMetadata', getMetadata)
+	monkeypatch.setattr(ps, 'scanPrograms', scanPrograms)
+	ps.pipelineAll(iter(url_list), p=100)
+	for url in url_list:
+		mFile = ps._moduleFile(url) if url in ps.name else ''
+		if url in programs:
+			assert os.path.exists(mFile)
+			with open(mFile) as IF: text = IF.read()
+			# ls and cat are in every image and excluded after reconciliation
+			assert '"ls"' not in text
+			assert ps.homepage[url] == ps.full_url[url]
+		else:
+			assert url in ps.invalid
+			assert url not in ps.images
+	assert "Regenerating 2 of 2 new modulefiles" in caplog.text
+	for f in ('valid.pkl', 'metadata.pkl', 'programs.pkl'):
+		assert os.path.exists(os.path.join(ps.cache_dir, f))
+	cleanup(ps)
+
+@pytest.mark.docker
+@pytest.mark.slow
+def test_pipelineAll():
+	from rgc.ContainerSystem import ContainerSystem
+	cs = ContainerSystem(cache_dir=tempfile.mkdtemp())
+	cs.moduleDir = tempfile.mkdtemp()
+	cs.containerDir = tempfile.mkdtemp()
+	cs.pipelineAll(url_list)
+	for url, valid in zip(url_list, (1,0,1)):
+		if valid:
+			assert os.path.exists(cs._moduleFile(url))
+		else:
+			assert url not in cs.images
+	cleanup(cs)
+
+def test_main_saves_invalid(monkeypatch):
+	import sys, pickle
+	import rgc
+	from rgc.ContainerSystem import ContainerSystem
+	monkeypatch.setattr(system, '_detectSystem', lambda self, target='': 'docker')
+	dirs = [tempfile.mkdtemp() for i in range(3)]
+	failed = {url_list[1]:'pull failed', url_list[2]:'no programs'}
+	def validateURL(self, url, include_libs=False):
+		self.parseURL(url)
+		self.valid.add(url)
+	def pull(self, url, metadata=True):
+		if failed.get(url) == 'pull failed':
+			self._markInvalid(url, 'pull failed')
+			return False
+		self.images[url] = url
+		return True
+	def scanPrograms(self, url, force=False):
+		if failed.get(url) == 'no programs':
+			self._markInvalid(url, 'no programs')
+			return False
+		self.programs[url] = {'ls'}
+		self.program_count += Counter(['ls'])
+		return True
+	monkeypatch.setattr(ContainerSystem, 'validateURL', validateURL)
+	monkeypatch.setattr(ContainerSystem, 'pull', pull)
+	monkeypatch.setattr(ContainerSystem, 'scanPrograms', scanPrograms)
+	def getMetadata(self, url):
+		for d in (self.categories, self.keywords): d[url] = ['Unknown']
+		self.description[url] = 'desc'
+		self.homepage[url] = False
+	monkeypatch.setattr(ContainerSystem, '_getMetadata', getMetadata)
+	monkeypatch.setattr(ContainerSystem, '_imageLayers', lambda self, url, fetch=True: ())
+	monkeypatch.setattr(ContainerSystem, 'deleteImage', lambda self, url: self.images.pop(url, None))
+	monkeypatch.setattr(sys, 'argv', ['rgc', '--cachedir', dirs[0], '-M', dirs[1], '-I', dirs[2]]+url_list)
+	rgc.main()
+	# Failures recorded after validation are written to valid.pkl
+	with open(os.path.join(dirs[0], 'valid.pkl'), 'rb') as IF:
+		invalid, valid, validation = pickle.load(IF)
+	for url, reason in failed.items():
+		assert url in invalid
+		assert validation[url][1] == reason
+	assert url_list[0] in valid
+	for d in dirs: del_cache_dir(d)
@@ -1,10 +1,12 @@
-import pytest, logging, os, shutil, tempfile
+import pytest, logging, os, sys, shutil, tempfile, tarfile
+from glob import glob
 from itertools import product
 import subprocess as sp
-from time import time
+from time import time, sleep
 
 from helpers import del_cache_dir, tmp_file
 from rgc.ContainerSystem.pull import pull
+from rgc.ThreadQueue import ThreadQueue
 from rgc.helpers import translate, remove_empty_sub_directories
 
 default_dir = os.path.join(os.path.expanduser('~'),'rgc_cache')
@@ -27,14 +29,13 @@ def teardown_function(function):
 def test_sing_cache(caplog):
 	ps = test_sing_cache.ps
 	ps.system = 'singularity3'
-	ps.cache_docker_images = ['quay.io/biocontainers/bwa:0.7.17--hed695b0_7','quay.io/biocontainers/bwa:0.7.3a--hed695b0_5']
+	caplog.set_level(logging.INFO)
+	urls = ['quay.io/biocontainers/bwa:0.7.17--hed695b0_7','quay.io/biocontainers/bwa:0.7.3a--hed695b0_5']
 	assert not ps.layer_cache
-	ps._makeSingularityCache()
-	assert "tar" in ps.layer_cache
-	assert os.path.exists(ps.layer_cache)
-	#print(os.stat(ps.layer_cache).st_size)
-	assert not os.path.exists(os.path.join(ps.cache_dir,'scache'))
-	assert "Creating the base layer cache." in caplog.text
+	ps._makeSingularityCache(urls)
+	assert ps.layer_cache == os.path.join(ps.cache_dir, 'scache')
+	assert glob(os.path.join(ps.layer_cache, 'cache', 'blob', 'blobs', 'sha256', '*'))
+	assert "Creating the base layer cache" in caplog.text
 
 @pytest.mark.dockerhub
 @pytest.mark.singularity
@@ -52,7 +53,6 @@ def test_sing_cache_speed(caplog):
 	time_start_no_cache = time()
 	ps._pullSingularity(url, img_dir, simg)
 	time_no_cache = time()-time_start_no_cache
-	assert "Extracting" not in caplog.text
 	assert os.path.exists(img_out)
 	os.remove(img_out)
 	caplog.clear()
@@ -62,12 +62,12 @@ def test_sing_cache_speed(caplog):
 		ps._makeSingularityCache()
 		assert "Using found layer" in caplog.text
 	else:
-		ps._makeSingularityCache()
-		shutil.copyfile(ps.layer_cache, restorable_cache)
+		ps._makeSingularityCache([url])
+		with tarfile.open(restorable_cache, 'w') as TF:
+			TF.add(os.path.join(ps.layer_cache, 'cache'), arcname='cache')
 	time_start_cache = time()
 	ps._pullSingularity(url, img_dir, simg)
 	time_cache = time()-time_start_cache
-	assert "Extracting" in caplog.text
 	assert os.path.exists(img_out)
 	os.remove(img_out)
 	print("No cache: %.1f seconds\nWith Cache: %.1f seconds"%(time_no_cache, time_cache))
@@ -81,11 +81,11 @@ def test__pullSingularity(caplog):
 	url = 'quay.io/biocontainers/bwa:0.7.3a--hed695b0_5'
 	img_out, img_dir, simg = tmp_file(split=True)
 	ps.parseURL(url)
-	ret = ps._pullSingularity(url, img_dir, simg, cache_dir=False, clean=True, keep_img=True)
+	ret = ps._pullSingularity(url, img_dir, simg, keep_img=True)
 	assert os.path.exists(img_out)
 	assert ret == img_out
 	os.remove(img_out)
-	ret = ps._pullSingularity(url, img_dir, simg, cache_dir=False, clean=True, keep_img=False)
+	ret = ps._pullSingularity(url, img_dir, simg, keep_img=False)
 	assert not os.path.exists(img_out)
 
 @pytest.mark.docker
@@ -185,15 +185,55 @@ def test_pullAll(caplog):
 	assert not os.path.exists(os.path.join(ps.containerDir, 'bears'))
 
 def test_sing_cache_exists(caplog):
+	caplog.set_level(logging.INFO)
 	ps = test_sing_cache_exists.ps
 	cache_file = os.path.join(ps.cache_dir, 'scache.tar')
 	assert not os.path.exists(cache_file)
-	open(cache_file,'w').close()
+	# Tarballs from older versions are imported into the shared cache once
+	layer = os.path.join(tempfile.mkdtemp(), 'cache', 'blob', 'layer')
+	os.makedirs(os.path.dirname(layer))
+	open(layer,'w').close()
+	with tarfile.open(cache_file, 'w') as TF:
+		TF.add(os.path.dirname(os.path.dirname(layer)), arcname='cache')
 	ps._makeSingularityCache()
+	assert "Importing layer cache" in caplog.text
 	assert "Using found layer cache" in caplog.text
+	assert ps.layer_cache == os.path.join(ps.cache_dir, 'scache')
+	assert os.path.exists(os.path.join(ps.layer_cache, 'cache', 'blob', 'layer'))
+	assert not os.path.exists(cache_file)
 	caplog.clear()
 	ps._makeSingularityCache()
 	assert "Using existing layer cache" in caplog.text
+	assert "Creating the base layer cache" not in caplog.text
+	del_cache_dir(os.path.dirname(os.path.dirname(os.path.dirname(layer))))
+
+def test__pullSingularity_shared_cache(monkeypatch):
+	ps = test__pullSingularity_shared_cache.ps
+	ps.system = 'singularity3'
+	ps.native_pull = False
+	url = 'biocontainers/bwa:v0.7.17_cv1'
+	ps.parseURL(url)
+	img_out, img_dir, simg = tmp_file(split=True)
+	cmds = []
+	def fake_retry(cmd, url, **kwargs):
+		cmds.append(cmd)
+		open(img_out,'w').close()
+		return True
+	monkeypatch.setattr(sys.modules[pull.__module__], 'retry_call', fake_retry)
+	assert ps._pullSingularity(url, img_dir, simg) == img_out
+	assert ps._pullSingularity(url, img_dir, simg) == img_out
+	# Every pull uses the same persistent cache without extracting anything
+	cache_folder = os.path.join(ps.cache_dir, 'scache')
+	assert all(cmd.startswith('SINGULARITY_CACHEDIR=%s '%(cache_folder)) for cmd in cmds)
+	assert len(cmds) == 2
+	assert os.path.exists(cache_folder)
+	# Pruning drops image copies but keeps layers
+	for sub in ('oci-tmp/abc', 'blob/layer'):
+		os.makedirs(os.path.join(cache_folder, 'cache', sub))
+	ps._pruneSingularityCache()
+	assert not os.path.exists(os.path.join(cache_folder, 'cache', 'oci-tmp', 'abc'))
+	assert os.path.exists(os.path.join(cache_folder, 'cache', 'blob', 'layer'))
+	os.remove(img_out)
 
 def test__pullWarn(caplog):
 	ps = test__pullWarn.ps
@@ -222,3 +262,248 @@ def test_remove_empty_sub_directories():
 	remove_empty_sub_directories(cd)
 	found_list = sorted((os.path.join(p,f) for p,dl,fl in os.walk(cd) for f in fl))
 	assert known_list == found_list
+
+def test__expectedTime(monkeypatch):
+	ps = test__expectedTime.ps
+	# Priorities are computed while queueing, so they must not send requests
+	def request(*args, **kwargs): raise AssertionError("request sent")
+	monkeypatch.setattr(ps, '_registryRequest', request)
+	ps.pull_time = {'a':10.0}
+	ps.image_size = {'a':100, 'b':50}
+	assert ps._expectedPullTime('a') == 10.0
+	assert ps._expectedPullTime('b') == 5.0
+	ps.tag_size[('dockerhub','org','c')] = {'1':200}
+	assert ps._expectedPullTime('org/c:1') == 20.0
+	assert ps._expectedPullTime('org/d:1') == 0
+	# The cached rate is refreshed once another duration is recorded
+	ps._recordTime('pull', 'e', 30.0, 100)
+	assert ps._expectedPullTime('b') == 10.0
+	# Images validated with a manifest HEAD fall back to their layer sizes
+	ps.digest['org/f:1'] = 'sha256:f'
+	ps.image_layers['sha256:f'] = (('sha256:l1', 150), ('sha256:l2', 50))
+	assert ps._expectedPullTime('org/f:1') == 40.0
+	# Without recorded durations the default rate is used
+	assert ps._expectedScanTime('b') == 50/ps.default_rate
+	# The cached rates are dropped when the durations are reloaded
+	ps.transfer_rate['pull'] = 1.0
+	ps._loadDurations()
+	assert ps.transfer_rate == {}
+
+def test__pullImage_digest(monkeypatch):
+	ps = test__pullImage_digest.ps
+	ps.system = 'singularity3'
+	pulled = []
+	def pullSingularity(url, img_dir, simg):
+		sleep(0.1)
+		pulled.append(url)
+		img_out = os.path.join(img_dir, simg)
+		with open(img_out, 'w') as OF: OF.write(url)
+		return img_out
+	monkeypatch.setattr(ps, '_pullSingularity', pullSingularity)
+	urls = ['quay.io/biocontainers/bwa:0.7.17--h84994c4_5', 'quay.io/biocontainers/bwa:0.7.17--hed695b0_6', \
+		'quay.io/biocontainers/bwa:0.7.16--0']
+	for url in urls: ps.parseURL(url)
+	ps.digest[urls[0]] = ps.digest[urls[1]] = 'sha256:aaa'
+	ps.digest[urls[2]] = 'sha256:bbb'
+	ps.valid.update(urls)
+	tq = ThreadQueue(target=ps._pullImage, n_threads=3)
+	tq.process_list(urls)
+	tq.join()
+	assert len(pulled) == 2
+	assert os.path.samefile(ps.images[urls[0]], ps.images[urls[1]])
+	assert ps.images[urls[0]] != ps.images[urls[1]]
+	assert not os.path.samefile(ps.images[urls[0]], ps.images[urls[2]])
+
+def test__pullImage_digest_failed(monkeypatch):
+	ps = test__pullImage_digest_failed.ps
+	ps.system = 'singularity3'
+	def pullSingularity(url, img_dir, simg):
+		sleep(0.1)
+		ps._pullError(url)
+		return False
+	monkeypatch.setattr(ps, '_pullSingularity', pullSingularity)
+	urls = ['quay.io/biocontainers/bwa:0.7.17--h84994c4_5', 'quay.io/biocontainers/bwa:0.7.17--hed695b0_6']
+	for url in urls: ps.parseURL(url)
+	ps.digest[urls[0]] = ps.digest[urls[1]] = 'sha256:aaa'
+	ps.valid.update(urls)
+	tq = ThreadQueue(target=ps._pullImage, n_threads=2)
+	tq.process_list(urls)
+	tq.join()
+	# Tags that waited on the failed pull are invalid too
+	assert ps.invalid == set(urls)
+	assert not ps.valid
+	assert ps.validation[urls[1]][1] == 'pull failed'
+
+def test__pullImage_digest_cached(monkeypatch):
+	ps = test__pullImage_digest_cached.ps
+	ps.system = 'singularity3'
+	monkeypatch.setattr(ps, '_pullSingularity', lambda url, img_dir, simg: False)
+	old, new = 'quay.io/biocontainers/bwa:0.7.17--h84994c4_5', 'quay.io/biocontainers/bwa:0.7.17--hed695b0_6'
+	for url in (old, new): ps.parseURL(url)
+	# An image pulled by an earlier run is recorded when it is found
+	img_dir = os.path.join(ps.containerDir, 'bwa')
+	os.makedirs(img_dir)
+	with open(os.path.join(img_dir, 'bwa-0.7.17--h84994c4_5.sif'), 'w') as OF: OF.write('old')
+	ps.digest[old] = 'sha256:aaa'
+	ps._pullImage(old)
+	ps._saveLayers()
+	# The next run links a new tag with the same digest instead of pulling it
+	ps2 = pull()
+	ps2.system, ps2.cache_dir, ps2.containerDir = 'singularity3', ps.cache_dir, ps.containerDir
+	monkeypatch.setattr(ps2, '_pullSingularity', lambda url, img_dir, simg: False)
+	ps2._loadLayers()
+	ps2.parseURL(new)
+	ps2.digest[new] = 'sha256:aaa'
+	assert ps2._pullImage(new)
+	with open(ps2.images[new]) as IF: assert IF.read() == 'old'
+
+def test__warmLayerCache():
+	from helpers import local_server, registry_routes
+	ps = test__warmLayerCache.ps
+	ps.system = 'singularity3'
+	blobs = {}
+	images = {'gzynda/a:1':[b'b'*3000, b'a'*10], 'gzynda/b:1':[b'b'*3000, b'x'*10]}
+	with local_server(registry_routes(images, blobs)) as srv:
+		ps.registry_api = {'dockerhub':srv.url}
+		ps.pull_limited = ()
+		ps._makeSingularityCache(sorted(images))
+	oci_dir = os.path.join(ps.cache_dir, 'scache', 'cache', 'blob')
+	cached = os.listdir(os.path.join(oci_dir, 'blobs', 'sha256'))
+	assert [blobs['sha256:'+d] for d in cached] == [b'b'*3000]
+	assert os.path.exists(os.path.join(oci_dir, 'oci-layout'))
+
+def test__pruneSingularityCache():
+	ps = test__pruneSingularityCache.ps
+	ps.system = 'singularity3'
+	ps.force_cache = True
+	ps._makeSingularityCache()
+	blob_dir = os.path.join(ps.layer_cache, 'cache', 'blob', 'blobs', 'sha256')
+	os.makedirs(blob_dir)
+	os.makedirs(os.path.join(ps.layer_cache, 'cache', 'oci-tmp', 'abc'))
+	for i, name in enumerate(('old', 'new', 'untracked', 'pulled')):
+		with open(os.path.join(blob_dir, name), 'wb') as OF: OF.write(b'0'*100)
+		os.utime(os.path.join(blob_dir, name), (1000+i, 1000+i))
+	ps.layer_used = {'sha256:old':10, 'sha256:new':time()}
+	# Pulling a digest marks its layers as used
+	ps.image_layers = {'sha256:img':(('sha256:pulled', 100),)}
+	ps._touchLayers('sha256:img')
+	# Abandoned partial downloads are evicted, while ones still being resumed are kept
+	partial_dir = os.path.join(ps.layer_cache, 'cache', 'blob', 'partial')
+	os.makedirs(partial_dir)
+	for name in ('stale', 'stale.lock', 'active', 'active.lock'):
+		open(os.path.join(partial_dir, name), 'w').close()
+	for name in ('stale', 'stale.lock', 'active.lock'):
+		os.utime(os.path.join(partial_dir, name), (1000, 1000))
+	ps.layer_cache_size = 250
+	ps._pruneSingularityCache()
+	assert sorted(os.listdir(blob_dir)) == ['new', 'pulled']
+	assert sorted(os.listdir(partial_dir)) == ['active', 'active.lock']
+	assert not os.listdir(os.path.join(ps.layer_cache, 'cache', 'oci-tmp'))
+	# Forcing the cache keeps cached layers, and usage is remembered across runs
+	ps2 = pull()
+	ps2.cache_dir = ps.cache_dir
+	ps2.force_cache = True
+	ps2._makeSingularityCache()
+	ps2.layer_cache_size = 100
+	ps2._pruneSingularityCache()
+	assert os.listdir(blob_dir) == ['pulled']
+
+def test_pullAll_docker(monkeypatch):
+	from threading import Lock
+	ps = test_pullAll_docker.ps
+	ps.system = 'docker'
+	ps.n_threads = 8
+	ps.docker_config = os.path.join(ps.cache_dir, 'daemon.json')
+	with open(ps.docker_config, 'w') as OF: OF.write('{"max-concurrent-downloads": 3}')
+	assert ps._pullThreads() == 3
+	active, peak, lock = [0], [0], Lock()
+	def pull(url, metadata=True):
+		with lock:
+			active[0] += 1
+			peak[0] = max(peak[0], active[0])
+		sleep(0.1)
+		with lock: active[0] -= 1
+		ps.images[url] = url
+	monkeypatch.setattr(ps, 'pull', pull)
+	monkeypatch.setattr(ps, '_resolveMetadata', lambda url: None)
+	monkeypatch.setattr(ps, '_imageLayers', lambda url, fetch=True: ())
+	urls = ['gzynda/tool:%i'%(i) for i in range(9)]
+	start = time()
+	ps.pullAll(urls)
+	# Pulls run concurrently, but never more than the daemon downloads at once
+	assert peak[0] == 3
+	assert time()-start < 0.6
+	assert sorted(ps.images) == sorted(urls)
+	# The daemon default is used without a configuration file
+	ps.docker_config = os.path.join(ps.cache_dir, 'missing.json')
+	assert ps._pullThreads() == ps.docker_downloads
+
+def test__pullNative(monkeypatch, caplog):
+	import json
+	from helpers import local_server, registry_routes
+	ps = test__pullNative.ps
+	ps.system = 'singularity3'
+	blobs = {}
+	images = {'gzynda/a:1':[b'b'*3000, b'a'*10], 'gzynda/b:1':[b'b'*3000, b'x'*10]}
+	built, fallback = [], []
+	def fake_call(cmd, timeout=0):
+		layout = cmd.split(' oci:')[1].split(':')[0]
+		with open(os.path.join(layout, 'index.json')) as IF: index = json.load(IF)
+		manifest = index['manifests'][0]
+		with open(os.path.join(layout, 'blobs', 'sha256', manifest['digest'].split(':')[1]), 'rb') as IF:
+			layers = json.loads(IF.read().decode())['layers']
+		built.append([os.path.exists(os.path.join(layout, 'blobs', 'sha256', l['digest'].split(':')[1])) for l in layers])
+		if len(built) == 2: return 1
+		open(cmd.split(' build -F ')[1].split(' ')[0], 'w').close()
+		return 0
+	def fake_retry(cmd, url, **kwargs):
+		fallback.append(url)
+		open(cmd.split(' pull -F ')[1].split(' ')[0], 'w').close()
+		return True
+	monkeypatch.setattr(sys.modules[pull.__module__], 'call', fake_call)
+	monkeypatch.setattr(sys.modules[pull.__module__], 'retry_call', fake_retry)
+	with local_server(registry_routes(images, blobs)) as srv:
+		ps.registry_api = {'dockerhub':srv.url}
+		for url in sorted(images):
+			ps.parseURL(url)
+			img_out, img_dir, simg = tmp_file(split=True)
+			assert ps._pullSingularity(url, img_dir, simg) == img_out
+	# Images are built from verified local blobs, and the shared base layer is only downloaded once
+	assert built == [[True, True], [True, True]]
+	blob_paths = [r[1] for r in srv.requests if '/blobs/' in r[1]]
+	assert len(blob_paths) == len(set(blob_paths)) == 4
+	assert not os.listdir(os.path.join(ps.cache_dir, 'scache', 'layouts'))
+	# Images that singularity cannot build are pulled by singularity instead
+	assert fallback == ['gzynda/b:1']
+	assert "Pulling with singularity instead" in caplog.text
+
+def test_pull_limiter(monkeypatch):
+	ps = test_pull_limiter.ps
+	ps.system = 'docker'
+	url = 'gzynda/tool:1'
+	ps.parseURL(url)
+	# Validation creates the registry limiter, which counts slow requests as congestion
+	validation = ps._limiter('dockerhub')
+	assert validation.slow
+	monkeypatch.setattr(sys.modules[pull.__module__], 'call', lambda cmd, timeout=0: 0)
+	assert ps._pullDocker(url, ps.containerDir, 'tool-1.sif') == url
+	# Pulls are long, so they have their own limiter that never counts them as slow
+	assert ps.limiters['dockerhub/pull'].slow == 0
+	assert ps.limiters['dockerhub/pull'] is not validation
+	assert validation.limit == validation.max_limit
+
+def test__linkImage(monkeypatch):
+	ps = test__linkImage.ps
+	source = os.path.join(ps.containerDir, 'bwa', 'bwa-1.sif')
+	os.makedirs(os.path.dirname(source))
+	with open(source, 'w') as OF: OF.write('image')
+	os.chmod(source, 0o644)
+	# Images on another filesystem are copied
+	def link(src, dst): raise OSError(18, 'Invalid cross-device link')
+	monkeypatch.setattr(os, 'link', link)
+	img_out = ps._linkImage(source, os.path.join(ps.containerDir, 'bwa', 'bwa-2.sif'))
+	os.remove(source)
+	assert not os.path.islink(img_out)
+	with open(img_out) as IF: assert IF.read() == 'image'
+	assert os.stat(img_out).st_mode & 0o777 == 0o644
+	assert os.listdir(os.path.dirname(img_out)) == ['bwa-2.sif']
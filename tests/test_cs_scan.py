@@ -118,3 +118,34 @@ def test_findCommon_baseline(caplog):
 		ss.program_count += Counter(tp[url])
 	ss.findCommon(p=40, baseline=['bl'])
 	assert ss.block_set == {'1','2','3','time'}
+
+def test_scanPrograms_digest(monkeypatch):
+	ss = test_scanPrograms_digest.ss
+	ss.system = 'singularity3'
+	scanned = []
+	def listPrograms(url):
+		scanned.append(url)
+		return ['bwa', 'ls']
+	monkeypatch.setattr(ss, '_listPrograms', listPrograms)
+	a, b = 'quay.io/biocontainers/bwa:0.7.17--h84994c4_5', 'quay.io/biocontainers/bwa:0.7.17--hed695b0_6'
+	for url in (a, b):
+		ss.parseURL(url)
+		ss.images[url] = url
+		ss.digest[url] = 'sha256:aaa'
+		ss.valid.add(url)
+	assert ss.scanPrograms(a) and ss.scanPrograms(b)
+	assert scanned == [a]
+	assert ss.programs[a] == ss.programs[b] == set(['bwa', 'ls'])
+	assert ss.program_count['bwa'] == 2
+
+def test_scanPrograms_none(monkeypatch):
+	ss = test_scanPrograms_none.ss
+	ss.system = 'singularity3'
+	url = 'quay.io/biocontainers/empty:1'
+	monkeypatch.setattr(ss, '_listPrograms', lambda url: [])
+	ss.parseURL(url)
+	ss.images[url] = url
+	ss.valid.add(url)
+	assert not ss.scanPrograms(url)
+	assert url in ss.invalid
+	assert ss.validation[url][1] == 'no programs'
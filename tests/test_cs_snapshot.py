@@ -0,0 +1,32 @@
+import pytest, logging, os, shutil, tempfile
+
+from rgc.ContainerSystem.snapshot import snapshot
+from helpers import local_server
+
+def test_snapshot_offline():
+	tmp_dir = tempfile.mkdtemp()
+	snap_file = os.path.join(tmp_dir, 'snap.pkl')
+	online = snapshot()
+	online.tag_index[('quay', 'biocontainers', 'bwa')] = {'0.7.3':('', '', 10)}
+	online.tool_metadata['bwa'] = (['Read mapping'], ['Mapping'], 'Fast aligner', 'http://bwa')
+	online.biotools_index['htslib'] = (('Library',), (), (), 'lib', False)
+	online.exportSnapshot(snap_file)
+	with local_server({'/v2/biocontainers/bwa/manifests/0.7.4':(200, {'Docker-Content-Digest':'sha256:abc'}, '')}) as srv:
+		s = snapshot()
+		s.cache_dir = tmp_dir
+		s.loadSnapshot(snap_file)
+		for url in ('quay.io/biocontainers/bwa:0.7.3', 'quay.io/biocontainers/bwa:0.7.4', 'quay.io/biocontainers/htslib:1.9'):
+			s.validateURL(url)
+		assert s.valid == set(['quay.io/biocontainers/bwa:0.7.3'])
+		assert s.validation['quay.io/biocontainers/htslib:1.9'][1] == 'library'
+		# Tags missing from the snapshot are checked against the mirror
+		s = snapshot()
+		s.loadSnapshot(snap_file, mirror=srv.url)
+		s.validateURL('quay.io/biocontainers/bwa:0.7.4')
+		assert s.valid == set(['quay.io/biocontainers/bwa:0.7.4'])
+	assert len(srv.requests) == 1
+	s._getMetadata('quay.io/biocontainers/bwa:0.7.4')
+	s._getMetadata('quay.io/biocontainers/bears:1')
+	assert s.description['quay.io/biocontainers/bwa:0.7.4'] == 'Fast aligner'
+	assert s.description['quay.io/biocontainers/bears:1'] == 'The bears package'
+	shutil.rmtree(tmp_dir)
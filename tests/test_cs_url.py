@@ -1,4 +1,5 @@
 import pytest, logging
+from time import sleep
 
 from rgc.ContainerSystem.url import url_parser
 from rgc.helpers import translate, iterdict
@@ -78,3 +79,45 @@ def test_parseURL(url, san_url, name, tag, registry, full_url):
 		assert not v
 	assert u.known_registries
 	assert u.full_url_templates
+
+def test__getJSON():
+	from helpers import local_server
+	from rgc.ThreadQueue import ThreadQueue, AIMDLimiter
+	from rgc.HTTPPool import HTTPError
+	def slow_tool(handler):
+		sleep(0.2)
+		return (200, {}, '{"name":"tool"}')
+	u = url_parser()
+	u.limiters['local'] = AIMDLimiter('local', max_cooldown=0)
+	routes = {'/tool':slow_tool, '/busy':(429, {}, '{}')}
+	with local_server(routes) as srv:
+		tq = ThreadQueue(target=lambda url: u._getJSON(url, 'local'), n_threads=8)
+		results = tq.process_list([srv.url+'/tool']*8)
+		tq.join()
+		# Concurrent requests share the one in flight
+		assert all(r.ok and r.result == {'name':'tool'} for r in results)
+		assert len(srv.requests) == 1
+		# Only 404s are remembered
+		for i in range(2):
+			with pytest.raises(HTTPError):
+				u._getJSON(srv.url+'/missing', 'local')
+			with pytest.raises(HTTPError):
+				u._getJSON(srv.url+'/busy', 'local')
+	assert [path for method, path, headers in srv.requests].count('/missing') == 1
+	assert [path for method, path, headers in srv.requests].count('/busy') == 2
+
+def test_records():
+	from rgc.ContainerSystem.url import ImageRecord
+	u = url_parser()
+	a, b = "quay.io/biocontainers/samtools:1.11--h6270b1f_0", "quay.io/biocontainers/samtools:1.9--h91753b0_8"
+	for url in (a, b): u.parseURL(url)
+	assert isinstance(u.records[a], ImageRecord)
+	assert u.records[a].name == u.name[a] == 'samtools'
+	assert u.name[a] is u.name[b]
+	assert sorted(u.name) == sorted([a, b])
+	assert u.registry.get('missing', 'none') == 'none'
+	assert 'missing' not in u.tag
+	with pytest.raises(KeyError):
+		u.tag['missing']
+	del u.tag[a]
+	assert a not in u.tag and a in u.name
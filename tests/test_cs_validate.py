@@ -1,6 +1,7 @@
 import pytest, logging, os, shutil, tempfile
 
 from rgc.ContainerSystem.validate import validate
+from rgc.ThreadQueue import AIMDLimiter
 
 def test_registry_exclude():
 	v = validate()
@@ -84,3 +85,135 @@ def test_validateURLs(caplog):
 	for url in urls:
 		assert "Restored %s"%(url) in caplog.text
 	del_cache_dir()
+
+def test__manifestDigest():
+	from helpers import local_server
+	def manifest(handler):
+		if handler.headers.get('Authorization') != 'Bearer anon':
+			return (401, {'WWW-Authenticate':'Bearer realm="%s/token",service="registry",scope="repository:gzynda/tool:pull"'%(srv.url)}, '')
+		return (200, {'Docker-Content-Digest':'sha256:abc'}, '')
+	routes = {'/token':(200, {}, '{"token":"anon","expires_in":300}'),\
+		'/v2/gzynda/tool/manifests/1.0':manifest,\
+		'/v2/gzynda/tool/tags/list':(200, {}, '{}')}
+	with local_server(routes) as srv:
+		v = validate()
+		v.registry_api = {'dockerhub':srv.url}
+		v.validateURL('gzynda/tool:1.0', include_libs=True)
+		v.validateURL('gzynda/tool:2.0', include_libs=True)
+		v.validateURL('gzynda/tool:1.0', include_libs=True)
+	assert v.valid == set(['gzynda/tool:1.0'])
+	assert 'gzynda/tool:2.0' in v.invalid
+	assert v.digest['gzynda/tool:1.0'] == 'sha256:abc'
+	# One token for the repository, then a HEAD per check
+	paths = [r[1].split('?')[0] for r in srv.requests]
+	assert paths.count('/token') == 1
+	assert set(r[0] for r in srv.requests if 'manifests' in r[1]) == set(['HEAD'])
+
+def test__getTags_pages():
+	from helpers import local_server
+	import json
+	def page(handler):
+		query = dict(kv.split('=') for kv in handler.path.split('?')[1].split('&'))
+		p, size = int(query['page']), int(query.get('page_size', query.get('limit')))
+		names = ['t%i'%(i) for i in range(250)][(p-1)*size:p*size]
+		if 'quay' in handler.path:
+			return (200, {}, json.dumps({'tags':[{'name':n, 'size':1} for n in names], 'page':p, 'has_additional':p*size < 250}))
+		return (200, {}, json.dumps({'count':250, 'results':[{'name':n, 'full_size':1} for n in names]}))
+	with local_server({'/hub/gzynda/tool/':page, '/quay/gzynda/tool/':page}) as srv:
+		v = validate()
+		v.tag_query = {'dockerhub':srv.url+'/hub/%s/%s/', 'quay':srv.url+'/quay/%s/%s/'}
+		hub = v._getTags('gzynda/tool:t1')
+		quay = v._getTags('quay.io/gzynda/tool:t1')
+	assert hub == quay == set('t%i'%(i) for i in range(250))
+	assert len(srv.requests) == 6
+	assert v.tag_size[('quay','gzynda','tool')]['t249'] == 1
+
+def test_tag_index():
+	from helpers import local_server
+	import json
+	tags = [{'name':'t%i'%(i), 'last_updated':'2020-01-%02i'%(i%28+1), 'full_size':i} for i in range(250)]
+	def page(handler):
+		query = dict(kv.split('=') for kv in handler.path.split('?')[1].split('&'))
+		p, size = int(query['page']), int(query['page_size'])
+		ordered = sorted(tags, key=lambda t: t['last_updated'], reverse=True) if 'ordering' in query else tags
+		return (200, {}, json.dumps({'count':len(tags), 'next':p*size < len(tags) or None, 'results':ordered[(p-1)*size:p*size]}))
+	cache_dir = tempfile.mkdtemp()
+	with local_server({'/hub/gzynda/tool/':page}) as srv:
+		v = validate()
+		v.cache_dir = cache_dir
+		v.tag_query = {'dockerhub':srv.url+'/hub/%s/%s/'}
+		assert len(v._getTags('gzynda/tool:t1')) == 250
+		v._saveTagIndex()
+		n_full = len(srv.requests)
+		tags.append({'name':'new', 'last_updated':'2021-01-01', 'full_size':7})
+		v = validate()
+		v.cache_dir = cache_dir
+		v.tag_query = {'dockerhub':srv.url+'/hub/%s/%s/'}
+		v._loadTagIndex()
+		assert 'new' in v._getTags('gzynda/tool:t1')
+		assert v._registrySize('gzynda/tool:new') == 7
+	assert n_full == 3
+	assert len(srv.requests) == 4
+	shutil.rmtree(cache_dir)
+
+def test__loadValid():
+	from time import time
+	cache_dir = tempfile.mkdtemp()
+	v = validate()
+	v.cache_dir = cache_dir
+	v._markValid('gzynda/a:1')
+	v._markInvalid('gzynda/b:1', 'tag not found')
+	v._markInvalid('gzynda/c:1', 'rate limited')
+	v._markInvalid('gzynda/d:1', 'no tag')
+	v.validation['gzynda/c:1'] = (time()-7200, 'rate limited', 3600)
+	v.validation['gzynda/d:1'] = (0, 'no tag', None)
+	v._saveValid()
+	v = validate()
+	v.cache_dir = cache_dir
+	v._loadValid()
+	assert v.valid == set(['gzynda/a:1'])
+	assert v.invalid == set(['gzynda/b:1', 'gzynda/d:1'])
+	assert 'gzynda/c:1' not in v.validation
+	# Caches without records keep valid URLs and recheck invalid ones
+	v._cache_save('valid.pkl', (set(['gzynda/b:1']), set(['gzynda/a:1'])))
+	v._loadValid()
+	assert v.valid == set(['gzynda/a:1']) and not v.invalid
+	assert v.validation['gzynda/a:1'][1] == 'valid'
+	shutil.rmtree(cache_dir)
+
+def test__getTags_singleflight():
+	from helpers import local_server
+	from rgc.ThreadQueue import ThreadQueue
+	from time import sleep
+	def page(handler):
+		sleep(0.1)
+		return (200, {}, '{"tags":[{"name":"t1"},{"name":"t2"}],"has_additional":false}')
+	with local_server({'/quay/gzynda/tool/':page}) as srv:
+		v = validate()
+		v.tag_query = {'quay':srv.url+'/quay/%s/%s/'}
+		tq = ThreadQueue(target=v._getTags, n_threads=6)
+		results = tq.process_list(['quay.io/gzynda/tool:t%i'%(i) for i in range(6)])
+		tq.join()
+	assert all(r.result == set(['t1', 't2']) for r in results)
+	assert len(srv.requests) == 1
+
+def test_validateURL_transient():
+	from helpers import local_server
+	routes = {}
+	for repo, status in (('limited', 429), ('broken', 503), ('missing', 404)):
+		routes['/v2/gzynda/%s/manifests/1.0'%(repo)] = (status, {}, '{}')
+		routes['/hub/gzynda/%s/'%(repo)] = (status, {}, '{}')
+	with local_server(routes) as srv:
+		v = validate()
+		v.registry_api = {'dockerhub':srv.url}
+		v.tag_query = {'dockerhub':srv.url+'/hub/%s/%s/'}
+		# Skip the congestion cooldowns
+		v.limiters['dockerhub'] = AIMDLimiter('dockerhub', max_cooldown=0)
+		for repo in ('limited', 'broken', 'missing'):
+			v.validateURL('gzynda/%s:1.0'%(repo), include_libs=True)
+	# Only a missing repository or tag is recorded as a missing tag
+	assert v.validation['gzynda/limited:1.0'][1] == 'rate limited'
+	assert v.validation['gzynda/broken:1.0'][1] == 'error'
+	assert v.validation['gzynda/missing:1.0'][1] == 'tag not found'
+	assert v.validation['gzynda/broken:1.0'][2] == v.validation_ttl['error']
+	assert len(v.invalid) == 3
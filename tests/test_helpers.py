@@ -0,0 +1,118 @@
+import pytest, logging, os
+import subprocess as sp
+from threading import Thread
+from time import time, sleep
+
+from rgc import helpers
+from rgc.helpers import call, check_output, retry_call, kill_children
+
+def test_call():
+	assert call('true') == 0
+	assert call('exit 3') == 3
+	assert check_output('echo bears') == b'bears\n'
+	with pytest.raises(sp.CalledProcessError):
+		check_output('exit 1')
+
+def test_timeout(caplog):
+	start = time()
+	assert call('sleep 5; sleep 5', timeout=0.5) != 0
+	assert time()-start < 3
+	assert "Killed after" in caplog.text
+	assert not helpers._children
+	assert not retry_call('sleep 5', 'url', times=2, sleep_time=0, timeout=0.2)
+
+def test_kill_children():
+	out = {}
+	t = Thread(target=lambda: out.update(ret=call('sleep 30')))
+	start = time()
+	t.start()
+	while not helpers._children: sleep(0.01)
+	kill_children()
+	t.join()
+	assert out['ret'] != 0
+	assert time()-start < 5
+	assert not helpers._children
+	# Commands started after the kill are killed too
+	assert call('sleep 30') != 0
+	helpers._cancelled.clear()
+
+def test_retry_call_cancelled():
+	out = {}
+	t = Thread(target=lambda: out.update(ok=retry_call('sleep 30', 'url', sleep_time=0)))
+	start = time()
+	t.start()
+	while not helpers._children: sleep(0.01)
+	kill_children()
+	t.join()
+	helpers._cancelled.clear()
+	assert out['ok'] is False
+	assert time()-start < 5
+
+def test_retry_call_deadline():
+	start = time()
+	assert not retry_call('sleep 1; false', 'url', sleep_time=0, timeout=1.5)
+	assert time()-start < 2.5
+
+def test_read_urls():
+	from io import StringIO
+	from rgc.helpers import read_urls, unique
+	handle = StringIO(u"# biocontainers\nbwa:0.7.17\n\n  samtools:1.9  # pinned\nbwa:0.7.17\n")
+	urls = unique(['centos:7']+list(read_urls(handle)))
+	assert list(urls) == ['centos:7', 'bwa:0.7.17', 'samtools:1.9']
+
+def test_read_urls_path(tmpdir, monkeypatch):
+	import rgc.helpers
+	from rgc.helpers import read_urls
+	url_file = os.path.join(str(tmpdir), 'urls.txt')
+	with open(url_file, 'w') as OF: OF.write("bwa:0.7.17\nsamtools:1.9\n")
+	opened = []
+	real_open = open
+	def tracked_open(*args, **kwargs):
+		opened.append(real_open(*args, **kwargs))
+		return opened[-1]
+	monkeypatch.setattr(rgc.helpers, 'open', tracked_open, raising=False)
+	assert list(read_urls(url_file)) == ['bwa:0.7.17', 'samtools:1.9']
+	# Stopping early also closes the file
+	urls = read_urls(url_file)
+	next(urls)
+	urls.close()
+	assert len(opened) == 2 and all(f.closed for f in opened)
+
+def test_file_lock(tmpdir):
+	from rgc.helpers import file_lock
+	lock = os.path.join(str(tmpdir), 'locks', 'cache.lock')
+	events = []
+	def exclusive():
+		with file_lock(lock):
+			events.append('exclusive')
+	# Shared locks are held together
+	with file_lock(lock, shared=True):
+		with file_lock(lock, shared=True):
+			t = Thread(target=exclusive)
+			t.start()
+			sleep(0.3)
+			events.append('shared')
+	t.join()
+	# The exclusive lock waits for both shared holders
+	assert events == ['shared', 'exclusive']
+	assert os.path.exists(lock)
+
+def test_makedirs(tmpdir):
+	from rgc.helpers import makedirs
+	from rgc.ThreadQueue import ThreadQueue
+	path = os.path.join(str(tmpdir), 'tool', 'sub')
+	# Tags of the same tool create its directory at the same time
+	tq = ThreadQueue(target=lambda i: makedirs(path), n_threads=8, progress=False)
+	results = tq.process_list(range(32))
+	tq.join()
+	assert all(record.ok for record in results)
+	assert os.path.isdir(path)
+	open(os.path.join(path, 'file'), 'w').close()
+	with pytest.raises(OSError):
+		makedirs(os.path.join(path, 'file'))
+
+def test_run_new_session():
+	import sys
+	code, out = helpers.run('%s -c "import os; print(os.getsid(0))"'%(sys.executable), capture=True)
+	assert code == 0
+	assert int(out) != os.getsid(0)
@@ -0,0 +1,112 @@
+import pytest, logging, json, os
+from time import time
+from threading import Lock
+
+from rgc.HTTPPool import HTTPPool, HTTPError
+from rgc.ThreadQueue import ThreadQueue
+from helpers import local_server
+
+def test_get_keepalive():
+	routes = {'/tool/%i'%(i):(200, {'Content-Type':'application/json'}, json.dumps({'id':i})) for i in range(50)}
+	with local_server(routes) as srv:
+		pool = HTTPPool(max_per_host=4, timeout=5)
+		out = []
+		lock = Lock()
+		def target(i):
+			resp = json.loads(pool.get(srv.url+'/tool/%i'%(i)).decode())
+			with lock: out.append(resp['id'])
+		tq = ThreadQueue(target=target, n_threads=8)
+		start = time()
+		tq.process_list(range(50))
+		tq.join()
+		logging.info("%.0f requests/s"%(50/(time()-start)))
+		pool.close()
+	assert sorted(out) == list(range(50))
+	assert len(srv.requests) == 50
+	assert srv.connections <= 4
+
+def test_get_errors():
+	routes = {'/old':(301, {'Location':'/new'}, ''), '/new':(200, {}, 'moved')}
+	with local_server(routes) as srv:
+		pool = HTTPPool(timeout=5)
+		assert pool.get(srv.url+'/old') == b'moved'
+		with pytest.raises(HTTPError) as e:
+			pool.get(srv.url+'/missing')
+		assert e.value.code == 404
+		pool.close()
+	assert srv.connections == 1
+
+def test_request_redirect():
+	with local_server({'/new':(200, {}, 'moved')}) as srv:
+		port = srv.url.rsplit(':', 1)[1]
+		srv.routes['/old'] = (302, {'Location':'http://localhost:%s/new'%(port)}, '')
+		pool = HTTPPool(timeout=5)
+		assert pool.get(srv.url+'/old', {'Authorization':'Bearer secret'}) == b'moved'
+		pool.close()
+	# The token is not sent to the host the request was redirected to
+	assert srv.requests[0][2].get('Authorization') == 'Bearer secret'
+	assert 'Authorization' not in srv.requests[1][2]
+
+def test_cached_get():
+	import tempfile, shutil
+	def etag(handler):
+		if handler.headers.get('If-None-Match') == '"v1"':
+			return (304, {'ETag':'"v1"'}, '')
+		return (200, {'ETag':'"v1"', 'Cache-Control':'no-cache'}, 'etag')
+	routes = {'/etag':etag, '/fresh':(200, {'Cache-Control':'max-age=600'}, 'fresh'),\
+		'/nostore':(200, {'Cache-Control':'no-store'}, 'nostore'),\
+		'/stale':(200, {'Cache-Control':'max-age=0'}, 'stale')}
+	cache_dir = tempfile.mkdtemp()
+	with local_server(routes) as srv:
+		pool = HTTPPool(timeout=5)
+		for i in range(2):
+			for path in routes:
+				assert pool.cached_get(srv.url+path, cache_dir=cache_dir) == path[1:].encode()
+		assert pool.cached_get(srv.url+'/fresh', cache_dir=cache_dir, refresh=True) == b'fresh'
+		pool.close()
+	paths = [r[1] for r in srv.requests]
+	assert paths.count('/fresh') == 2
+	assert paths.count('/etag') == 2
+	assert paths.count('/nostore') == 2
+	assert paths.count('/stale') == 2
+	assert [r[2] for r in srv.requests if r[1] == '/etag'][1].get('If-None-Match') == '"v1"'
+	# Responses that can neither be reused nor revalidated are not stored
+	assert len(os.listdir(os.path.join(cache_dir, 'http'))) == 2
+	shutil.rmtree(cache_dir)
+
+def test_prune():
+	import tempfile, shutil
+	cache_dir = tempfile.mkdtemp()
+	http_dir = os.path.join(cache_dir, 'http')
+	os.makedirs(http_dir)
+	now = time()
+	for name, age in (('old', 40*24*3600), ('a', 300), ('b', 200), ('c', 100), ('x.tmp', 7200)):
+		with open(os.path.join(http_dir, name), 'wb') as OF: OF.write(b'0'*100)
+		os.utime(os.path.join(http_dir, name), (now-age, now-age))
+	pool = HTTPPool()
+	pool.cache_max_bytes = 200
+	pool.prune(cache_dir)
+	assert sorted(os.listdir(http_dir)) == ['b', 'c']
+	shutil.rmtree(cache_dir)
+
+def test_stream():
+	blob = os.urandom(5000)
+	with local_server({'/blob':(200, {}, blob)}) as srv:
+		port = srv.url.rsplit(':', 1)[1]
+		srv.routes['/redirect'] = (307, {'Location':'http://localhost:%s/blob'%(port)}, '')
+		pool = HTTPPool(timeout=5)
+		pool.chunk_size = 1024
+		chunks = []
+		resp = pool.stream(srv.url+'/redirect', chunks.append, {'Authorization':'Bearer secret'})
+		assert resp.status == 200
+		assert not resp.body
+		with pytest.raises(HTTPError) as e:
+			pool.stream(srv.url+'/missing', chunks.append)
+		assert e.value.code == 404
+		pool.close()
+	assert b''.join(chunks) == blob
+	assert len(chunks) == 5
+	# The token is not sent to the host the blob was redirected to
+	assert srv.requests[0][2].get('Authorization') == 'Bearer secret'
+	assert 'Authorization' not in srv.requests[1][2]
+	assert srv.requests[1][2].get('Accept-Encoding') == 'identity'
@@ -0,0 +1,167 @@
+import pytest, logging
+from time import time, sleep
+from threading import Lock, Event
+
+from rgc.ThreadQueue import ThreadQueue, AIMDLimiter
+
+def test_process_list():
+	out = []
+	lock = Lock()
+	def target(a, b):
+		with lock: out.append(a+b)
+	tq = ThreadQueue(target=target, n_threads=3)
+	tq.process_list([(i, i) for i in range(10)])
+	assert sorted(out) == [2*i for i in range(10)]
+	tq.join()
+
+def test_process_list_latency():
+	tq = ThreadQueue(target=lambda x: x, n_threads=2)
+	start = time()
+	for i in range(5):
+		tq.process_list(range(4))
+	tq.join()
+	assert time()-start < 0.5
+
+def test_process_list_results(caplog):
+	def target(x):
+		if x == 3: raise ValueError("bad item")
+		return x*2
+	tq = ThreadQueue(target=target, n_threads=2)
+	results = tq.process_list(range(6))
+	tq.join()
+	assert len(results) == 6
+	failed = [r for r in results if not r.ok]
+	assert len(failed) == 1
+	assert failed[0].args == 3
+	assert isinstance(failed[0].exception, ValueError)
+	assert "bad item" in caplog.text
+	assert sorted(r.result for r in results if r.ok) == [0, 2, 4, 8, 10]
+	assert all(r.elapsed >= 0 for r in results)
+
+def test_put_wait():
+	out = []
+	lock = Lock()
+	def second(x):
+		with lock: out.append(x)
+	tq2 = ThreadQueue(target=second, n_threads=2, maxsize=2)
+	tq1 = ThreadQueue(target=lambda x: tq2.put(x*10), n_threads=2, maxsize=2)
+	for i in range(8): tq1.put(i)
+	assert len(tq1.wait()) == 8
+	assert len(tq2.wait()) == 8
+	tq1.join()
+	tq2.join()
+	assert sorted(out) == [i*10 for i in range(8)]
+
+def test_priority():
+	order = []
+	lock = Lock()
+	gate = Event()
+	def target(x):
+		if x == 10: gate.wait()
+		with lock: order.append(x)
+	tq = ThreadQueue(target=target, n_threads=1, priority=lambda x: x)
+	# Hold the only worker so every item is queued before any is picked
+	tq.put(10)
+	for x in [3, 1, 5, 2, 4]: tq.put(x)
+	gate.set()
+	tq.wait()
+	tq.join()
+	assert order == [10, 5, 4, 3, 2, 1]
+
+def test_priority_list():
+	order = []
+	lock = Lock()
+	def target(x):
+		with lock: order.append(x)
+	def priority(x):
+		# A slow cost function must not let workers start early
+		sleep(0.05)
+		return x
+	tq = ThreadQueue(target=target, n_threads=1, priority=priority)
+	tq.process_list([1, 2, 5, 100, 99, 4, 3])
+	tq.join()
+	assert order == [100, 99, 5, 4, 3, 2, 1]
+
+class FakeHTTPError(Exception):
+	def __init__(self, code):
+		self.code = code
+
+def test_aimd_limiter():
+	lim = AIMDLimiter('host', max_limit=4, max_cooldown=0)
+	assert int(lim.limit) == 4
+	with pytest.raises(FakeHTTPError):
+		with lim.slot():
+			raise FakeHTTPError(429)
+	assert int(lim.limit) == 2
+	# Not found is not congestion
+	with pytest.raises(FakeHTTPError):
+		with lim.slot():
+			raise FakeHTTPError(404)
+	assert int(lim.limit) == 2
+	with lim.slot() as s:
+		s.congested()
+	assert int(lim.limit) == 1
+	with lim.slot() as s:
+		s.congested()
+	assert int(lim.limit) == 1
+	for i in range(10):
+		with lim.slot(): pass
+	assert int(lim.limit) == 4
+	assert lim.active == 0
+
+def test_aimd_limiter_concurrency():
+	lim = AIMDLimiter('host', max_limit=2)
+	state = {'active':0, 'peak':0}
+	lock = Lock()
+	def target(x):
+		with lim.slot():
+			with lock:
+				state['active'] += 1
+				state['peak'] = max(state['peak'], state['active'])
+			sleep(0.01)
+			with lock: state['active'] -= 1
+	tq = ThreadQueue(target=target, n_threads=6)
+	tq.process_list(range(12))
+	tq.join()
+	assert state['peak'] == 2
+
+def test_singleflight():
+	from rgc.ThreadQueue import Singleflight
+	calls = []
+	def target(key):
+		calls.append(key)
+		sleep(0.1)
+		if key == 'bad': raise ValueError(key)
+		return key*2
+	sf = Singleflight()
+	tq = ThreadQueue(target=lambda key: sf.do(key, target, key), n_threads=8)
+	results = tq.process_list(['a']*4+['bad']*4)
+	tq.join()
+	assert sorted(calls) == ['a', 'bad']
+	assert sorted(r.result for r in results if r.ok) == ['aa']*4
+	assert all(isinstance(r.exception, ValueError) for r in results if not r.ok)
+	assert sf.do('a', target, 'a') == 'aa'
+	assert len(calls) == 3
+
+def test_shared_handler():
+	import gc
+	from rgc.ThreadQueue import logger as tq_logger
+	tqs = [ThreadQueue(target=lambda x: x, n_threads=1) for i in range(3)]
+	handler = ThreadQueue.handler
+	assert tq_logger.handlers.count(handler) == 1
+	for tq in tqs: tq.join()
+	del tq, tqs
+	gc.collect()
+	assert handler not in tq_logger.handlers
+
+def test_kill():
+	from rgc import helpers
+	tq = ThreadQueue(target=lambda x: helpers.call('sleep 30'), n_threads=2, priority=lambda x: x)
+	for i in range(5): tq.put(i)
+	while len(helpers._children) < 2: sleep(0.01)
+	start = time()
+	tq._kill()
+	helpers._cancelled.clear()
+	assert time()-start < 5
+	assert not any(t.is_alive() for t in tq.threads)
+	assert len(tq.results) == 2